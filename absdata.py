@@ -1,8 +1,10 @@
 import json
-import ast
 import os
 import argparse
 import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from asr_decoder import decode_asr_items
 
 # 配置日志
 logging.basicConfig(
@@ -11,6 +13,78 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def parse_asr_data(data):
+    """
+    将ASR原始结果转换为按句组织的解析结果
+    
+    :param data: 读取自asr_result文件的字典，其'text'字段为FunASR输出的Python字面量字符串
+    :return: 解析结果列表，每项包含key、text和sentences
+    """
+    return items_to_results(decode_asr_items(data['text']))
+
+def items_to_results(items):
+    """
+    将FunASR的结果条目转换为按句组织的解析结果
+    
+    :param items: FunASR输出的条目列表，每项包含key、text和sentence_info
+    :return: 解析结果列表，每项包含key、text和sentences
+    """
+    results = []
+    
+    for item in items:
+        item_result = {
+            'key': item['key'],
+            'text': item['text'],
+            'sentences': []
+        }
+        
+        for sentence in item['sentence_info']:
+            item_result['sentences'].append({
+                'speaker': f"Speaker_{sentence['spk']}",
+                'text': sentence['text'],
+                'start_ms': sentence['start'],
+                'end_ms': sentence['end'],
+                # 'timestamps': sentence['timestamp']
+            })
+        
+        results.append(item_result)
+    
+    return results
+
+def save_parsed_results(results, output_dir, json_filename="parsed_asr_result.json", txt_filename="parsed_asr_result.txt"):
+    """
+    保存解析结果（JSON版本和便于阅读的文本版本）
+    
+    :param results: parse_asr_data返回的解析结果
+    :param output_dir: 输出目录路径
+    :param json_filename: 输出的JSON文件名
+    :param txt_filename: 输出的文本文件名
+    """
+    # 确保输出目录存在
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # 保存解析结果到新文件
+    output_file = os.path.join(output_dir, json_filename)
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    
+    logger.info(f"解析结果已保存到: {output_file}")
+    
+    # 同时保存一个便于阅读的文本版本
+    text_output_file = os.path.join(output_dir, txt_filename)
+    with open(text_output_file, 'w', encoding='utf-8') as f:
+        for result in results:
+            f.write(f"\n=== 文件: {result['key']} ===\n")
+            f.write(f"完整文本: {result['text'][:100]}...\n\n")
+            
+            for sent in result['sentences'][:5]:  # 只写入前5句示例
+                f.write(f"说话人: {sent['speaker']}\n")
+                f.write(f"时间段: {sent['start_ms']}-{sent['end_ms']}ms\n")
+                f.write(f"内容: {sent['text']}\n")
+                # f.write(f"时间戳: {sent['timestamps']}\n\n")
+    
+    logger.info(f"文本格式结果已保存到: {text_output_file}")
+
 def parse_and_save_asr_result(input_file, output_dir, json_filename="parsed_asr_result.json", txt_filename="parsed_asr_result.txt"):
     """
     解析ASR结果并保存到指定目录
@@ -21,59 +95,15 @@ def parse_and_save_asr_result(input_file, output_dir, json_filename="parsed_asr_
     :param txt_filename: 输出的文本文件名
     :return: 成功返回True，失败返回False
     """
-    # 确保输出目录存在
-    os.makedirs(output_dir, exist_ok=True)
-    
     try:
         # 读取JSON文件
         with open(input_file, 'r', encoding='utf-8') as f:
             data = json.load(f)
         
         # 解析文本数据
-        text_data = ast.literal_eval(data['text'])
-        
-        # 准备保存结果
-        results = []
-        
-        for item in text_data:
-            item_result = {
-                'key': item['key'],
-                'text': item['text'],
-                'sentences': []
-            }
-            
-            for sentence in item['sentence_info']:
-                item_result['sentences'].append({
-                    'speaker': f"Speaker_{sentence['spk']}",
-                    'text': sentence['text'],
-                    'start_ms': sentence['start'],
-                    'end_ms': sentence['end'],
-                    # 'timestamps': sentence['timestamp']
-                })
-            
-            results.append(item_result)
+        results = parse_asr_data(data)
         
-        # 保存解析结果到新文件
-        output_file = os.path.join(output_dir, json_filename)
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(results, f, ensure_ascii=False, indent=2)
-        
-        logger.info(f"解析结果已保存到: {output_file}")
-        
-        # 同时保存一个便于阅读的文本版本
-        text_output_file = os.path.join(output_dir, txt_filename)
-        with open(text_output_file, 'w', encoding='utf-8') as f:
-            for result in results:
-                f.write(f"\n=== 文件: {result['key']} ===\n")
-                f.write(f"完整文本: {result['text'][:100]}...\n\n")
-                
-                for sent in result['sentences'][:5]:  # 只写入前5句示例
-                    f.write(f"说话人: {sent['speaker']}\n")
-                    f.write(f"时间段: {sent['start_ms']}-{sent['end_ms']}ms\n")
-                    f.write(f"内容: {sent['text']}\n")
-                    # f.write(f"时间戳: {sent['timestamps']}\n\n")
-        
-        logger.info(f"文本格式结果已保存到: {text_output_file}")
+        save_parsed_results(results, output_dir, json_filename, txt_filename)
         return True
         
     except json.JSONDecodeError as e:
@@ -85,6 +115,55 @@ def parse_and_save_asr_result(input_file, output_dir, json_filename="parsed_asr_
     
     return False
 
+class _RecordCollector(logging.Handler):
+    """在子进程中收集日志记录，交回主进程按文件顺序输出"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+def _parse_file_task(task):
+    """
+    进程池中执行的单个文件解析任务
+    
+    :param task: (input_file, output_dir, json_filename, txt_filename)
+    :return: (是否成功, 该任务产生的日志记录)
+    """
+    collector = _RecordCollector()
+    logger.addHandler(collector)
+    logger.propagate = False
+    try:
+        success = parse_and_save_asr_result(*task)
+    finally:
+        logger.removeHandler(collector)
+        logger.propagate = True
+    return success, collector.records
+
+def run_parse_tasks(tasks, workers=1):
+    """
+    依次或并行执行解析任务，结果和日志均按任务顺序返回
+    
+    :param tasks: (input_file, output_dir, json_filename, txt_filename) 列表
+    :param workers: 进程数，为1时在当前进程中依次执行
+    :return: 生成每个任务的 (input_file, 是否成功)
+    """
+    if workers <= 1:
+        for task in tasks:
+            logger.info(f"正在处理文件: {task[0]}")
+            yield task[0], parse_and_save_asr_result(*task)
+        return
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map按提交顺序返回结果，子进程的日志随结果一起交回主进程输出
+        for task, (success, records) in zip(tasks, executor.map(_parse_file_task, tasks)):
+            logger.info(f"正在处理文件: {task[0]}")
+            for record in records:
+                logger.handle(record)
+            yield task[0], success
+
 def parse_arguments():
     """
     解析命令行参数
@@ -104,6 +183,8 @@ def parse_arguments():
                         help='输出的JSON文件后缀 (默认: .json)')
     parser.add_argument('--txt-suffix', '-t', type=str, default=".txt",
                         help='输出的文本文件后缀 (默认: .txt)')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help='并行解析的进程数 (默认: 1，即逐个处理)')
     return parser.parse_args()
 
 if __name__ == "__main__":
@@ -114,22 +195,16 @@ if __name__ == "__main__":
     success_count = 0
     failure_count = 0
     
-    # 循环处理文件
+    # 准备每个文件的解析任务
+    tasks = []
     for i in range(args.start, args.end + 1):
         input_file = f"{args.input_prefix}{i}.json"
         json_filename = f"parsed_asr_result{i}{args.json_suffix}"
         txt_filename = f"parsed_asr_result{i}{args.txt_suffix}"
-        
-        logger.info(f"正在处理文件: {input_file}")
-        
-        # 执行解析和保存
-        success = parse_and_save_asr_result(
-            input_file, 
-            args.output,
-            json_filename,
-            txt_filename
-        )
-        
+        tasks.append((input_file, args.output, json_filename, txt_filename))
+    
+    # 执行解析和保存
+    for input_file, success in run_parse_tasks(tasks, args.workers):
         if success:
             success_count += 1
             logger.info(f"文件 {input_file} 处理成功")
@@ -0,0 +1,163 @@
+import asyncio
+import math
+import random
+import time
+import logging
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger(__name__)
+
+# 服务端过载时返回的状态码，遇到时需要降低并发
+OVERLOAD_STATUSES = (429, 503)
+
+
+class RetryableStatus(Exception):
+    """接口返回了可以重试的状态码（429、5xx）"""
+
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """
+    解析Retry-After响应头
+
+    :param value: 秒数或HTTP日期
+    :return: 需要等待的秒数，无法解析时返回None
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(retry_count, retry_after=None, base=1.0, cap=60.0):
+    """
+    计算重试前的等待时间：带完全抖动的指数退避，服务端给出Retry-After时以其为准
+
+    :param retry_count: 已重试次数（从0开始）
+    :param retry_after: 服务端要求的等待秒数
+    :param base: 退避基数（秒）
+    :param cap: 最长等待（秒）
+    """
+    if retry_after is not None:
+        # 加一点抖动，避免所有请求在同一时刻重新涌入
+        return min(cap, retry_after) + random.uniform(0, base)
+    return random.uniform(0, min(cap, base * 2 ** retry_count))
+
+
+class AdaptiveLimiter:
+    """
+    根据延迟和错误自动调节在途请求数的限流器（AIMD）
+
+    - 每个统计窗口内p95延迟不超过基线的latency_tolerance倍时，每经过约limit个成功请求把上限加1
+    - p95延迟明显变高，或出现超时/429/503时，把上限乘以decrease_factor
+    - 基线取最近baseline_windows个窗口中最低的p95，即服务端较空闲时的延迟；
+      旧窗口会滚出，回答变长等原因使延迟整体变高后基线随之上调，不会一直按最初的低延迟判过载
+    """
+
+    def __init__(self, initial=8, min_limit=1, max_limit=64, decrease_factor=0.7,
+                 latency_tolerance=1.5, window=32, baseline_windows=8):
+        """
+        :param initial: 初始并发上限
+        :param min_limit: 并发下限
+        :param max_limit: 并发上限的最大值
+        :param decrease_factor: 降低并发时的乘数
+        :param latency_tolerance: p95延迟超过基线的该倍数时视为过载
+        :param window: 统计p95的样本数
+        :param baseline_windows: 估计基线时参考的最近窗口数
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.window = window
+        self.inflight = 0
+        self.baseline_p95 = None
+        self._latencies = deque(maxlen=window)
+        self._window_p95 = deque(maxlen=baseline_windows)
+        self._wakers = set()
+        self._last_decrease = 0.0
+        self._condition = asyncio.Condition()
+
+    @property
+    def current_limit(self):
+        return int(self.limit)
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.inflight < int(self.limit))
+            self.inflight += 1
+
+    async def release(self):
+        async with self._condition:
+            self.inflight -= 1
+            self._condition.notify_all()
+
+    def record_success(self, latency):
+        """记录一次成功请求的延迟"""
+        self._latencies.append(latency)
+        if len(self._latencies) < self.window:
+            self._increase()
+            return
+
+        # 最近秩法：第ceil(0.95n)小的样本
+        p95 = sorted(self._latencies)[math.ceil(len(self._latencies) * 0.95) - 1]
+        self._latencies.clear()
+        self._window_p95.append(p95)
+        self.baseline_p95 = min(self._window_p95)
+        if p95 > self.baseline_p95 * self.latency_tolerance:
+            self._decrease(f"p95延迟 {p95:.2f}s 超过基线 {self.baseline_p95:.2f}s")
+        else:
+            self._increase()
+
+    def record_overload(self, reason):
+        """记录一次超时或过载响应"""
+        self._decrease(reason)
+
+    def _increase(self):
+        old = int(self.limit)
+        self.limit = min(self.max_limit, self.limit + 1 / max(self.limit, 1))
+        if int(self.limit) > old:
+            self._wake()
+
+    def _wake(self):
+        """上限变大后唤醒等待的任务；record_success是同步方法，不能在这里持锁notify，改为调度一个任务"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = loop.create_task(self._notify())
+        self._wakers.add(task)
+        task.add_done_callback(self._wakers.discard)
+
+    async def _notify(self):
+        async with self._condition:
+            self._condition.notify_all()
+
+    def _decrease(self, reason):
+        now = time.monotonic()
+        # 同一批在途请求的连续失败只降一次，间隔取当前的延迟基线
+        if now - self._last_decrease < (self.baseline_p95 or 1.0):
+            return
+        self._last_decrease = now
+        old = int(self.limit)
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        logger.warning(f"降低并发 {old} -> {int(self.limit)}（{reason}）")
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.release()
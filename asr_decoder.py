@@ -0,0 +1,230 @@
+import ast
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# FunASR结果中体积最大、后续阶段又用不到的字段（逐字时间戳）
+DEFAULT_SKIP_KEYS = ("timestamp",)
+
+_WS = re.compile(r"\s*")
+_STRING = {
+    "'": re.compile(r"'(?:[^'\\\n]|\\.)*'"),
+    '"': re.compile(r'"(?:[^"\\\n]|\\.)*"'),
+}
+_NUMBER = re.compile(r"-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?")
+_CONSTANTS = {"True": True, "False": False, "None": None}
+# 跳过值时只关心括号和引号，其余字符交给正则整段略过
+_SKIP_INTERESTING = re.compile(r"[\[\]{}'\"]")
+
+
+class AsrDecodeError(ValueError):
+    """ASR结果字符串不是可识别的Python字面量格式"""
+
+
+class _Parser:
+    """
+    针对FunASR输出（由dict/list/str/数字组成的Python字面量）的递归下降解析器
+
+    直接在原字符串上移动下标，不构建AST；skip_keys中的字段只扫描不构建对象。
+    """
+
+    def __init__(self, text, skip_keys=DEFAULT_SKIP_KEYS):
+        self.text = text
+        self.pos = 0
+        self.skip_keys = frozenset(skip_keys)
+
+    def error(self, message):
+        snippet = self.text[self.pos:self.pos + 30]
+        return AsrDecodeError(f"{message} (位置 {self.pos}: {snippet!r})")
+
+    def skip_ws(self):
+        self.pos = _WS.match(self.text, self.pos).end()
+
+    def peek(self):
+        self.skip_ws()
+        if self.pos >= len(self.text):
+            raise self.error("输入意外结束")
+        return self.text[self.pos]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise self.error(f"期望 {char!r}")
+        self.pos += 1
+
+    def next_separator(self, closing):
+        """读取元素后的逗号或结束符，返回是否已到结束符"""
+        char = self.peek()
+        if char == ",":
+            self.pos += 1
+            if self.peek() == closing:
+                self.pos += 1
+                return True
+            return False
+        if char == closing:
+            self.pos += 1
+            return True
+        raise self.error(f"期望 ',' 或 {closing!r}")
+
+    def string(self):
+        char = self.peek()
+        pattern = _STRING.get(char)
+        match = pattern.match(self.text, self.pos) if pattern else None
+        if match is None:
+            raise self.error("无法识别的字符串")
+        self.pos = match.end()
+        token = match.group()
+        if "\\" in token:
+            # 含转义的字符串很少，交给literal_eval保证与原行为一致
+            return ast.literal_eval(token)
+        return token[1:-1]
+
+    def value(self):
+        char = self.peek()
+        if char == "{":
+            return self.dict()
+        if char == "[":
+            return list(self.iter_list())
+        if char in _STRING:
+            return self.string()
+        match = _NUMBER.match(self.text, self.pos)
+        if match:
+            self.pos = match.end()
+            token = match.group()
+            if "." in token or "e" in token or "E" in token:
+                return float(token)
+            return int(token)
+        for name, constant in _CONSTANTS.items():
+            if self.text.startswith(name, self.pos):
+                self.pos += len(name)
+                return constant
+        raise self.error("无法识别的值")
+
+    def skip_value(self):
+        """跳过一个值而不构建对象"""
+        char = self.peek()
+        if char in _STRING:
+            self.string()
+            return
+        if char not in "[{":
+            self.value()
+            return
+        depth = 0
+        while True:
+            match = _SKIP_INTERESTING.search(self.text, self.pos)
+            if match is None:
+                raise self.error("括号不匹配")
+            self.pos = match.start()
+            char = match.group()
+            if char in _STRING:
+                self.string()
+                continue
+            self.pos += 1
+            depth += 1 if char in "[{" else -1
+            if depth == 0:
+                return
+
+    def iter_list(self):
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.next_separator("]"):
+                return
+
+    def iter_dict_items(self):
+        """逐个返回key，由调用方在下一次迭代前消费对应的值"""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.string()
+            self.expect(":")
+            yield key
+            if self.next_separator("}"):
+                return
+
+    def dict(self):
+        result = {}
+        for key in self.iter_dict_items():
+            if key in self.skip_keys:
+                self.skip_value()
+            else:
+                result[key] = self.value()
+        return result
+
+    def finish(self):
+        self.skip_ws()
+        if self.pos != len(self.text):
+            raise self.error("结尾存在多余内容")
+
+
+def iter_sentence_info(text, skip_keys=DEFAULT_SKIP_KEYS):
+    """
+    逐条解析ASR结果中的sentence_info，不构建完整的AST
+
+    :param text: FunASR输出的Python字面量字符串（asr_result文件的'text'字段）
+    :param skip_keys: 不需要解析的字段名，默认跳过逐字时间戳
+    :return: 生成 (item序号, item, sentence)；item只包含sentence_info之前已解析的字段
+    """
+    parser = _Parser(text, skip_keys)
+    parser.expect("[")
+    if parser.peek() == "]":
+        parser.pos += 1
+        parser.finish()
+        return
+    index = 0
+    while True:
+        item = {}
+        for key in parser.iter_dict_items():
+            if key == "sentence_info":
+                parser.expect("[")
+                if parser.peek() == "]":
+                    parser.pos += 1
+                    continue
+                while True:
+                    yield index, item, parser.value()
+                    if parser.next_separator("]"):
+                        break
+            elif key in parser.skip_keys:
+                parser.skip_value()
+            else:
+                item[key] = parser.value()
+        index += 1
+        if parser.next_separator("]"):
+            break
+    parser.finish()
+
+
+def decode_asr_items(text, skip_keys=DEFAULT_SKIP_KEYS):
+    """
+    解析完整的ASR结果，格式异常时回退到ast.literal_eval
+
+    :param text: FunASR输出的Python字面量字符串
+    :param skip_keys: 不需要保留的字段名
+    :return: item列表，与ast.literal_eval的结果一致（去掉skip_keys中的字段）
+    """
+    try:
+        parser = _Parser(text, skip_keys)
+        items = parser.value()
+        parser.finish()
+        if not isinstance(items, list):
+            raise AsrDecodeError("顶层不是列表")
+        return items
+    except AsrDecodeError as e:
+        logger.warning(f"快速解析失败，回退到ast.literal_eval: {e}")
+
+    items = ast.literal_eval(text)
+    skip_keys = frozenset(skip_keys)
+
+    def strip(value):
+        if isinstance(value, dict):
+            return {k: strip(v) for k, v in value.items() if k not in skip_keys}
+        if isinstance(value, list):
+            return [strip(v) for v in value]
+        return value
+
+    return strip(items)
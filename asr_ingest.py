@@ -0,0 +1,267 @@
+"""
+在进程内用FunASR（paraformer + 说话人分离）识别一个目录的音频，直接产出按句组织的解析结果
+
+识别结果不再转成Python字面量字符串写文件再解析，而是直接交给合并阶段。
+每个文件的结果按 (音频内容哈希, 模型配置) 缓存，重跑或新增几集时只识别没见过的音频。
+"""
+import hashlib
+import json
+import os
+import re
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from absdata import items_to_results, save_parsed_results
+from build_state import text_hash
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".flac", ".m4a", ".aac", ".ogg", ".opus", ".mp4", ".mkv")
+DEFAULT_CACHE_DIR = "data/asr_cache"
+# FunASR的模型组合：识别、断句、标点、说话人
+DEFAULT_MODELS = {
+    "model": "paraformer-zh",
+    "vad_model": "fsmn-vad",
+    "punc_model": "ct-punc",
+    "spk_model": "cam++",
+}
+# 每批送入识别模型的语音总时长（秒），VAD切出的片段按时长拼批
+DEFAULT_BATCH_SIZE_S = 300
+
+# 进程池中每个子进程各自加载一份模型
+_worker_model = None
+
+
+def list_audio_files(audio_dir):
+    """
+    按自然顺序列出目录中的音频文件，第2集排在第10集之前
+
+    :param audio_dir: 音频目录
+    :return: 文件路径列表
+    """
+    names = [name for name in os.listdir(audio_dir) if name.lower().endswith(AUDIO_EXTENSIONS)]
+    names.sort(key=lambda name: [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)])
+    return [os.path.join(audio_dir, name) for name in names]
+
+
+def audio_hash(path, chunk_size=1 << 20):
+    """音频文件内容的sha256"""
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def load_model(models=None, device="cpu", threads=4):
+    """
+    加载FunASR模型
+
+    :param models: 模型组合，默认DEFAULT_MODELS
+    :param device: 推理设备
+    :param threads: 推理使用的CPU线程数
+    """
+    try:
+        from funasr import AutoModel
+    except ImportError:
+        raise ImportError("在进程内识别音频需要安装funasr（见requirements.txt）") from None
+    return AutoModel(**(models or DEFAULT_MODELS), device=device, ncpu=threads, disable_update=True,
+                     disable_pbar=True, disable_log=True)
+
+
+def transcribe(model, path, batch_size_s=DEFAULT_BATCH_SIZE_S):
+    """
+    识别一个音频文件
+
+    :return: 按句组织的解析结果，与absdata.parse_asr_data的返回值相同
+    """
+    items = model.generate(input=path, batch_size_s=batch_size_s)
+    for item in items:
+        # 没有检测到语音时FunASR不返回sentence_info
+        item.setdefault("sentence_info", [])
+    return items_to_results(items)
+
+
+def _init_worker(models, device, threads):
+    global _worker_model
+    _worker_model = load_model(models, device, threads)
+
+
+def _transcribe_task(task):
+    """进程池中执行的单个文件识别任务，task为 (音频路径, batch_size_s)"""
+    return transcribe(_worker_model, *task)
+
+
+class AsrCache:
+    """
+    按 (音频内容哈希, 模型配置) 缓存每个文件的解析结果，每个文件一个JSON
+
+    模型配置变化后键随之变化，旧结果不会被误用。
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, models=None):
+        self.cache_dir = cache_dir
+        self.config = json.dumps(models or DEFAULT_MODELS, sort_keys=True)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, digest):
+        return text_hash(digest, self.config)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        """
+        :return: 缓存的解析结果，没有时返回None
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                results = json.load(f)["results"]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"缓存文件 {path} 损坏，重新识别: {e}")
+            self.misses += 1
+            return None
+        self.hits += 1
+        return results
+
+    def put(self, key, audio_path, results):
+        """先写临时文件再改名，中断时不会留下半个缓存文件"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"audio": audio_path, "results": results}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def log_stats(self):
+        logger.info(f"识别缓存 - 命中: {self.hits}, 未命中: {self.misses}")
+
+
+def ingest_audio(audio_files, start=1, cache=None, workers=1, threads=None, models=None, device="cpu",
+                 batch_size_s=DEFAULT_BATCH_SIZE_S, dump_dir=None):
+    """
+    识别一组音频，按文件顺序逐集产出解析结果，可直接接合并阶段
+
+    命中缓存的文件不加载模型；未命中的文件一次全部提交给进程池，按顺序取回结果。
+
+    :param audio_files: 音频文件路径列表，依次对应第start、start+1……集
+    :param start: 第一个文件的集数编号
+    :param cache: AsrCache，为None时不使用缓存
+    :param workers: 识别进程数，为1时在当前进程中识别
+    :param threads: 每个进程的推理线程数，默认按CPU核数平分
+    :param models: 模型组合，默认DEFAULT_MODELS
+    :param device: 推理设备
+    :param batch_size_s: 每批送入识别模型的语音总时长（秒）
+    :param dump_dir: 中间结果保存目录，为None时不保存
+    :return: 生成 (编号, 解析结果)
+    """
+    workers = max(1, workers)
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    episodes = []
+    for offset, path in enumerate(audio_files):
+        key = cache.key(audio_hash(path)) if cache else None
+        results = cache.get(key) if cache else None
+        episodes.append((start + offset, path, key, results))
+    pending = [path for _, path, _, results in episodes if results is None]
+    logger.info(f"共 {len(episodes)} 个音频，需要识别 {len(pending)} 个")
+
+    executor = None
+    model = None
+    futures = {}
+    if pending and workers > 1:
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(pending)), initializer=_init_worker,
+                                       initargs=(models, device, threads))
+        futures = {path: executor.submit(_transcribe_task, (path, batch_size_s)) for path in pending}
+    try:
+        for i, path, key, results in episodes:
+            if results is None:
+                logger.info(f"正在识别第{i}集: {path}")
+                try:
+                    if executor is not None:
+                        results = futures[path].result()
+                    else:
+                        if model is None:
+                            model = load_model(models, device, threads)
+                        results = transcribe(model, path, batch_size_s)
+                except Exception as e:
+                    logger.error(f"第{i}集识别失败: {e}")
+                    continue
+                if cache:
+                    cache.put(key, path, results)
+            if dump_dir:
+                save_parsed_results(results, os.path.join(dump_dir, "parsed_results"),
+                                    f"parsed_asr_result{i}.json", f"parsed_asr_result{i}.txt")
+            yield i, results
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if cache:
+            cache.log_stats()
+
+
+def add_ingest_arguments(parser):
+    """给命令行解析器加上音频识别相关参数"""
+    parser.add_argument('--audio-dir', type=str, default=None,
+                        help='音频目录，指定后直接识别音频，不再读取ASR结果文件')
+    parser.add_argument('--asr-workers', type=int, default=1,
+                        help='识别进程数，每个进程各加载一份模型 (默认: 1)')
+    parser.add_argument('--asr-threads', type=int, default=None,
+                        help='每个识别进程的推理线程数 (默认: CPU核数 / 进程数)')
+    parser.add_argument('--asr-batch-size-s', type=int, default=DEFAULT_BATCH_SIZE_S,
+                        help=f'每批送入识别模型的语音总时长（秒） (默认: {DEFAULT_BATCH_SIZE_S})')
+    parser.add_argument('--asr-device', type=str, default="cpu",
+                        help='推理设备 (默认: cpu)')
+    parser.add_argument('--asr-cache-dir', type=str, default=DEFAULT_CACHE_DIR,
+                        help=f'识别结果缓存目录 (默认: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--no-asr-cache', action='store_true',
+                        help='不使用识别结果缓存')
+
+
+def ingest_from_args(args, start=1, dump_dir=None):
+    """
+    按命令行参数构造识别阶段
+
+    :return: 生成 (编号, 解析结果) 的迭代器，未指定 --audio-dir 时返回None
+    """
+    if not args.audio_dir:
+        return None
+    cache = None if args.no_asr_cache else AsrCache(args.asr_cache_dir)
+    return ingest_audio(list_audio_files(args.audio_dir), start, cache, args.asr_workers, args.asr_threads,
+                        device=args.asr_device, batch_size_s=args.asr_batch_size_s, dump_dir=dump_dir)
+
+
+def parse_arguments():
+    """
+    解析命令行参数
+
+    :return: 解析后的参数
+    """
+    parser = argparse.ArgumentParser(description='识别音频并保存按句组织的解析结果')
+    parser.add_argument('--output', '-o', type=str, default="data/parsed_results",
+                        help='输出目录路径 (默认: data/parsed_results)')
+    parser.add_argument('--start', '-s', type=int, default=1,
+                        help='第一个音频文件的集数编号 (默认: 1)')
+    add_ingest_arguments(parser)
+    args = parser.parse_args()
+    if not args.audio_dir:
+        parser.error("需要指定 --audio-dir")
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    args = parse_arguments()
+    count = 0
+    for i, results in ingest_from_args(args, args.start):
+        save_parsed_results(results, args.output, f"parsed_asr_result{i}.json", f"parsed_asr_result{i}.txt")
+        count += 1
+    logger.info(f"处理完成，共 {count} 集: {args.output}")
@@ -0,0 +1,109 @@
+"""
+对比 ast.literal_eval 与 asr_decoder 解析ASR结果的速度和内存峰值
+
+用法: python benchmarks/asr_decoder_bench.py [--input asr_result.txt] [--repeat 5]
+
+每种方法在独立子进程中运行，ru_maxrss 才能反映该方法自身的内存峰值。
+"""
+import argparse
+import ast
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from asr_decoder import decode_asr_items, iter_sentence_info  # noqa: E402
+
+
+def _literal_eval(text):
+    return sum(len(item['sentence_info']) for item in ast.literal_eval(text))
+
+
+def _decode_items(text):
+    return sum(len(item['sentence_info']) for item in decode_asr_items(text))
+
+
+def _iter_sentences(text):
+    return sum(1 for _ in iter_sentence_info(text))
+
+
+METHODS = {
+    "literal_eval": _literal_eval,
+    "decode_asr_items": _decode_items,
+    "iter_sentence_info": _iter_sentences,
+}
+
+
+def _max_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS返回字节，Linux返回KB
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def run_method(name, input_file, repeat):
+    """在当前进程中运行单个方法，返回测量结果"""
+    with open(input_file, 'r', encoding='utf-8') as f:
+        text = f.read()
+    func = METHODS[name]
+    rss_before = _max_rss_kb()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sentences = func(text)
+        timings.append(time.perf_counter() - start)
+    rss_after = _max_rss_kb()
+
+    tracemalloc.start()
+    func(text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "method": name,
+        "sentences": sentences,
+        "input_bytes": len(text.encode('utf-8')),
+        "best_s": min(timings),
+        "mean_s": sum(timings) / len(timings),
+        "peak_alloc_kb": peak // 1024,
+        "max_rss_kb": rss_after,
+        "rss_growth_kb": rss_after - rss_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ASR结果解析基准测试')
+    parser.add_argument('--input', type=str, default=os.path.join(ROOT, "asr_result.txt"),
+                        help='FunASR输出的Python字面量文本 (默认: asr_result.txt)')
+    parser.add_argument('--repeat', type=int, default=5, help='每种方法的重复次数 (默认: 5)')
+    parser.add_argument('--method', type=str, choices=sorted(METHODS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.method:
+        print(json.dumps(run_method(args.method, args.input, args.repeat)))
+        return
+
+    results = []
+    for name in METHODS:
+        output = subprocess.run(
+            [sys.executable, __file__, "--input", args.input, "--repeat", str(args.repeat), "--method", name],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    baseline = results[0]
+    print(f"输入: {args.input} ({baseline['input_bytes'] / 1024:.0f} KB, {baseline['sentences']} 句)")
+    print(f"{'方法':<20}{'最快(ms)':>10}{'平均(ms)':>10}{'加速':>8}{'分配峰值(KB)':>14}{'RSS增长(KB)':>13}")
+    for r in results:
+        print(f"{r['method']:<20}{r['best_s'] * 1000:>10.1f}{r['mean_s'] * 1000:>10.1f}"
+              f"{baseline['best_s'] / r['best_s']:>7.1f}x{r['peak_alloc_kb']:>14}{r['rss_growth_kb']:>13}")
+
+
+if __name__ == "__main__":
+    main()
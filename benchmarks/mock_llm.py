@@ -0,0 +1,177 @@
+"""
+进程内的OpenAI兼容mock推理服务，延迟和错误按可配置的分布产生
+
+用法: python benchmarks/mock_llm.py [--port 8001] [--ttft-ms 80] [--error-rate 0.02] [--bad-rate 0.05]
+单独运行时监听指定端口，qwenapi.py等脚本可以直接对着它跑（QWEN_API_URL指向该地址）。
+
+- 按prompts.py的模板识别请求，返回格式正确的回答，后面跟一段说明文字，
+  客户端在JSON闭合后断开时，剩余部分不会再生成
+- 首个token延迟服从对数正态分布，之后每个token固定间隔；同时解码的请求数有上限，
+  超出的请求排队，模拟GPU的批处理容量
+- 按比例返回429/500/503，或返回不合格的回答
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import threading
+
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from llm_backends import mock_answer  # noqa: E402
+
+ERROR_STATUSES = (429, 500, 503)
+# JSON之后的说明文字，模拟模型不听话多说的部分
+TRAILER = "\n以上是结果，下面是解释：" + "这段对话的语气符合人物身份。" * 8
+
+
+class MockLLMServer:
+    """OpenAI兼容的chat/completions mock服务"""
+
+    def __init__(self, ttft_ms=80.0, ttft_sigma=0.5, token_ms=2.0, chars_per_token=2, max_batch=64,
+                 error_rate=0.0, bad_rate=0.0, seed=0):
+        """
+        :param ttft_ms: 首个token延迟的中位数（毫秒）
+        :param ttft_sigma: 首个token延迟的对数标准差，0表示固定延迟
+        :param token_ms: 之后每个token的间隔（毫秒）
+        :param chars_per_token: 每个token的字符数
+        :param max_batch: 同时解码的请求数上限，超出的请求排队
+        :param error_rate: 返回429/500/503的比例
+        :param bad_rate: 返回不合格回答的比例
+        :param seed: 随机种子
+        """
+        self.ttft_ms = ttft_ms
+        self.ttft_sigma = ttft_sigma
+        self.token_ms = token_ms
+        self.chars_per_token = chars_per_token
+        self.max_batch = max_batch
+        self.error_rate = error_rate
+        self.bad_rate = bad_rate
+        self.rng = random.Random(seed)
+        self.stats = {"requests": 0, "errors": 0, "bad": 0, "tokens_sent": 0, "aborted": 0}
+        self.url = None
+        self._batch = None
+        self._runner = None
+        self._loop = None
+        self._thread = None
+
+    async def handle(self, request):
+        body = await request.json()
+        self.stats["requests"] += 1
+        if self.rng.random() < self.error_rate:
+            self.stats["errors"] += 1
+            return web.Response(status=self.rng.choice(ERROR_STATUSES))
+        if self.rng.random() < self.bad_rate:
+            self.stats["bad"] += 1
+            text = "好的，我看了一下，这确实是一段对话。" + TRAILER
+        else:
+            text = mock_answer(body) + TRAILER
+        ttft = self.ttft_ms * math.exp(self.rng.gauss(0, self.ttft_sigma)) if self.ttft_sigma else self.ttft_ms
+        chunks = [text[k:k + self.chars_per_token] for k in range(0, len(text), self.chars_per_token)]
+
+        async with self._batch:
+            await asyncio.sleep(ttft / 1000)
+            if not body.get("stream"):
+                await asyncio.sleep(len(chunks) * self.token_ms / 1000)
+                self.stats["tokens_sent"] += len(chunks)
+                return web.json_response({
+                    "choices": [{"message": {"role": "assistant", "content": text}}],
+                    "usage": {"completion_tokens": len(chunks)},
+                })
+
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            try:
+                for chunk in chunks:
+                    event = {"choices": [{"delta": {"content": chunk}}]}
+                    await response.write(b"data: " + json.dumps(event, ensure_ascii=False).encode() + b"\n\n")
+                    self.stats["tokens_sent"] += 1
+                    await asyncio.sleep(self.token_ms / 1000)
+                await response.write(b"data: [DONE]\n\n")
+            except ConnectionResetError:
+                # 客户端拿到完整JSON后断开，剩余token不再生成
+                self.stats["aborted"] += 1
+            return response
+
+    async def start(self, host="127.0.0.1", port=0):
+        """在当前事件循环中启动服务，port为0时随机选一个空闲端口"""
+        self._batch = asyncio.Semaphore(self.max_batch)
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        self._runner = web.AppRunner(app, handle_signals=False, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}/v1/chat/completions"
+        return self.url
+
+    def start_in_thread(self, host="127.0.0.1", port=0):
+        """
+        在后台线程的事件循环中启动服务，不占用调用方的事件循环
+
+        :return: chat/completions地址
+        """
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start(host, port))
+            ready.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._runner.cleanup())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="mock-llm", daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self.url
+
+    def stop(self):
+        """停止start_in_thread启动的服务"""
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+
+
+def add_server_arguments(parser):
+    """给命令行解析器加上mock服务的延迟和错误参数"""
+    parser.add_argument('--ttft-ms', type=float, default=80.0, help='首个token延迟的中位数（毫秒） (默认: 80)')
+    parser.add_argument('--ttft-sigma', type=float, default=0.5, help='首个token延迟的对数标准差 (默认: 0.5)')
+    parser.add_argument('--token-ms', type=float, default=2.0, help='每个token的间隔（毫秒） (默认: 2)')
+    parser.add_argument('--max-batch', type=int, default=64, help='同时解码的请求数上限 (默认: 64)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回429/500/503的比例 (默认: 0)')
+    parser.add_argument('--bad-rate', type=float, default=0.0, help='返回不合格回答的比例 (默认: 0)')
+    parser.add_argument('--server-seed', type=int, default=0, help='mock服务的随机种子 (默认: 0)')
+
+
+def server_from_args(args):
+    return MockLLMServer(args.ttft_ms, args.ttft_sigma, args.token_ms, max_batch=args.max_batch,
+                         error_rate=args.error_rate, bad_rate=args.bad_rate, seed=args.server_seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OpenAI兼容的mock推理服务')
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='监听地址 (默认: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8001, help='监听端口 (默认: 8001)')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    server = server_from_args(args)
+    url = server.start_in_thread(args.host, args.port)
+    print(f"mock服务已启动: {url}，Ctrl+C 退出")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+        print(json.dumps(server.stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+"""
+流水线吞吐基准测试：合成ASR数据 + 进程内mock推理服务，按阶段计时，结果写成可跨提交对比的JSON
+
+用法:
+    python benchmarks/pipeline_bench.py                                   # 结果写到 benchmarks/results/latest.json
+    python benchmarks/pipeline_bench.py --episodes 20 --error-rate 0.02 --bad-rate 0.05
+    python benchmarks/pipeline_bench.py --baseline benchmarks/results/main.json   # 吞吐下降超过容差时退出码为1
+
+场景（每个在独立子进程中运行，ru_maxrss 才是该场景自身的内存峰值；mock服务在父进程中，不占子进程的CPU）:
+- pipeline: pipeline.build_pipeline 从ASR原始结果一直到去重后的训练数据，各阶段分别计时
+- validate: qwenapi.validate_episodes 逐条校验并写出断点文件
+- validate_batch: 同上，每个请求打包 --batch-pairs 条
+- role_qa: data/create_data/api.py 按计划生成 --variants 个角色变体，按角色分片写出
+
+合成数据和mock服务的延迟、错误都由种子决定，同样的参数在不同提交上跑出的数字可以直接比较。
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from mock_llm import add_server_arguments, server_from_args  # noqa: E402
+from synthetic_asr import write_corpus  # noqa: E402
+
+SCENARIOS = ("pipeline", "validate", "validate_batch", "role_qa")
+DEFAULT_OUTPUT = os.path.join(BENCH_DIR, "results", "latest.json")
+# 对比时只看这些指标，吞吐越大越好，内存越小越好
+HIGHER_IS_BETTER = ("records_per_s",)
+LOWER_IS_BETTER = ("max_rss_kb",)
+
+
+def _max_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS返回字节，Linux返回KB
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def conversion_path(work_dir, i):
+    return os.path.join(work_dir, "conversion_result", f"conversion_result{i}.json")
+
+
+def load_pairs(work_dir, episodes):
+    pairs = []
+    for i in range(1, episodes + 1):
+        with open(conversion_path(work_dir, i), "r", encoding="utf-8") as f:
+            pairs.extend(json.load(f))
+    return pairs
+
+
+def prepare(args):
+    """生成合成ASR数据，并（不计时地）提取出校验场景要用的对话"""
+    from pipeline import build_pipeline
+
+    write_corpus(os.path.join(args.work_dir, "asr"), args.episodes, args.sentences, seed=args.seed)
+    os.makedirs(os.path.join(args.work_dir, "conversion_result"), exist_ok=True)
+    for i, conversions in build_pipeline(os.path.join(args.work_dir, "asr", "asr_result"), 1, args.episodes,
+                                         stop_after="extract"):
+        with open(conversion_path(args.work_dir, i), "w", encoding="utf-8") as f:
+            json.dump(conversions, f, ensure_ascii=False)
+
+
+def scenario_pipeline(args, metrics):
+    from pipeline import build_pipeline
+    from reshape import write_json_array
+    from dedup import Deduplicator
+
+    with Deduplicator() as dedup:
+        stream = build_pipeline(os.path.join(args.work_dir, "asr", "asr_result"), 1, args.episodes,
+                                max_concurrent=args.max_concurrent, dedup=dedup, metrics=metrics)
+        with metrics.stage("assemble") as stats:
+            stats.records_out = write_json_array(stream, os.path.join(args.work_dir, "pipeline_output.json"))
+        stats.records_in = metrics.summary("validate").records_out
+    return metrics.summary("validate").records_in, stats.records_out
+
+
+def _validate(args, metrics, batch_pairs):
+    from qwenapi import validate_episodes
+
+    jobs = [(conversion_path(args.work_dir, i), os.path.join(args.work_dir, "validate", f"result{i}.jsonl"))
+            for i in range(1, args.episodes + 1)]
+    with metrics.stage("validate") as stats:
+        asyncio.run(validate_episodes(jobs, max_concurrent=args.max_concurrent, batch_pairs=batch_pairs,
+                                      stats=metrics.llm("validate")))
+    stats.records_in = len(load_pairs(args.work_dir, args.episodes))
+    for _, output_file in jobs:
+        with open(output_file, "r", encoding="utf-8") as f:
+            stats.records_out += sum(1 for _ in f)
+    return stats.records_in, stats.records_out
+
+
+def scenario_validate(args, metrics):
+    return _validate(args, metrics, 1)
+
+
+def scenario_validate_batch(args, metrics):
+    return _validate(args, metrics, args.batch_pairs)
+
+
+def scenario_role_qa(args, metrics):
+    spec = importlib.util.spec_from_file_location("role_api", os.path.join(ROOT, "data", "create_data", "api.py"))
+    api = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(api)
+    questions = [{"input": pair["orther"], "output": pair["huang"]}
+                 for pair in load_pairs(args.work_dir, args.episodes)]
+
+    output_dir = os.path.join(args.work_dir, "role_qa")
+    with metrics.stage("role_qa") as stats:
+        asyncio.run(api.augment(questions, output_dir, variants=args.variants, max_concurrent=args.max_concurrent,
+                                stats=metrics.llm("role_qa")))
+        shard_dir = os.path.join(output_dir, "roles")
+        for name in os.listdir(shard_dir):
+            if name.endswith(".jsonl"):
+                with open(os.path.join(shard_dir, name), "r", encoding="utf-8") as f:
+                    stats.records_out += sum(1 for _ in f)
+    stats.records_in = len(questions) * args.variants
+    return stats.records_in, stats.records_out
+
+
+def run_scenario(name, args):
+    """在当前进程中运行一个场景，返回测量结果"""
+    from metrics import PipelineMetrics
+
+    metrics = PipelineMetrics()
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    records_in, records_out = globals()[f"scenario_{name}"](args, metrics)
+    wall = time.perf_counter() - start
+    report = metrics.to_dict()
+    return {
+        "records_in": records_in,
+        "records_out": records_out,
+        "wall_s": round(wall, 3),
+        "cpu_s": round(time.process_time() - cpu_start, 3),
+        "records_per_s": round(records_in / wall, 2) if wall else None,
+        "max_rss_kb": _max_rss_kb(),
+        "stages": {
+            stage: {key: data[key] for key in ("records_in", "records_out", "wall_s", "cpu_s", "records_per_s")}
+            for stage, data in report["stages"].items()
+        },
+        "llm": {
+            client: {
+                "requests": data["requests"],
+                "retries": data["retries"],
+                "failures": data["failures"],
+                "rejects": data["rejects"],
+                "latency_p50_s": data["latency_s"]["p50"],
+                "latency_p99_s": data["latency_s"]["p99"],
+                "first_token_p50_s": data["first_token_s"]["p50"],
+                "tokens_per_s": data["tokens_per_s"],
+            }
+            for client, data in report["llm"].items()
+        },
+    }
+
+
+def spawn_scenario(name, args, url):
+    """在子进程中运行场景，工作目录设为临时目录，日志文件不会写进仓库"""
+    command = [sys.executable, os.path.abspath(__file__), "--scenario", name, "--work-dir", args.work_dir,
+               "--episodes", str(args.episodes), "--max-concurrent", str(args.max_concurrent),
+               "--batch-pairs", str(args.batch_pairs), "--variants", str(args.variants)]
+    env = dict(os.environ, QWEN_API_URL=url)
+    process = subprocess.run(command, cwd=args.work_dir, env=env, capture_output=True, text=True)
+    if process.returncode != 0:
+        sys.stderr.write(process.stderr[-4000:])
+        raise SystemExit(f"场景 {name} 运行失败")
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def compare(results, baseline, tolerance):
+    """
+    与基线结果对比
+
+    :return: (对比表格的行, 退化的指标列表)
+    """
+    lines = [f"{'场景':<16}{'指标':<16}{'基线':>12}{'本次':>12}{'变化':>9}"]
+    regressions = []
+    if results["config"] != baseline.get("config"):
+        lines.append("注意: 与基线的参数不同，数字不可直接比较")
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        for metric in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            old, new = previous.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = new / old - 1
+            worse = change < -tolerance if metric in HIGHER_IS_BETTER else change > tolerance
+            if worse:
+                regressions.append(f"{name}.{metric}")
+            lines.append(f"{name:<16}{metric:<16}{old:>12}{new:>12}{change * 100:>+8.1f}%" + ("  退化" if worse else ""))
+    return lines, regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='流水线吞吐基准测试（合成数据 + mock推理服务）')
+    parser.add_argument('--scenarios', type=str, nargs='+', default=list(SCENARIOS), choices=SCENARIOS,
+                        help='要运行的场景 (默认: 全部)')
+    parser.add_argument('--episodes', type=int, default=8, help='合成的集数 (默认: 8)')
+    parser.add_argument('--sentences', type=int, default=700, help='每集句子数 (默认: 700)')
+    parser.add_argument('--seed', type=int, default=0, help='合成数据的随机种子 (默认: 0)')
+    parser.add_argument('--max-concurrent', type=int, default=64, help='模型调用的最大并发数 (默认: 64)')
+    parser.add_argument('--batch-pairs', type=int, default=8, help='validate_batch场景每个请求的对话条数 (默认: 8)')
+    parser.add_argument('--variants', type=int, default=1, help='role_qa场景每条对话的角色变体数 (默认: 1)')
+    add_server_arguments(parser)
+    parser.add_argument('--output', '-o', type=str, default=DEFAULT_OUTPUT,
+                        help='结果文件 (默认: benchmarks/results/latest.json)')
+    parser.add_argument('--baseline', type=str, default=None, help='对比的基线结果文件')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='判为退化的相对变化 (默认: 0.15)')
+    parser.add_argument('--work-dir', type=str, default=None, help='合成数据和中间结果的目录，默认使用临时目录')
+    parser.add_argument('--scenario', type=str, choices=SCENARIOS, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.scenario:
+        print(json.dumps(run_scenario(args.scenario, args)))
+        return
+
+    temp_dir = None
+    if args.work_dir is None:
+        temp_dir = tempfile.TemporaryDirectory(prefix="pipeline_bench_")
+        args.work_dir = temp_dir.name
+    args.work_dir = os.path.abspath(args.work_dir)
+
+    start = time.perf_counter()
+    prepare(args)
+    print(f"合成数据: {args.episodes} 集 x {args.sentences} 句, "
+          f"{len(load_pairs(args.work_dir, args.episodes))} 条对话 ({time.perf_counter() - start:.1f}s)")
+
+    config = {key: getattr(args, key) for key in (
+        "episodes", "sentences", "seed", "max_concurrent", "batch_pairs", "variants", "ttft_ms", "ttft_sigma",
+        "token_ms", "max_batch", "error_rate", "bad_rate", "server_seed")}
+    commit, dirty = git_revision()
+    results = {
+        "meta": {"commit": commit, "dirty": dirty, "date": datetime.now().isoformat(timespec="seconds"),
+                 "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": config,
+        "scenarios": {},
+    }
+
+    print(f"{'场景':<16}{'记录数':>8}{'耗时(s)':>9}{'记录/秒':>10}{'CPU(s)':>8}{'RSS峰值(MB)':>12}{'请求':>7}{'错误':>6}")
+    for name in args.scenarios:
+        # 每个场景用一个新的mock服务，随机序列从头开始
+        server = server_from_args(args)
+        url = server.start_in_thread()
+        try:
+            result = spawn_scenario(name, args, url)
+        finally:
+            server.stop()
+        result["server"] = dict(server.stats)
+        results["scenarios"][name] = result
+        print(f"{name:<16}{result['records_in']:>8}{result['wall_s']:>9.2f}{result['records_per_s']:>10.1f}"
+              f"{result['cpu_s']:>8.2f}{result['max_rss_kb'] / 1024:>12.0f}"
+              f"{server.stats['requests']:>7}{server.stats['errors'] + server.stats['bad']:>6}")
+        for stage, data in result["stages"].items():
+            print(f"  {stage:<14}{data['records_out']:>8}{data['wall_s']:>9.2f}{data['records_per_s'] or 0:>10.1f}"
+                  f"{data['cpu_s']:>8.2f}")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"结果已写入 {args.output}")
+    if temp_dir is not None:
+        temp_dir.cleanup()
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        lines, regressions = compare(results, baseline, args.tolerance)
+        print("\n".join(lines))
+        if regressions:
+            raise SystemExit(f"性能退化: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+对比两种prompt布局在开启prefix caching的推理服务上的前缀复用率
+
+用法: python benchmarks/prompt_prefix_bench.py [--limit 500] [--url http://localhost:8001/v1/chat/completions]
+
+- inline: 旧布局，本条数据和固定指令混在同一条user消息里，数据在前
+- system: prompts.py的布局，固定指令放在system消息，本条数据放在user消息末尾
+
+默认启动进程内的OpenAI兼容mock服务，按vLLM的方式把prompt切成固定大小的块，
+块及其之前的全部内容都出现过时计为命中。token按字符近似。
+给出--url时改为请求真实服务，命中数取自响应usage.prompt_tokens_details.cached_tokens。
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from prompts import get_template, batch_pairs_text  # noqa: E402
+
+SAMPLE_ROLES = [
+    {"role": "程序员", "traits": ["直接", "技术术语", "务实"], "examples": ["这个需求有技术债", "API返回500错误"]},
+    {"role": "家庭主妇", "traits": ["生活化", "细节控", "情感化"], "examples": ["超市土豆涨价了", "孩子班主任来电话了"]},
+    {"role": "带货主播", "traits": ["饥饿营销", "夸张表演", "价格对比"], "examples": ["最后三单秒杀！", "原价899今天99"]},
+]
+
+
+class MockPrefixServer:
+    """记录每个请求的前缀命中情况的OpenAI兼容mock服务"""
+
+    def __init__(self, block_size=16, prefill_us_per_token=20.0):
+        """
+        :param block_size: prefix cache的块大小（token）
+        :param prefill_us_per_token: 未命中token的模拟prefill耗时（微秒）
+        """
+        self.block_size = block_size
+        self.prefill_us_per_token = prefill_us_per_token
+        self.blocks = set()
+
+    @staticmethod
+    def render(messages):
+        """按ChatML拼接消息，近似服务端的chat template"""
+        return "".join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages)
+
+    def lookup(self, prompt):
+        """返回命中的token数，并把prompt的所有完整块加入缓存"""
+        cached = 0
+        prefix_hash = 0
+        hit = True
+        for start in range(0, len(prompt) - self.block_size + 1, self.block_size):
+            prefix_hash = hash((prefix_hash, prompt[start:start + self.block_size]))
+            if hit and prefix_hash in self.blocks:
+                cached += self.block_size
+            else:
+                hit = False
+                self.blocks.add(prefix_hash)
+        return cached
+
+    async def handle(self, request):
+        body = await request.json()
+        prompt = self.render(body["messages"])
+        cached = self.lookup(prompt)
+        await asyncio.sleep((len(prompt) - cached) * self.prefill_us_per_token / 1e6)
+        return web.json_response({
+            "choices": [{"message": {"content": "{}"}}],
+            "usage": {"prompt_tokens": len(prompt), "prompt_tokens_details": {"cached_tokens": cached}},
+        })
+
+
+def inline_payload(payload):
+    """把请求体改成旧布局：system消息的内容接在数据后面，合成一条user消息"""
+    system, user = payload["messages"]
+    return dict(payload, messages=[{"role": "user", "content": user["content"] + "\n" + system["content"]}])
+
+
+def load_pairs(limit):
+    pairs = []
+    for path in sorted(glob.glob(os.path.join(ROOT, "data", "conversion_result", "conversion_result*.json"))):
+        with open(path, "r", encoding="utf-8") as f:
+            pairs.extend(json.load(f))
+        if len(pairs) >= limit:
+            break
+    return pairs[:limit]
+
+
+def build_workloads(pairs, batch_pairs, seed):
+    """各模板的请求体列表"""
+    rng = random.Random(seed)
+    validate_pair = get_template("validate_pair")
+    validate_batch = get_template("validate_batch")
+    role_qa = get_template("role_qa")
+
+    role_payloads = []
+    for pair in pairs:
+        role = rng.choice(SAMPLE_ROLES)
+        role_payloads.append(role_qa.payload(
+            role=role["role"], traits=", ".join(role["traits"]), examples=role["examples"],
+            input=pair["orther"], output=pair["huang"],
+        ))
+    return {
+        "validate_pair": [validate_pair.payload(orther=p["orther"], huang=p["huang"]) for p in pairs],
+        "validate_batch": [
+            validate_batch.payload(pairs=batch_pairs_text(pairs[k:k + batch_pairs]))
+            for k in range(0, len(pairs), batch_pairs)
+        ],
+        "role_qa": role_payloads,
+    }
+
+
+async def run_workload(session, url, payloads, concurrency):
+    """发送全部请求，返回 (prompt token数, 命中token数, 耗时)"""
+    semaphore = asyncio.Semaphore(concurrency)
+    totals = [0, 0]
+
+    async def send(payload):
+        async with semaphore:
+            async with session.post(url, json=dict(payload, max_tokens=1)) as response:
+                usage = (await response.json()).get("usage", {})
+        totals[0] += usage.get("prompt_tokens", 0)
+        totals[1] += (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+
+    start = time.perf_counter()
+    # 先发一条预热，避免并发的首批请求都因缓存为空而未命中
+    await send(payloads[0])
+    await asyncio.gather(*(send(payload) for payload in payloads[1:]))
+    return totals[0], totals[1], time.perf_counter() - start
+
+
+async def run(args):
+    pairs = load_pairs(args.limit)
+    if not pairs:
+        raise SystemExit("data/conversion_result 下没有对话数据")
+    workloads = build_workloads(pairs, args.batch_pairs, args.seed)
+
+    runner = None
+    url = args.url
+    server = None
+    if url is None:
+        server = MockPrefixServer(args.block_size)
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", server.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        url = f"http://127.0.0.1:{port}/v1/chat/completions"
+
+    print(f"对话数: {len(pairs)}, 服务: {args.url or f'mock (块大小 {args.block_size})'}")
+    print(f"{'模板':<16}{'布局':<8}{'请求数':>8}{'prompt tokens':>15}{'命中tokens':>12}{'复用率':>9}{'耗时(s)':>9}")
+    try:
+        async with aiohttp.ClientSession() as session:
+            for name, payloads in workloads.items():
+                for layout in ("inline", "system"):
+                    if server:
+                        server.blocks.clear()
+                    batch = [inline_payload(p) for p in payloads] if layout == "inline" else payloads
+                    prompt_tokens, cached, elapsed = await run_workload(session, url, batch, args.concurrency)
+                    ratio = cached / prompt_tokens * 100 if prompt_tokens else 0.0
+                    print(f"{name:<16}{layout:<8}{len(batch):>8}{prompt_tokens:>15}{cached:>12}"
+                          f"{ratio:>8.1f}%{elapsed:>9.2f}")
+    finally:
+        if runner:
+            await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='prompt前缀复用率基准测试')
+    parser.add_argument('--limit', type=int, default=500, help='使用的对话条数 (默认: 500)')
+    parser.add_argument('--batch-pairs', type=int, default=8, help='validate_batch每个请求的对话条数 (默认: 8)')
+    parser.add_argument('--concurrency', type=int, default=16, help='并发请求数 (默认: 16)')
+    parser.add_argument('--block-size', type=int, default=16, help='mock服务的缓存块大小 (默认: 16)')
+    parser.add_argument('--seed', type=int, default=0, help='角色抽样的随机种子 (默认: 0)')
+    parser.add_argument('--url', type=str, default=None,
+                        help='真实的chat/completions地址，不给时使用进程内mock服务')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+生成结构与FunASR输出一致的合成ASR结果，供基准测试使用
+
+用法: python benchmarks/synthetic_asr.py --output-dir /tmp/asr --episodes 10 [--sentences 700] [--seed 0]
+
+每集写成 <output-dir>/asr_result<i>.json，内容为 {"key": ..., "text": "<Python字面量>"}，
+text中每个条目包含key、text、timestamp和sentence_info（spk、text、start、end、timestamp），
+与absdata.py读取的真实文件相同。相同的参数和种子生成的文件逐字节相同。
+"""
+import argparse
+import json
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from find_huang import DEFAULT_TRIGGERS  # noqa: E402
+
+# 常用字，用于拼出长度和字符分布接近台词的句子
+CHARS = (
+    "的一是不了人我在有他这中大来上个国到说们为子和你地出道也时年得就那要下以生会自着去之过家学对可她里后小么心多天而"
+    "能好都然没日于起还发成事只作当想看文无开手十用主行方又如前所本见经头面公同三已老从动两长知民样现分将外但身些与高"
+    "意进把法此实回二理美点月明其种声全工己话儿者向情部正名定女问力机给等几很业最间新什打便位因重被走电四第门相次东政"
+    "臣妾爱卿陛下宫殿娘娘公主太后奴才皇后侍卫将军丞相奏折圣旨赏赐"
+)
+PUNCTUATION = "，。？！"
+# 高频套话，制造精确和近似重复，让去重阶段有事可做
+STOCK_PHRASES = ["皇上息怒。", "臣遵旨。", "奴才该死，奴才该死。", "谢主隆恩。", "娘娘吉祥。", "起来吧。"]
+
+
+def synth_sentence(rng, trigger_rate, stock_rate, triggers=DEFAULT_TRIGGERS):
+    """生成一句台词，按trigger_rate插入触发词"""
+    if rng.random() < stock_rate:
+        return rng.choice(STOCK_PHRASES)
+    length = max(2, int(rng.lognormvariate(2.0, 0.5)))
+    chars = [rng.choice(CHARS) for _ in range(length)]
+    if rng.random() < trigger_rate:
+        chars.insert(rng.randrange(len(chars)), rng.choice(triggers))
+    return "".join(chars) + rng.choice(PUNCTUATION)
+
+
+def synth_item(rng, key, sentences, speakers=10, trigger_rate=0.05, stock_rate=0.05, stay_rate=0.4):
+    """
+    生成一个FunASR结果条目
+
+    :param sentences: 句子数
+    :param speakers: 说话人数，说话人按齐普夫分布出现（主角戏份最多）
+    :param stay_rate: 下一句仍是同一说话人的概率，用于产生需要合并的连续发言
+    :return: 与FunASR输出相同结构的字典
+    """
+    weights = [1 / (rank + 1) for rank in range(speakers)]
+    speaker = 0
+    clock = rng.randint(0, 5000)
+    sentence_info = []
+    all_timestamps = []
+    for _ in range(sentences):
+        if rng.random() >= stay_rate:
+            speaker = rng.choices(range(speakers), weights)[0]
+        text = synth_sentence(rng, trigger_rate, stock_rate)
+        # 间隔偶尔超过合并阈值，使合并阶段既有合并也有切分
+        clock += int(rng.expovariate(1 / 800))
+        start = clock
+        timestamps = []
+        for _ in text.rstrip(PUNCTUATION):
+            token_start = clock
+            clock += rng.randint(120, 380)
+            timestamps.append([token_start, clock])
+        sentence_info.append({"text": text, "start": start, "end": clock,
+                              "timestamp": timestamps, "spk": speaker})
+        all_timestamps.extend(timestamps)
+    return {
+        "key": key,
+        "text": "".join(sentence["text"] for sentence in sentence_info),
+        "timestamp": all_timestamps,
+        "sentence_info": sentence_info,
+    }
+
+
+def write_corpus(output_dir, episodes, sentences=700, speakers=10, trigger_rate=0.05, seed=0,
+                 prefix="asr_result"):
+    """
+    生成多集合成ASR结果
+
+    :param output_dir: 输出目录
+    :param episodes: 集数，文件编号从1开始
+    :param sentences: 每集的句子数
+    :param seed: 随机种子，每集另以集数派生，改变集数不影响已有各集的内容
+    :return: 写出的文件路径列表
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i in range(1, episodes + 1):
+        rng = random.Random(f"{seed}-{i}")
+        key = f"synthetic_episode_{i:03d}"
+        item = synth_item(rng, key, sentences, speakers, trigger_rate)
+        path = os.path.join(output_dir, f"{prefix}{i}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            # FunASR的结果是Python对象的str()，不是JSON
+            json.dump({"key": key, "text": repr([item])}, f, ensure_ascii=False)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成合成ASR结果')
+    parser.add_argument('--output-dir', '-o', type=str, required=True, help='输出目录')
+    parser.add_argument('--episodes', type=int, default=10, help='集数 (默认: 10)')
+    parser.add_argument('--sentences', type=int, default=700, help='每集句子数 (默认: 700)')
+    parser.add_argument('--speakers', type=int, default=10, help='说话人数 (默认: 10)')
+    parser.add_argument('--trigger-rate', type=float, default=0.05, help='含触发词的句子比例 (默认: 0.05)')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子 (默认: 0)')
+    args = parser.parse_args()
+    paths = write_corpus(args.output_dir, args.episodes, args.sentences, args.speakers, args.trigger_rate, args.seed)
+    total = sum(os.path.getsize(path) for path in paths)
+    print(f"已生成 {len(paths)} 集，共 {total / 1024 / 1024:.1f} MB: {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
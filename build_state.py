@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "build_state.json")
+
+
+def text_hash(*parts):
+    """若干字符串的sha256，用于把代码或prompt的内容计入参数"""
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(part.encode("utf-8"))
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+def source_hash(*modules):
+    """
+    若干源文件内容的哈希，处理逻辑改动后对应阶段会被重建
+
+    :param modules: 仓库根目录下的文件名
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    sources = []
+    for module in modules:
+        with open(os.path.join(root, module), "r", encoding="utf-8") as f:
+            sources.append(f.read())
+    return text_hash(*sources)
+
+
+class BuildState:
+    """
+    记录每个阶段每个目标（通常是一集）的输入内容哈希、参数和输出哈希
+
+    输入、参数未变且输出文件都还在、内容未被改动时，该目标视为最新，可以跳过。
+    上游的输出就是下游的输入，上游重建后内容没变时下游也不会重建。
+    文件哈希按 (大小, 修改时间) 缓存，未改动的大文件不会重复读取。
+    """
+
+    def __init__(self, path=DEFAULT_STATE_PATH):
+        """
+        :param path: 状态文件路径（JSON）
+        """
+        self.path = path
+        self.targets = {}
+        self.hashes = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            self.targets = state.get("targets", {})
+            self.hashes = state.get("hashes", {})
+
+    def file_hash(self, path):
+        """
+        文件内容的sha256，文件不存在时返回None
+
+        :param path: 文件路径
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        cached = self.hashes.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        digest = sha.hexdigest()
+        self.hashes[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def _fingerprint(self, inputs, params):
+        return {
+            "inputs": {path: self.file_hash(path) for path in inputs},
+            "params": json.loads(json.dumps(params, sort_keys=True)),
+        }
+
+    def is_fresh(self, stage, key, inputs, params):
+        """
+        判断目标是否为最新
+
+        :param stage: 阶段名
+        :param key: 目标名（如集数）
+        :param inputs: 输入文件路径列表
+        :param params: 影响输出的参数（可JSON序列化）
+        """
+        entry = self.targets.get(f"{stage}/{key}")
+        if entry is None or not entry.get("complete", True):
+            return False
+        fingerprint = self._fingerprint(inputs, params)
+        if None in fingerprint["inputs"].values():
+            return False
+        if entry["inputs"] != fingerprint["inputs"] or entry["params"] != fingerprint["params"]:
+            return False
+        return all(self.file_hash(path) == digest for path, digest in entry["outputs"].items())
+
+    def previous_params(self, stage, key):
+        """上次构建时使用的参数，没有记录时返回None"""
+        entry = self.targets.get(f"{stage}/{key}")
+        return entry["params"] if entry else None
+
+    def record(self, stage, key, inputs, params, outputs, complete=True):
+        """
+        记录一次构建
+
+        :param outputs: 输出文件路径列表
+        :param complete: 为False时表示只完成了一部分（如有请求失败），下次仍需重建，但保留参数供续跑判断
+        """
+        entry = self._fingerprint(inputs, params)
+        entry["outputs"] = {path: self.file_hash(path) for path in outputs}
+        entry["complete"] = complete
+        self.targets[f"{stage}/{key}"] = entry
+
+    def forget(self, stage, key):
+        """删除目标的记录，下次一定重建"""
+        self.targets.pop(f"{stage}/{key}", None)
+
+    def save(self):
+        """写入状态文件（先写临时文件再替换，中断时不会留下半个文件）"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"targets": self.targets, "hashes": self.hashes}, f, ensure_ascii=False, indent=1)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _line_start(f, end, block=8192):
+    """
+    从end往前找最后一个换行符，只读取文件末尾需要的部分
+
+    :param f: 以二进制模式打开的文件
+    :param end: 从这个位置往前找
+    :return: 该换行符之后的位置，没有换行符时返回0
+    """
+    pos = end
+    while pos > 0:
+        step = min(block, pos)
+        pos -= step
+        f.seek(pos)
+        cut = f.read(step).rfind(b"\n")
+        if cut >= 0:
+            return pos + cut + 1
+    return 0
+
+
+def _drop_partial_line(path):
+    """
+    中断时可能留下半行，截掉最后一个换行符之后的内容
+
+    :return: 截断后的文件长度，文件不存在时返回0
+    """
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        keep = _line_start(f, end)
+        if keep < end:
+            f.truncate(keep)
+    return keep
+
+
+def task_id(record, fields=("orther", "huang")):
+    """
+    根据输入内容计算任务编号，上游顺序变化时编号不变
+
+    :param record: 任务输入字典
+    :param fields: 参与计算的字段
+    :return: 16位十六进制字符串
+    """
+    material = json.dumps([record.get(field) for field in fields], ensure_ascii=False)
+    return hashlib.sha1(material.encode("utf-8")).hexdigest()[:16]
+
+
+def retain_tasks(output_file, keep, keep_record=None):
+    """
+    只保留输出中任务编号在keep里的结果，供输入变化后以resume=True续跑
+
+    按每行结果里的task_id判断；没有task_id的旧结果无法确认属于哪个任务，一律丢弃，续跑时重新请求。
+
+    :param output_file: JSONL输出文件路径
+    :param keep: 需要保留的任务编号集合
+    :param keep_record: 对结果字典的额外判断，返回False的结果也丢弃，为None时不判断
+    :return: 保留的任务数
+    """
+    manifest_file = output_file + ".done"
+    if not (os.path.exists(output_file) and os.path.exists(manifest_file)):
+        return 0
+    kept = {}
+    legacy = 0
+    with open(output_file, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            tid = record.get("task_id") if isinstance(record, dict) else None
+            if tid is None:
+                legacy += 1
+            elif tid in keep and tid not in kept and (keep_record is None or keep_record(record)):
+                kept[tid] = line
+    if legacy:
+        logger.warning(f"{output_file} 中有 {legacy} 条结果没有task_id，已丢弃，续跑时重新请求")
+
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.writelines(kept.values())
+    with open(manifest_file, "w", encoding="utf-8") as f:
+        f.writelines(tid + "\n" for tid in kept)
+    return len(kept)
+
+
+class CheckpointWriter:
+    """
+    每完成一个任务就把结果追加到JSONL输出，并把任务编号记入清单（output + ".done"）
+
+    中断后以resume=True重新打开，清单中已有的任务会被跳过。
+    回答多次不合格的任务记入拒绝队列（output + ".rejects"），不进清单，续跑时会重新请求。
+    """
+
+    def __init__(self, output_file, resume=False):
+        """
+        :param output_file: JSONL输出文件路径
+        :param resume: 为True时保留已有结果继续写，否则清空重来
+        """
+        self.output_file = output_file
+        self.manifest_file = output_file + ".done"
+        self.reject_file = output_file + ".rejects"
+        self.done = set()
+        self.reject_count = 0
+        self._rejects = None
+        output_dir = os.path.dirname(output_file)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+        if resume and os.path.exists(self.manifest_file):
+            _drop_partial_line(self.manifest_file)
+            with open(self.manifest_file, "r", encoding="utf-8") as f:
+                self.done.update(line.strip() for line in f if line.strip())
+            self._recover_last_result()
+            logger.info(f"从 {self.manifest_file} 恢复，已完成 {len(self.done)} 个任务")
+            mode = "a"
+        else:
+            mode = "w"
+
+        self.out = open(output_file, mode, encoding="utf-8")
+        self.manifest = open(self.manifest_file, mode, encoding="utf-8")
+        # 上次的拒绝记录在续跑时会被重新请求，这里重新记录
+        if os.path.exists(self.reject_file):
+            os.remove(self.reject_file)
+
+    def _recover_last_result(self):
+        """
+        截掉结果文件末尾的半行；最后一条结果已写入而清单没来得及写时补记清单，避免续跑时重复写入
+
+        先写结果再写清单，中断时只有最后一条结果可能不在清单里。
+        """
+        end = _drop_partial_line(self.output_file)
+        if not end:
+            return
+        with open(self.output_file, "rb") as f:
+            start = _line_start(f, end - 1)
+            f.seek(start)
+            last = f.read(end - start)
+        try:
+            tid = json.loads(last).get("task_id")
+        except (ValueError, AttributeError):
+            return
+        if tid and tid not in self.done:
+            with open(self.manifest_file, "a", encoding="utf-8") as f:
+                f.write(tid + "\n")
+            self.done.add(tid)
+            logger.info(f"任务 {tid} 的结果已写入但未记入清单，已补记")
+
+    def is_done(self, tid):
+        return tid in self.done
+
+    def write(self, tid, result):
+        """
+        追加一条结果并记入清单；结果行带上task_id字段，先写结果再写清单，
+        中断在两者之间时续跑会按结果行补记清单
+
+        :param tid: 任务编号
+        :param result: 结果字典，须可JSON序列化
+        """
+        self.out.write(json.dumps(dict(result, task_id=tid), ensure_ascii=False) + "\n")
+        self.out.flush()
+        self.manifest.write(tid + "\n")
+        self.manifest.flush()
+        self.done.add(tid)
+
+    def reject(self, item, raw, reason):
+        """
+        记录一个回答不合格的任务
+
+        :param item: 任务输入
+        :param raw: 模型的原始回答
+        :param reason: 不合格的原因
+        """
+        if self._rejects is None:
+            self._rejects = open(self.reject_file, "w", encoding="utf-8")
+        self._rejects.write(json.dumps({"item": item, "raw": raw, "reason": reason}, ensure_ascii=False) + "\n")
+        self._rejects.flush()
+        self.reject_count += 1
+
+    def close(self):
+        self.out.close()
+        self.manifest.close()
+        if self._rejects is not None:
+            self._rejects.close()
+            logger.warning(f"{self.reject_count} 个任务的回答不合格，已记入 {self.reject_file}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
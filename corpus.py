@@ -0,0 +1,484 @@
+"""
+各阶段输出的随机访问语料库：长度前缀的记录文件 + 偏移索引，通过mmap读取
+
+每个阶段一个记录文件（<stage>.rec）和一个索引文件（<stage>.idx）：
+- 记录文件：MAGIC之后依次是 [uint32长度][紧凑JSON]，每条记录单独解码
+- 索引文件：定长头 + 集数列表 + 每集来源JSON的大小和修改时间 + 每集第一条记录的下标 + 每条记录的字节偏移
+
+parsed/merged阶段按句/按轮拆成记录（附带所属条目下标item），conversion和validate阶段每条对话、
+每行结果一条记录。按 (集数, 轮次) 取一条记录只读这一条的字节，打开语料库只映射文件、
+读取集数列表，查看和抽样的开销与语料总量无关。
+
+现有脚本把按集读取JSON的地方换成 load_episode(stage, i) 即可：语料库中有这一集且该集的JSON
+自写入后没有变化时从语料库读取，否则照旧读取JSON文件，两种方式返回的结构相同。
+"""
+import json
+import mmap
+import os
+import random
+import struct
+import sys
+import argparse
+import logging
+from array import array
+from collections.abc import Sequence
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CORPUS01"
+INDEX_MAGIC = b"CORPIDX2"
+_LENGTH = struct.Struct("<I")
+# magic, n_records, n_episodes
+_INDEX_HEADER = struct.Struct("<8sQQ")
+DEFAULT_CORPUS_DIR = "data/corpus"
+# 阶段 -> (按集编号的JSON文件, 拆成记录的字段)；字段为None时文件本身就是记录列表
+STAGES = {
+    "parsed": ("data/parsed_results/parsed_asr_result{}.json", "sentences"),
+    "merged": ("data/merge_results/merged_asr_result{}.json", "merged_sentences"),
+    "conversion": ("data/conversion_result/conversion_result{}.json", None),
+    "validate": ("data/qwenapi_result/qwenapi_result{}.json", None),
+}
+
+for _code in ("q", "Q"):
+    assert array(_code).itemsize == 8, f"array('{_code}') 的大小不是 8 字节"
+
+
+def corpus_path(stage, corpus_dir=DEFAULT_CORPUS_DIR):
+    """阶段语料库的记录文件路径，索引文件为同名的.idx"""
+    return os.path.join(corpus_dir, f"{stage}.rec")
+
+
+def _index_path(path):
+    return os.path.splitext(path)[0] + ".idx"
+
+
+def read_stage_file(stage, episode):
+    """
+    按各阶段脚本的格式读取一集的JSON输出
+
+    :return: 与各阶段脚本读取到的结构相同；validate阶段为逐行解析的结果列表，跳过不完整的行
+    """
+    path = STAGES[stage][0].format(episode)
+    with open(path, "r", encoding="utf-8") as f:
+        if stage != "validate":
+            return json.load(f)
+        records = []
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+        return records
+
+
+def flatten_episode(stage, data):
+    """
+    把一集的输出拆成记录
+
+    parsed/merged的每句/每轮带上item（条目下标），条目的第一条记录另带key；
+    条目全文与逐句文本拼接不一致时第一条记录另带item_text，与sentence_store的做法相同。
+    """
+    field = STAGES[stage][1]
+    if field is None:
+        return list(data)
+    records = []
+    for n, item in enumerate(data):
+        units = item.get(field, [])
+        texts = [segment["text"] for unit in units for segment in unit.get("segments", [unit])]
+        for k, unit in enumerate(units):
+            record = dict(unit, item=n)
+            if k == 0:
+                record["key"] = item.get("key", "")
+                if item.get("text", "") != "".join(texts):
+                    record["item_text"] = item.get("text", "")
+            records.append(record)
+        if not units:
+            # 没有句子的条目也要保留，否则条目下标会错位
+            records.append({"item": n, "key": item.get("key", ""), "item_text": item.get("text", ""),
+                            "empty": True})
+    return records
+
+
+def regroup_episode(stage, records):
+    """flatten_episode的逆操作，还原一集的输出结构"""
+    field = STAGES[stage][1]
+    if field is None:
+        return list(records)
+    items = []
+    for record in records:
+        record = dict(record)
+        n = record.pop("item")
+        if n == len(items):
+            items.append({"key": record.pop("key", ""), "item_text": record.pop("item_text", None), field: []})
+        if not record.pop("empty", False):
+            items[n][field].append(record)
+    for item in items:
+        text = item.pop("item_text")
+        if text is None:
+            text = "".join(segment["text"] for unit in item[field] for segment in unit.get("segments", [unit]))
+        item["text"] = text
+        # 保持原文件的字段顺序
+        item[field] = item.pop(field)
+    return items
+
+
+class RecordView(Sequence):
+    """语料库中一段连续记录的惰性视图，取到某条时才解码"""
+
+    def __init__(self, corpus, indices):
+        self.corpus = corpus
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return RecordView(self.corpus, self.indices[index])
+        return self.corpus.record(self.indices[index])
+
+    def __iter__(self):
+        for n in self.indices:
+            yield self.corpus.record(n)
+
+
+class Corpus:
+    """
+    只读打开一个阶段的语料库
+
+    corpus[n] 取全局第n条记录，corpus[episode, turn] 取某集第turn条，corpus[a:b] 与
+    corpus.episode(i) 返回惰性视图，迭代时逐条解码。
+    """
+
+    def __init__(self, path):
+        """
+        :param path: 记录文件路径
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(_index_path(path), "rb") as f:
+            self._index_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            self._close_files()
+            raise ValueError(f"{path} 不是语料库记录文件")
+        buffer = memoryview(self._index_mmap)
+        magic, n_records, n_episodes = _INDEX_HEADER.unpack_from(buffer, 0)
+        if magic != INDEX_MAGIC:
+            buffer.release()
+            self._close_files()
+            raise ValueError(f"{_index_path(path)} 不是语料库索引文件或版本过旧，需要重新build")
+        offset = _INDEX_HEADER.size
+        self.episode_ids = buffer[offset:offset + 8 * n_episodes].cast("q")
+        offset += 8 * n_episodes
+        self.source_sizes = buffer[offset:offset + 8 * n_episodes].cast("q")
+        offset += 8 * n_episodes
+        self.source_mtimes = buffer[offset:offset + 8 * n_episodes].cast("q")
+        offset += 8 * n_episodes
+        self.episode_starts = buffer[offset:offset + 8 * (n_episodes + 1)].cast("Q")
+        offset += 8 * (n_episodes + 1)
+        self.offsets = buffer[offset:offset + 8 * (n_records + 1)].cast("Q")
+        self._episode_pos = {episode: pos for pos, episode in enumerate(self.episode_ids)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __contains__(self, episode):
+        return episode in self._episode_pos
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self.record(n)
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            episode, turn = index
+            return self.episode(episode)[turn]
+        if isinstance(index, slice):
+            return RecordView(self, range(len(self))[index])
+        return self.record(range(len(self))[index])
+
+    def episodes(self):
+        """语料库中的集数，按写入顺序"""
+        return list(self.episode_ids)
+
+    def episode_range(self, episode):
+        """
+        :return: 该集记录的全局下标范围
+        :raises KeyError: 语料库中没有这一集
+        """
+        pos = self._episode_pos[episode]
+        return range(self.episode_starts[pos], self.episode_starts[pos + 1])
+
+    def episode(self, episode):
+        """该集全部记录的惰性视图"""
+        return RecordView(self, self.episode_range(episode))
+
+    def episode_source(self, episode):
+        """
+        :return: 写入该集时来源JSON的 (大小, 修改时间纳秒)，来源未知时为None
+        :raises KeyError: 语料库中没有这一集
+        """
+        pos = self._episode_pos[episode]
+        if self.source_sizes[pos] < 0:
+            return None
+        return self.source_sizes[pos], self.source_mtimes[pos]
+
+    def raw(self, n):
+        """第n条记录的JSON字节"""
+        start = self.offsets[n]
+        (length,) = _LENGTH.unpack_from(self._mmap, start)
+        return self._mmap[start + _LENGTH.size:start + _LENGTH.size + length]
+
+    def record(self, n):
+        return json.loads(self.raw(n))
+
+    def close(self):
+        """释放mmap，之后不能再读取记录"""
+        if self._mmap is None:
+            return
+        for view in (self.episode_ids, self.source_sizes, self.source_mtimes, self.episode_starts, self.offsets):
+            view.release()
+        self._close_files()
+
+    def _close_files(self):
+        self._index_mmap.close()
+        self._mmap.close()
+        self._mmap = None
+
+
+class CorpusWriter:
+    """
+    逐集写入语料库，关闭时写索引
+
+    append=True 时在已有语料库之后追加新的集，已有的集不会被读取或重写；
+    记录文件中索引之外的尾部（上次写到一半中断）会被截掉。
+    """
+
+    def __init__(self, path, append=False):
+        """
+        :param path: 记录文件路径
+        :param append: 是否追加到已有语料库，为False时清空重写
+        """
+        self.path = path
+        self.episode_ids = array("q")
+        self.source_sizes = array("q")
+        self.source_mtimes = array("q")
+        self.episode_starts = array("Q", [0])
+        self.offsets = array("Q", [len(MAGIC)])
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if append and os.path.exists(path) and os.path.exists(_index_path(path)):
+            with Corpus(path) as corpus:
+                self.episode_ids = array("q", corpus.episode_ids)
+                self.source_sizes = array("q", corpus.source_sizes)
+                self.source_mtimes = array("q", corpus.source_mtimes)
+                self.episode_starts = array("Q", corpus.episode_starts)
+                self.offsets = array("Q", corpus.offsets)
+            self._file = open(path, "r+b")
+            self._file.truncate(self.offsets[-1])
+            self._file.seek(self.offsets[-1])
+        else:
+            self._file = open(path, "wb")
+            self._file.write(MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __contains__(self, episode):
+        return episode in self.episode_ids
+
+    def add_episode(self, episode, records, source=None):
+        """
+        :param episode: 集数编号
+        :param records: 该集的记录（可迭代）
+        :param source: 来源JSON的os.stat结果，load_episode据此判断这一集是否过期，为None时不判断
+        :return: 写入的记录数
+        """
+        if episode in self.episode_ids:
+            raise ValueError(f"第{episode}集已在语料库 {self.path} 中")
+        count = 0
+        for record in records:
+            data = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            self._file.write(_LENGTH.pack(len(data)))
+            self._file.write(data)
+            self.offsets.append(self.offsets[-1] + _LENGTH.size + len(data))
+            count += 1
+        self.episode_ids.append(episode)
+        self.source_sizes.append(source.st_size if source else -1)
+        self.source_mtimes.append(source.st_mtime_ns if source else -1)
+        self.episode_starts.append(len(self.offsets) - 1)
+        return count
+
+    def close(self):
+        """先写临时文件再改名，中断时旧索引仍然有效"""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        index_path = _index_path(self.path)
+        with open(index_path + ".tmp", "wb") as f:
+            f.write(_INDEX_HEADER.pack(INDEX_MAGIC, len(self.offsets) - 1, len(self.episode_ids)))
+            for column in (self.episode_ids, self.source_sizes, self.source_mtimes, self.episode_starts, self.offsets):
+                column.tofile(f)
+        os.replace(index_path + ".tmp", index_path)
+
+
+def build_corpus(stage, episodes, corpus_dir=DEFAULT_CORPUS_DIR, append=False):
+    """
+    把一个阶段的JSON输出写入语料库
+
+    :param stage: STAGES中的阶段名
+    :param episodes: 集数编号列表，没有输出文件的集跳过
+    :param append: 是否追加到已有语料库，已有的集跳过
+    :return: 写入的集数
+    """
+    written = 0
+    with CorpusWriter(corpus_path(stage, corpus_dir), append=append) as writer:
+        for i in episodes:
+            path = STAGES[stage][0].format(i)
+            if i in writer or not os.path.exists(path):
+                continue
+            # 先取来源状态再读取，读取期间文件被改写时下次会判为过期
+            source = os.stat(path)
+            count = writer.add_episode(i, flatten_episode(stage, read_stage_file(stage, i)), source)
+            logger.info(f"[{stage}] 第{i}集: {count} 条记录")
+            written += 1
+    return written
+
+
+# 进程内复用已打开的语料库，按 (路径, 索引修改时间) 区分，重建后会关闭旧的并重新打开
+_opened = {}
+
+
+def open_corpus(stage, corpus_dir=DEFAULT_CORPUS_DIR):
+    """
+    重建后再次调用时旧的Corpus会被关闭，不要跨调用持有它返回的视图
+
+    :return: 该阶段的Corpus，语料库不存在或索引版本过旧时返回None
+    """
+    path = corpus_path(stage, corpus_dir)
+    try:
+        mtime = os.stat(_index_path(path)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    cached = _opened.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    if cached is not None:
+        cached[1].close()
+        del _opened[path]
+    try:
+        corpus = Corpus(path)
+    except ValueError as e:
+        logger.warning(f"{e}，暂时直接读取JSON文件")
+        return None
+    _opened[path] = (mtime, corpus)
+    return corpus
+
+
+def source_signature(stage, episode, corpus_dir=DEFAULT_CORPUS_DIR):
+    """
+    一集输出的来源标识（文件大小和修改时间），不读取内容，供下游的索引判断是否需要重建
+
+    :return: 字符串，JSON文件和语料库中都没有这一集时返回None
+    """
+    path = STAGES[stage][0].format(episode)
+    if not os.path.exists(path):
+        corpus = open_corpus(stage, corpus_dir)
+        if corpus is None or episode not in corpus:
+            return None
+        path = corpus_path(stage, corpus_dir)
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def load_episode(stage, episode, corpus_dir=DEFAULT_CORPUS_DIR):
+    """
+    读取一集的输出，结构与直接读取该阶段的JSON文件相同
+
+    语料库中有这一集、且JSON文件不存在或大小和修改时间与写入该集时相同时从语料库读取，否则读取JSON文件。
+
+    :param stage: STAGES中的阶段名
+    :param episode: 集数编号
+    :param corpus_dir: 语料库目录
+    """
+    corpus = open_corpus(stage, corpus_dir)
+    if corpus is not None and episode in corpus:
+        source = corpus.episode_source(episode)
+        try:
+            stat = os.stat(STAGES[stage][0].format(episode))
+            stale = source is not None and source != (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            stale = False
+        if not stale:
+            return regroup_episode(stage, corpus.episode(episode))
+    return read_stage_file(stage, episode)
+
+
+def parse_arguments():
+    """
+    解析命令行参数
+
+    :return: 解析后的参数
+    """
+    parser = argparse.ArgumentParser(description='构建和查看各阶段输出的随机访问语料库')
+    parser.add_argument('command', choices=["build", "show", "sample", "stats"],
+                        help='build: 从JSON输出构建；show: 查看某集的记录；sample: 随机抽样；stats: 统计')
+    parser.add_argument('stage', choices=list(STAGES),
+                        help='阶段')
+    parser.add_argument('--corpus-dir', type=str, default=DEFAULT_CORPUS_DIR,
+                        help=f'语料库目录 (默认: {DEFAULT_CORPUS_DIR})')
+    parser.add_argument('--start', '-s', type=int, default=1,
+                        help='build: 起始文件编号 (默认: 1)')
+    parser.add_argument('--end', '-e', type=int, default=46,
+                        help='build: 结束文件编号 (默认: 46)')
+    parser.add_argument('--append', action='store_true',
+                        help='build: 只追加语料库中还没有的集')
+    parser.add_argument('--episode', type=int, default=None,
+                        help='show: 集数编号')
+    parser.add_argument('--turn', type=int, default=0,
+                        help='show: 从该集第几条记录开始 (默认: 0)')
+    parser.add_argument('--count', '-n', type=int, default=5,
+                        help='show/sample: 输出的记录数 (默认: 5)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='sample: 随机种子')
+    args = parser.parse_args()
+    if args.command == "show" and args.episode is None:
+        parser.error("show 需要指定 --episode")
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    args = parse_arguments()
+    if args.command == "build":
+        written = build_corpus(args.stage, range(args.start, args.end + 1), args.corpus_dir, args.append)
+        logger.info(f"写入 {written} 集: {corpus_path(args.stage, args.corpus_dir)}")
+        sys.exit(0)
+
+    corpus = open_corpus(args.stage, args.corpus_dir)
+    if corpus is None:
+        sys.exit(f"语料库 {corpus_path(args.stage, args.corpus_dir)} 不存在，先运行 build")
+    if args.command == "show":
+        for record in corpus.episode(args.episode)[args.turn:args.turn + args.count]:
+            print(json.dumps(record, ensure_ascii=False))
+    elif args.command == "sample":
+        rng = random.Random(args.seed)
+        for n in sorted(rng.sample(range(len(corpus)), min(args.count, len(corpus)))):
+            print(json.dumps(corpus.record(n), ensure_ascii=False))
+    else:
+        episodes = corpus.episodes()
+        print(json.dumps({"episodes": len(episodes), "records": len(corpus),
+                          "bytes": os.path.getsize(corpus.path)}, ensure_ascii=False))
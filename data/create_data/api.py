@@ -1,13 +1,22 @@
-import aiohttp
 import asyncio
+import argparse
 import logging
 import json
-from tqdm import tqdm
 from datetime import datetime
 import os
+import sys
 import random
 from pathlib import Path
-from typing import List, Dict, Any
+
+# 共用仓库根目录下的模块
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from llm_cache import add_cache_arguments, cache_from_args
+from prompts import ROLE_QA
+from response_parser import ResponseParseError
+from metrics import add_metrics_arguments, metrics_from_args, finish_metrics
+from llm_backends import add_backend_arguments, backend_from_args
+from llm_caller import AsyncLLMCaller
+from checkpoint import CheckpointWriter, task_id as make_task_id
 # 现代角色库（可自由扩展）
 MODERN_ROLES = [
     # 教育场景
@@ -41,6 +50,8 @@ MODERN_ROLES = [
     {"role": "环球旅行家", "traits": ["凡尔赛", "攻略达人", "风险淡化"], "examples": ["叙利亚其实很安全", "办签证要准备20项材料"]},
     {"role": "玄学博主", "traits": ["模棱两可", "灾难预言", "付费解锁"], "examples": ["你命中有贵人相助", "详情请扫码咨询"]}
 ]
+ROLES_BY_NAME = {role["role"]: role for role in MODERN_ROLES}
+
 # 配置日志
 def setup_logging(log_dir="./logs", log_level=logging.INFO, show_logs=True):
     """设置日志配置"""
@@ -63,199 +74,202 @@ def setup_logging(log_dir="./logs", log_level=logging.INFO, show_logs=True):
 
 logger = setup_logging()
 
-async def analyze_feedback(feedback_content):
+def build_plan(questions, variants=1, seed=0, roles=MODERN_ROLES):
     """
-    Analyze a single feedback entry using LLM
+    生成全部 (条目 × 角色 × 变体) 任务
+
+    每个条目的第v个变体使用角色 (offset + v) % 角色数，offset在条目间均匀分配后按种子打乱，
+    因此每一轮变体中各角色的任务数最多相差1，同一条目在变体数不超过角色数时不会重复角色。
+    相同的输入、变体数和种子得到相同的计划。
+
+    :param questions: 条目列表，每项包含input和output
+    :param variants: 每个条目生成的变体数
+    :param seed: 随机种子
+    :param roles: 角色库
+    :return: 任务列表，按变体轮次排列，中途停止时已完成的部分也覆盖各角色
     """
-    try:
-        # Clean up the response if it contains code block formatting
-        clean_response = feedback_content
-        if clean_response.startswith('```json'):
-            clean_response = clean_response[7:]  # Remove ```json prefix
-        if clean_response.startswith('```'):
-            clean_response = clean_response[3:]  # Remove ``` prefix
-        if clean_response.endswith('```'):
-            clean_response = clean_response[:-3]  # Remove ``` suffix
-        if clean_response.startswith('```python'):
-            clean_response = clean_response[7:]  # Remove ```json prefix
-        if clean_response.startswith('```'):
-            clean_response = clean_response[3:]  # Remove ``` prefix
-        if clean_response.endswith('```'):
-            clean_response = clean_response[:-3]  # Remove ``` suffix
-        # Parse the cleaned JSON
-        logger.info(f"clean_response: {clean_response}")
-        result = json.loads(clean_response)
-        logger.info(f"result: {result}")
-
-        return result
-    except Exception as e:
-        clean_response = json.dumps(clean_response, ensure_ascii=False)
-        return json.loads(clean_response)
-async def generate_role_prompt(question):
-    """生成带随机角色的prompt"""
-    selected_role = random.choice(MODERN_ROLES)
-    
-    return f"""
-## 角色
-- 你是一个资深的语言大师，精通各行各业的语言
-## 任务
-- 我需要得到一些的和皇帝的对话
-- 我现在会给你一个角色的相关信息，然后我给予你了一个对话的实例，你根据当前角色还可能的说的话或者相关问题，来生成提问以及皇帝的回答
-- 提问需要按照当代的语言提问，也就是我给你的角色信息的few-shot的样子提问
-## 角色信息
-- 提问者身份：{selected_role['role']}
-- 角色特征：{", ".join(selected_role['traits'])}
-- 示例发言："{selected_role['examples']}"
-
-## 当前对话
-- 输入内容：「{question["input"]}」
-- 皇帝回应：「{question["output"]}」
-
-## 输出格式
-- 标注json格式
-- 不要输出其他任何东西
- {{
- "input":""//模仿的提问,注意使用当代语言提问，不要出现皇上两个字，就是角色信息的正常说话
-"output":""//生成的回答
- }}
-""".strip()
-class AsyncQwenCaller:
-    def __init__(self, max_concurrent=5, max_retries=3):
-        self.max_concurrent = max_concurrent
-        self.max_retries = max_retries
-        self.url = "http://localhost:8001/v1/chat/completions"
-        self.headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer YOUR_TOKEN"
-        }
-        self._running_tasks = set()
-        self.processed_count = 0
-        self.total_count = 0
-        self.progress_bar = None
-        self.datas = []
-
-    async def __aenter__(self):
-        timeout = aiohttp.ClientTimeout(total=600, connect=10)
-        self.session = aiohttp.ClientSession(timeout=timeout)
-        return self
-
-    async def __aexit__(self, exc_type, exc, tb):
-        await self.session.close()
-
-    async def _call_api(self, question: dict, retry_count=0) -> dict:
-        """实际调用API的异步方法，带重试机制"""
-        try:
-            # print(generate_role_prompt(question))
-            data = {
-                "model": "Qwen2.5",
-                "messages": [
-                    {"role": "user", "content":await generate_role_prompt(question)}
-                ],
-                "temperature": 0.7,
-                "max_tokens": 4096 * 4
-            }
-
-            async with self.session.post(self.url, headers=self.headers, json=data) as response:
-                response_json = await response.json()
-                response_data = response_json["choices"][0]["message"].get("content")
-                logger.info(f"回答: {response_data}")
-                logger.info("-" * 50)
-
-                # question["answer_7b"] = response_data
-                return response_data
+    rng = random.Random(seed)
+    offsets = [i % len(roles) for i in range(len(questions))]
+    rng.shuffle(offsets)
+    jobs = []
+    for variant in range(variants):
+        for question, offset in zip(questions, offsets):
+            role = roles[(offset + variant) % len(roles)]
+            job = {"input": question["input"], "output": question["output"], "role": role["role"],
+                   "variant": variant}
+            job["id"] = make_task_id(job, fields=("input", "output", "role", "variant"))
+            # 采样种子随任务固定，重跑时推理服务得到完全相同的请求
+            job["seed"] = (int(job["id"], 16) + seed) % 2 ** 31
+            jobs.append(job)
+    return jobs
+
+
+def role_payload(job, attempt=0):
+    """
+    生成任务的请求体，角色信息放在user消息中，system消息对所有请求相同
 
-        except Exception as e:
-            if retry_count < self.max_retries:
-                wait_time = 2 ** retry_count  # 指数退避
-                logger.warning(f"请求失败，{wait_time}秒后重试... (错误: {str(e)})")
-                await asyncio.sleep(wait_time)
-                return await self._call_api(question, retry_count + 1)
-            logger.error(f"处理问题 '{question['question']}' 时发生错误: {str(e)}")
-            return question
-
-    async def _execute_call(self, question: dict, task_id: int):
-        """实际执行调用的内部方法"""
+    :param attempt: 重新请求的次数，用于换一个采样种子
+    """
+    role = ROLES_BY_NAME[job["role"]]
+    payload = ROLE_QA.payload(
+        role=role['role'],
+        traits=", ".join(role['traits']),
+        examples=role['examples'],
+        input=job["input"],
+        output=job["output"],
+    )
+    payload["seed"] = job["seed"] + attempt
+    return payload
+
+
+def shard_path(output_dir, role):
+    """角色对应的输出分片"""
+    return os.path.join(output_dir, "roles", f"{role}.jsonl")
+
+
+class AsyncQwenCaller(AsyncLLMCaller):
+    """按计划为条目生成角色提问，重新请求时换一个采样种子"""
+
+    async def _call_api(self, job: dict, attempt=0):
+        """
+        为一个任务生成角色提问，先查缓存，只有合格的回答才写入缓存
+
+        :param attempt: 重新请求的次数，每次使用不同的采样种子
+        :return: 解析后的结果，网络错误重试用尽时返回None
+        :raises ResponseParseError: 回答不符合格式
+        """
+        data = role_payload(job, attempt)
+        return await self._post_chat(data, ROLE_QA, job.get("input"))
+
+    async def _execute_call(self, job: dict, task_id: int, writer=None):
+        """实际执行调用的内部方法；回答不合格时换一个采样种子重新请求，仍不合格则记入拒绝队列"""
         try:
-            result = await self._call_api(question)
-            result = await analyze_feedback(result)
-            self.datas.append(result)
-            if self.progress_bar:
-                self.progress_bar.update(1)
-                self.processed_count += 1
+            result = await self._call_with_requery(lambda attempt: self._call_api(job, attempt), task_id)
+            if result is not None:
+                self._save_result(job["id"], result, writer)
+        except ResponseParseError as error:
+            self._save_reject(job, error, writer)
         except Exception as e:
             logger.error(f"任务 {task_id} 执行失败: {str(e)}")
-            if self.progress_bar:
-                self.progress_bar.update(1)
-                self.processed_count += 1
-
-    async def process_question(self, question: dict, task_id: int):
-        """处理单个问题"""
-        while len(self._running_tasks) >= self.max_concurrent:
-            done, _ = await asyncio.wait(
-                self._running_tasks,
-                return_when=asyncio.FIRST_COMPLETED
-            )
-            self._running_tasks -= done
-
-        task = asyncio.create_task(self._execute_call(question, task_id))
-        self._running_tasks.add(task)
-        task.add_done_callback(self._running_tasks.discard)
-
-    def set_progress_bar(self, total):
-        """设置进度条"""
-        self.total_count = total
-        self.progress_bar = tqdm(total=total, desc="处理问题", unit="个")
-
-    def close_progress(self):
-        """关闭进度条"""
-        if self.progress_bar:
-            self.progress_bar.close()
-
-
-async def main(input_file: str, output_dir: str, max_concurrent: int = 5, batch_size: int = 100):
-    for j in range(batch_size):
-        questions=[]
-        with open(input_file, "r", encoding="utf-8") as f:
-            data=json.load(f)
-            for i in data:
-                questions.append(i)
-        # for line in f:
-        #     try:
-        #         question = json.loads(line)
-        #         questions.append(question)
-        #     except json.JSONDecodeError:
-        #         logger.warning(f"跳过无效的JSON行: {line[:50]}...")
-
-        logger.info(f"共读取 {len(questions)} 条问题记录")
-
-        # 异步处理问题
-        async with AsyncQwenCaller(max_concurrent=max_concurrent) as caller:
-            caller.set_progress_bar(len(questions))
-
-            tasks = []
-            for i, question in enumerate(questions):
-                task = caller.process_question(question, i + 1)
-                tasks.append(task)
-
-            # 等待所有任务完成
-            await asyncio.gather(*tasks, return_exceptions=True)
-
-            # 等待剩余的任务完成
+        self._advance()
+
+    async def process_job(self, job: dict, task_id: int, writer=None):
+        """
+        处理单个任务，并发已满时等待空位后再提交
+
+        :param job: build_plan生成的任务
+        :param writer: 该任务结果写入的CheckpointWriter，默认使用self.writer
+        :return: 已提交的任务
+        """
+        return await self._submit(self._execute_call(job, task_id, writer))
+
+
+def load_questions(input_file: str) -> list:
+    """读取待扩充的训练数据，每项包含input和output"""
+    with open(input_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def check_plan(plan_file: str, plan: dict, resume: bool):
+    """
+    写出计划参数；续跑时除变体数外的参数必须与已有输出一致，否则已完成的任务对不上新计划
+
+    同一条目前v个变体的任务与总变体数无关，续跑时可以调大变体数，只补做新增的变体。
+
+    :raises ValueError: 续跑时参数不一致或变体数变小
+    """
+    if resume and os.path.exists(plan_file):
+        with open(plan_file, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        if dict(previous, variants=None) != dict(plan, variants=None):
+            raise ValueError(f"计划参数与 {plan_file} 不一致，不能续跑: {previous} != {plan}")
+        if plan["variants"] < previous["variants"]:
+            raise ValueError(f"续跑时变体数不能小于已有输出的 {previous['variants']}")
+    os.makedirs(os.path.dirname(plan_file) or ".", exist_ok=True)
+    with open(plan_file, "w", encoding="utf-8") as f:
+        json.dump(plan, f, ensure_ascii=False, indent=2)
+
+
+async def augment(questions: list, output_dir: str, variants: int = 1, seed: int = 0, max_concurrent: int = 5,
+                  cache=None, resume: bool = False, adaptive: bool = True, stats=None, backend=None) -> int:
+    """
+    按计划为每个条目生成多个角色变体，所有任务共用一个会话和并发上限，结果按角色写入各自的分片
+
+    :param questions: 条目列表，每项包含input和output
+    :param output_dir: 输出目录，分片写到 roles/<角色>.jsonl，计划参数写到 plan.json
+    :param variants: 每个条目生成的变体数
+    :param seed: 随机种子
+    :param max_concurrent: 最大并发数
+    :param cache: llm_cache.ResponseCache，为None时不使用缓存
+    :param resume: 是否跳过各分片清单中已完成的任务
+    :param adaptive: 是否根据延迟和错误自动调节并发，为False时固定为max_concurrent
+    :param stats: metrics.LLMStats，记录模型调用的指标
+    :param backend: llm_backends中的模型后端，为None时使用HttpBackend
+    :return: 本次提交的任务数
+    """
+    if variants > len(MODERN_ROLES):
+        logger.warning(f"变体数 {variants} 超过角色数 {len(MODERN_ROLES)}，同一条目会重复使用角色（采样种子不同）")
+    jobs = build_plan(questions, variants, seed)
+    check_plan(os.path.join(output_dir, "plan.json"), {
+        "items": len(questions),
+        "items_id": make_task_id({"items": questions}, fields=("items",)),
+        "variants": variants,
+        "seed": seed,
+        "roles": [role["role"] for role in MODERN_ROLES],
+    }, resume)
+
+    writers = {role["role"]: CheckpointWriter(shard_path(output_dir, role["role"]), resume=resume)
+               for role in MODERN_ROLES}
+    pending = [job for job in jobs if not writers[job["role"]].is_done(job["id"])]
+    logger.info(f"共 {len(questions)} 条 x {variants} 个变体 = {len(jobs)} 个任务，待处理 {len(pending)} 个")
+
+    try:
+        async with AsyncQwenCaller(max_concurrent=max_concurrent, cache=cache, adaptive=adaptive,
+                                   stats=stats, backend=backend) as caller:
+            caller.set_progress_bar(len(pending))
+            # 逐个提交，并发已满时process_job会等待，在途任务数不超过max_concurrent
+            for i, job in enumerate(pending):
+                await caller.process_job(job, i + 1, writers[job["role"]])
             if caller._running_tasks:
                 await asyncio.wait(caller._running_tasks)
-
             caller.close_progress()
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    logger.info(f"所有任务处理完成，结果按角色写入 {os.path.join(output_dir, 'roles')}")
+    return len(pending)
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='基于角色生成现代提问与皇帝回答')
+    parser.add_argument('--input', '-i', type=str, default="input/train_data.json",
+                        help='待扩充的训练数据 (默认: input/train_data.json)')
+    parser.add_argument('--output-dir', '-o', type=str, default="output",
+                        help='输出目录 (默认: output)')
+    parser.add_argument('--variants', type=int, default=1,
+                        help='每条数据生成的角色变体数 (默认: 1)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='分配角色和采样用的随机种子 (默认: 0)')
+    parser.add_argument('--max-concurrent', type=int, default=64,
+                        help='最大并发数 (默认: 64)')
+    parser.add_argument('--fixed-concurrency', action='store_true',
+                        help='关闭自适应并发，始终使用 --max-concurrent')
+    parser.add_argument('--resume', action='store_true',
+                        help='跳过各分片清单中已完成的任务，继续上次中断的运行')
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    add_backend_arguments(parser)
+    return parser.parse_args()
 
-            # 写入结果
-            batch_output = Path(output_dir) / f"batch_{j+1}.json"
-
-            with open(batch_output, "w", encoding="utf-8") as f:
-                for data in caller.datas:
-                    f.write(json.dumps(data, ensure_ascii=False) + "\n")
 
-        logger.info(f"所有批次处理完成，共生成 {batch_size} 个batch文件")
 if __name__ == "__main__":
-   
-    input_file = f"input/train_data.json"
-    output_file = f"output"
-    asyncio.run(main(input_file, output_file, max_concurrent=64,batch_size=1))
+    args = parse_arguments()
+    metrics = metrics_from_args(args)
+    with metrics.stage("role_qa"):
+        asyncio.run(augment(load_questions(args.input), args.output_dir, variants=args.variants, seed=args.seed,
+                            max_concurrent=args.max_concurrent, cache=cache_from_args(args), resume=args.resume,
+                            adaptive=not args.fixed_concurrency, stats=metrics.llm("role_qa"),
+                            backend=backend_from_args(args)))
+    finish_metrics(metrics, args)
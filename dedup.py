@@ -0,0 +1,269 @@
+import json
+import os
+import re
+import sqlite3
+import hashlib
+import argparse
+import logging
+import tempfile
+import unicodedata
+import zlib
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = 0.8
+DEFAULT_NUM_PERM = 128
+DEFAULT_NGRAM = 3
+DEFAULT_FIELDS = ("input", "output")
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+# 归一化时去掉的字符：空白和各类标点
+_STRIP_PATTERN = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def normalize_text(text):
+    """全角转半角、转小写并去掉空白和标点，只保留文字本身"""
+    return _STRIP_PATTERN.sub("", unicodedata.normalize("NFKC", text or "").lower())
+
+
+def char_ngrams(text, n=DEFAULT_NGRAM):
+    """
+    字符n-gram集合，中文不分词也能比较
+
+    :param text: 归一化后的文本
+    :param n: n-gram长度，文本短于n时整段作为一个gram
+    """
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[k:k + n] for k in range(len(text) - n + 1)}
+
+
+def optimal_bands(threshold, num_perm):
+    """
+    选择LSH的分段数b和每段行数r（b*r<=num_perm），使相似度阈值处的S曲线拐点 (1/b)^(1/r) 最接近threshold
+
+    :return: (b, r)
+    """
+    best = None
+    for r in range(1, num_perm + 1):
+        b = num_perm // r
+        error = abs((1 / b) ** (1 / r) - threshold)
+        if best is None or error < best[0]:
+            best = (error, b, r)
+    return best[1], best[2]
+
+
+class MinHasher:
+    """对字符n-gram集合计算MinHash签名"""
+
+    def __init__(self, num_perm=DEFAULT_NUM_PERM, ngram=DEFAULT_NGRAM, seed=1):
+        self.num_perm = num_perm
+        self.ngram = ngram
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text):
+        """
+        :param text: 归一化后的文本
+        :return: 长度为num_perm的uint64数组
+        """
+        grams = char_ngrams(text, self.ngram)
+        if not grams:
+            return np.full(self.num_perm, _MAX_HASH, dtype=np.uint64)
+        hashes = np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams),
+                             dtype=np.uint64, count=len(grams))
+        # (a*h + b) mod p，每列是一个哈希函数
+        permuted = (np.outer(hashes, self.a) + self.b) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=0)
+
+
+class Deduplicator:
+    """
+    流式去重：精确重复（归一化文本的哈希）+ 近似重复（MinHash/LSH）
+
+    已见过的哈希、签名和LSH分桶都存放在SQLite中，内存占用与数据量无关。
+    每条记录只和LSH分桶中的候选比较签名，不做两两比较。
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, num_perm=DEFAULT_NUM_PERM, ngram=DEFAULT_NGRAM,
+                 fields=DEFAULT_FIELDS, db_path=None, near=True):
+        """
+        :param threshold: 估计的Jaccard相似度达到该值视为近似重复
+        :param num_perm: MinHash签名长度
+        :param ngram: 字符n-gram长度
+        :param fields: 参与比较的字段，按顺序拼接
+        :param db_path: 状态数据库路径，为None时使用临时文件
+        :param near: 是否做近似去重，为False时只去精确重复
+        """
+        self.threshold = threshold
+        self.fields = tuple(fields)
+        self.near = near
+        self.hasher = MinHasher(num_perm, ngram)
+        self.bands, self.rows = optimal_bands(threshold, num_perm)
+        self.stats = {"total": 0, "kept": 0, "exact": 0, "near": 0}
+
+        self._temp_dir = None
+        if db_path is None:
+            self._temp_dir = tempfile.TemporaryDirectory(prefix="dedup_")
+            db_path = os.path.join(self._temp_dir.name, "dedup.sqlite")
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        # 摘要和分桶键都取64位整数，作为整数主键/索引比BLOB快
+        self.conn.execute("CREATE TABLE IF NOT EXISTS exact (digest INTEGER PRIMARY KEY)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS signatures (id INTEGER PRIMARY KEY, signature BLOB NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS buckets (key INTEGER NOT NULL, id INTEGER NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS buckets_key ON buckets(key)")
+        self._in_clause = ",".join("?" * self.bands)
+        # 分桶键 = 段内各行的多项式哈希 + 段号偏移，不同段的键互不相同
+        rng = np.random.RandomState(0)
+        self._band_mult = rng.randint(1, 1 << 62, size=self.rows, dtype=np.uint64) | np.uint64(1)
+        self._band_offset = rng.randint(1, 1 << 62, size=self.bands, dtype=np.uint64)
+        logger.info(f"LSH参数: {self.bands} 段 x {self.rows} 行，阈值 {threshold}")
+
+    def _text(self, record):
+        return "\x00".join(normalize_text(str(record.get(field, ""))) for field in self.fields)
+
+    def _band_keys(self, signature):
+        bands = signature[:self.bands * self.rows].reshape(self.bands, self.rows)
+        keys = (bands * self._band_mult).sum(axis=1) + self._band_offset
+        return keys.view(np.int64).tolist()
+
+    def check(self, record):
+        """
+        判断记录是否重复，不重复时记入已见集合
+
+        :param record: 字典记录
+        :return: "exact" / "near" 表示重复类型，不重复时返回None
+        """
+        self.stats["total"] += 1
+        text = self._text(record)
+        digest = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "little", signed=True)
+        if self.conn.execute("INSERT OR IGNORE INTO exact (digest) VALUES (?)", (digest,)).rowcount == 0:
+            self.stats["exact"] += 1
+            return "exact"
+
+        if self.near:
+            signature = self.hasher.signature(text)
+            keys = self._band_keys(signature)
+            if self._has_similar(signature, keys):
+                self.stats["near"] += 1
+                return "near"
+            record_id = self.conn.execute("INSERT INTO signatures (signature) VALUES (?)",
+                                          (signature.tobytes(),)).lastrowid
+            self.conn.executemany("INSERT INTO buckets (key, id) VALUES (?, ?)", [(key, record_id) for key in keys])
+
+        self.stats["kept"] += 1
+        return None
+
+    def _has_similar(self, signature, keys):
+        """在与该签名同桶的记录中找估计相似度达到阈值的"""
+        rows = self.conn.execute(
+            f"SELECT signature FROM signatures WHERE id IN "
+            f"(SELECT id FROM buckets WHERE key IN ({self._in_clause}))", keys
+        )
+        for (other,) in rows:
+            other = np.frombuffer(other, dtype=np.uint64)
+            if np.count_nonzero(other == signature) / len(signature) >= self.threshold:
+                return True
+        return False
+
+    def filter(self, records):
+        """
+        逐条去重
+
+        :param records: 记录迭代器
+        :return: 生成不重复的记录（保留第一次出现的）
+        """
+        for count, record in enumerate(records, 1):
+            if self.check(record) is None:
+                yield record
+            if count % 10000 == 0:
+                self.conn.commit()
+                logger.info(f"已处理 {count} 条，保留 {self.stats['kept']} 条")
+        self.conn.commit()
+
+    def log_stats(self):
+        total = self.stats["total"]
+        removed = self.stats["exact"] + self.stats["near"]
+        rate = removed / total * 100 if total else 0.0
+        logger.info(f"去重统计 - 输入: {total}, 保留: {self.stats['kept']}, 精确重复: {self.stats['exact']}, "
+                    f"近似重复: {self.stats['near']}, 去除比例: {rate:.1f}%")
+
+    def close(self):
+        self.conn.close()
+        if self._temp_dir is not None:
+            self._temp_dir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def iter_records(path):
+    """读取JSON数组或JSONL文件中的记录"""
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)
+
+
+def parse_arguments():
+    """
+    解析命令行参数
+
+    :return: 解析后的参数
+    """
+    parser = argparse.ArgumentParser(description='训练数据的精确去重与近似去重（MinHash/LSH）')
+    parser.add_argument('input', type=str, help='输入文件（JSON数组或.jsonl）')
+    parser.add_argument('--output', '-o', type=str, required=True,
+                        help='输出文件，.jsonl结尾时逐行写出，否则写JSON数组')
+    parser.add_argument('--threshold', '-t', type=float, default=DEFAULT_THRESHOLD,
+                        help=f'近似重复的Jaccard相似度阈值 (默认: {DEFAULT_THRESHOLD})')
+    parser.add_argument('--num-perm', type=int, default=DEFAULT_NUM_PERM,
+                        help=f'MinHash签名长度 (默认: {DEFAULT_NUM_PERM})')
+    parser.add_argument('--ngram', type=int, default=DEFAULT_NGRAM,
+                        help=f'字符n-gram长度 (默认: {DEFAULT_NGRAM})')
+    parser.add_argument('--fields', type=str, nargs='+', default=list(DEFAULT_FIELDS),
+                        help='参与比较的字段 (默认: input output)')
+    parser.add_argument('--exact-only', action='store_true',
+                        help='只去掉精确重复')
+    parser.add_argument('--db', type=str, default=None,
+                        help='去重状态数据库路径，默认使用临时文件')
+    parser.add_argument('--stats', type=str, default=None,
+                        help='把统计结果写入该JSON文件')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    args = parse_arguments()
+
+    from reshape import write_json_array
+
+    with Deduplicator(args.threshold, args.num_perm, args.ngram, args.fields, args.db,
+                      near=not args.exact_only) as dedup:
+        records = dedup.filter(iter_records(args.input))
+        if args.output.endswith(".jsonl"):
+            with open(args.output, "w", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            write_json_array(records, args.output)
+        dedup.log_stats()
+        if args.stats:
+            with open(args.stats, "w", encoding="utf-8") as f:
+                json.dump(dict(dedup.stats, threshold=args.threshold, bands=dedup.bands, rows=dedup.rows),
+                          f, ensure_ascii=False, indent=2)
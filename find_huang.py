@@ -1,17 +1,303 @@
 import json
+import os
+import pickle
+import sys
+import argparse
+from array import array
 
-for i in range(1,47):
-    with open(f"data/merge_results/merged_asr_result{i}.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
-        datas=data[0]["merged_sentences"]
-    datajson=[]
-    for j,item in enumerate(datas):
-        if "朕" in item["text"]:
-            print(item["text"])
-            print(j)
-            conversion={"orther":datas[j-1]["text"],"huang":item["text"]}
-            datajson.append(conversion)
-
-    with open(f"data/conversion_result/conversion_result{i}.json", "w", encoding="utf-8") as f:
-        json.dump(datajson, f, ensure_ascii=False, indent=2)
+from corpus import load_episode, source_signature
 
+# 默认的触发词，出现任意一个即视为皇上说的话
+DEFAULT_TRIGGERS = ("朕",)
+
+
+def _grams(text):
+    """文本中出现的单字和相邻二字"""
+    grams = set(text)
+    grams.update(text[k:k + 2] for k in range(len(text) - 1))
+    return grams
+
+
+class DialogueIndex:
+    """
+    合并后对话轮次上的单字/二字倒排索引
+
+    建一次索引后可以反复用不同的触发词表查询，不必每次扫描全部文本。
+    单字触发词直接取倒排表，多字触发词取其各个二字倒排表的交集后再做子串校验。
+    """
+
+    def __init__(self):
+        self.texts = []
+        # 每轮对应的 (集数, 条目序号, 条目内轮次序号)
+        self.positions = []
+        # 每个条目的第一轮在texts中的下标，用于判断上一轮是否属于同一条目
+        self.item_starts = array('I')
+        # 每轮的说话人和起止时间，供预筛判断说话人是否交替、间隔是否过长
+        self.speakers = []
+        self.start_ms = array('q')
+        self.end_ms = array('q')
+        self.postings = {}
+        # 集数 -> 建索引时合并结果的来源标识，保存的索引据此判断是否过期
+        self.sources = {}
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add_episode(self, episode, merged_results, source=None):
+        """
+        加入一集的合并结果
+
+        :param episode: 集数编号
+        :param merged_results: merge_speaker.py处理后的结果列表（可包含多个条目）
+        :param source: 合并结果的来源标识，见corpus.source_signature
+        """
+        self.sources[episode] = source
+        for item_index, item in enumerate(merged_results):
+            item_start = len(self.texts)
+            for turn_index, turn in enumerate(item.get("merged_sentences", [])):
+                self._add_turn(turn["text"], (episode, item_index, turn_index), item_start,
+                               turn.get("speaker"), turn.get("start_ms", 0), turn.get("end_ms", 0))
+
+    def add_store(self, episode, store, source=None):
+        """
+        直接从列式句子存储加入一集，各轮的文本、说话人和起止时间取自存储的列，不生成逐轮字典
+
+        :param episode: 集数编号
+        :param store: 附带轮次划分的sentence_store.SentenceStore（merge_speaker.merge_store的结果）
+        :param source: 存储文件的来源标识
+        """
+        if not store.is_merged:
+            raise ValueError(f"第{episode}集的句子存储没有轮次划分，需要先经过merge_speaker.py合并")
+        self.sources[episode] = source
+        turn_offsets = store.turn_offsets
+        for item_index in range(len(store.keys)):
+            item_start = len(self.texts)
+            for turn_index, t in enumerate(store.item_turn_range(item_index)):
+                first, last = turn_offsets[t], turn_offsets[t + 1]
+                self._add_turn(store.turn_text(t), (episode, item_index, turn_index), item_start,
+                               store.speaker_name(first), store.start_ms[first], store.end_ms[last - 1])
+
+    def _add_turn(self, text, position, item_start, speaker, start_ms, end_ms):
+        turn_id = len(self.texts)
+        self.texts.append(text)
+        self.positions.append(position)
+        self.item_starts.append(item_start)
+        self.speakers.append(speaker)
+        self.start_ms.append(start_ms)
+        self.end_ms.append(end_ms)
+        for gram in _grams(text):
+            postings = self.postings.get(gram)
+            if postings is None:
+                postings = self.postings[gram] = array('I')
+            postings.append(turn_id)
+
+    def find_turns(self, term):
+        """
+        包含触发词的全部轮次
+
+        :param term: 触发词
+        :return: 轮次下标的集合
+        """
+        if not term:
+            return set()
+        if len(term) == 1:
+            return set(self.postings.get(term, ()))
+        grams = sorted((term[k:k + 2] for k in range(len(term) - 1)),
+                       key=lambda gram: len(self.postings.get(gram, ())))
+        candidates = set(self.postings.get(grams[0], ()))
+        for gram in grams[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(self.postings.get(gram, ()))
+        return {t for t in candidates if term in self.texts[t]}
+
+    def iter_pairs(self, triggers=DEFAULT_TRIGGERS, context=1):
+        """
+        按轮次顺序生成 (前文, 触发轮) 对话对
+
+        条目的第一轮没有前文，不会生成对话对。
+
+        :param triggers: 触发词列表
+        :param context: 前文包含的轮数
+        :return: 生成对话字典，orther为紧邻的上一轮，附两轮的说话人、间隔和时长；
+                 context大于1时另附context列表（从早到晚）
+        """
+        matched = {}
+        for term in triggers:
+            for t in self.find_turns(term):
+                matched.setdefault(t, term)
+
+        for t in sorted(matched):
+            conversion = self._pair(t, context)
+            if conversion is not None:
+                conversion["trigger"] = matched[t]
+                yield conversion
+
+    def iter_speaker_pairs(self, speakers, context=1):
+        """
+        按轮次顺序生成指定说话人的每一轮与其前一轮组成的对话对，不依赖触发词
+
+        :param speakers: 集数 -> {本集说话人: 全局说话人}，见speaker_cluster.speakers_by_episode
+        :param context: 前文包含的轮数
+        :return: 生成对话字典，格式同iter_pairs，以global_speaker代替trigger
+        """
+        for t, speaker in enumerate(self.speakers):
+            episode_speakers = speakers.get(self.positions[t][0])
+            if not episode_speakers or speaker not in episode_speakers:
+                continue
+            conversion = self._pair(t, context)
+            if conversion is not None:
+                conversion["global_speaker"] = episode_speakers[speaker]
+                yield conversion
+
+    def _pair(self, t, context):
+        """第t轮与前一轮组成的对话字典，条目的第一轮没有前文时返回None"""
+        item_start = self.item_starts[t]
+        if t == item_start:
+            return None
+        episode, item_index, turn_index = self.positions[t]
+        conversion = {
+            "orther": self.texts[t - 1],
+            "huang": self.texts[t],
+            "episode": episode,
+            "item": item_index,
+            "turn": turn_index,
+            "speakers": [self.speakers[t - 1], self.speakers[t]],
+            "gap_ms": self.start_ms[t] - self.end_ms[t - 1],
+            "duration_ms": [self.end_ms[t - 1] - self.start_ms[t - 1], self.end_ms[t] - self.start_ms[t]],
+        }
+        if context > 1:
+            conversion["context"] = self.texts[max(item_start, t - context):t]
+        return conversion
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path, sources=None):
+        """
+        :param sources: 集数 -> 来源标识，与索引中记录的不一致时返回None
+        :return: DialogueIndex，文件不存在或已过期时返回None
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        # 旧版本保存的索引没有来源标识和说话人信息，视为过期
+        if sources is not None and state.get("sources") != sources:
+            return None
+        index = cls()
+        index.__dict__.update(state)
+        return index
+
+
+def extract_conversions(merged_results, triggers=DEFAULT_TRIGGERS, context=1, episode=None):
+    """
+    从一集的合并结果中提取触发词所在轮与前一轮组成的对话
+
+    :param merged_results: merge_speaker.py处理后的结果列表
+    :param triggers: 触发词列表
+    :param context: 前文包含的轮数
+    :param episode: 集数编号，写入每条对话
+    :return: 对话列表，每项包含orther和huang
+    """
+    index = DialogueIndex()
+    index.add_episode(episode, merged_results)
+    return list(index.iter_pairs(triggers, context))
+
+
+def extract_conversions_from_store(store, triggers=DEFAULT_TRIGGERS, context=1, episode=None):
+    """
+    直接在列式句子存储（merge_speaker.merge_store的结果）上提取对话
+
+    :param store: 附带轮次划分的sentence_store.SentenceStore
+    :param triggers: 触发词列表
+    :param context: 前文包含的轮数
+    :param episode: 集数编号，写入每条对话
+    :return: 对话列表，每项包含orther和huang
+    """
+    index = DialogueIndex()
+    index.add_store(episode, store)
+    return list(index.iter_pairs(triggers, context))
+
+
+def parse_arguments():
+    """
+    解析命令行参数
+
+    :return: 解析后的参数
+    """
+    parser = argparse.ArgumentParser(description='从合并后的对话中提取皇上的对话')
+    parser.add_argument('--start', '-s', type=int, default=1,
+                        help='起始文件编号 (默认: 1)')
+    parser.add_argument('--end', '-e', type=int, default=46,
+                        help='结束文件编号 (默认: 46)')
+    parser.add_argument('--triggers', '-t', type=str, nargs='+', default=list(DEFAULT_TRIGGERS),
+                        help='触发词列表 (默认: 朕)')
+    parser.add_argument('--context', '-c', type=int, default=1,
+                        help='前文包含的轮数 (默认: 1)')
+    parser.add_argument('--index', type=str, default=None,
+                        help='索引缓存文件，集数范围和合并结果都没变时直接读取，否则重新建好后保存')
+    parser.add_argument('--store-dir', type=str, default=None,
+                        help='从该目录的列式句子存储(merged_asr_result{i}.sst)读取合并结果，不读取JSON')
+    parser.add_argument('--global-speaker', type=str, nargs='+', default=None,
+                        help='按speaker_cluster.py给出的全局说话人编号提取该角色的全部对话，不再按触发词匹配')
+    parser.add_argument('--speaker-map', type=str, default="data/speaker_map.json",
+                        help='speaker_cluster.py输出的说话人映射 (默认: data/speaker_map.json)')
+    parser.add_argument('--allow-text-speakers', action='store_true',
+                        help='允许 --global-speaker 指定文本向量聚出的簇（T开头），默认只接受声纹簇')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    speakers = None
+    if args.global_speaker:
+        from speaker_cluster import load_speaker_map, speakers_by_episode
+
+        try:
+            speakers = speakers_by_episode(load_speaker_map(args.speaker_map), args.global_speaker,
+                                           args.allow_text_speakers)
+        except ValueError as e:
+            sys.exit(f"{e}（--allow-text-speakers）")
+
+    if args.store_dir:
+        from sentence_store import load_results_as_store, store_path
+
+        paths = {i: store_path("merged", i, args.store_dir) for i in range(args.start, args.end + 1)}
+        sources = {}
+        for i, path in paths.items():
+            stat = os.stat(path)
+            sources[i] = f"sst:{stat.st_size}:{stat.st_mtime_ns}"
+    else:
+        sources = {i: source_signature("merged", i) for i in range(args.start, args.end + 1)}
+    index = DialogueIndex.load(args.index, sources) if args.index else None
+    if index is None:
+        if args.index and os.path.exists(args.index):
+            print(f"索引 {args.index} 的集数范围或合并结果已变化，重新建立")
+        index = DialogueIndex()
+        for i in range(args.start, args.end + 1):
+            if args.store_dir:
+                store = load_results_as_store(paths[i])
+                index.add_store(i, store, sources[i])
+                store.close()
+            else:
+                index.add_episode(i, load_episode("merged", i), sources[i])
+        if args.index:
+            index.save(args.index)
+
+    if speakers is not None:
+        pairs = index.iter_speaker_pairs(speakers, args.context)
+    else:
+        pairs = index.iter_pairs(args.triggers, args.context)
+    conversions = {i: [] for i in range(args.start, args.end + 1)}
+    for conversion in pairs:
+        if conversion["episode"] in conversions:
+            conversions[conversion["episode"]].append(conversion)
+
+    for i, datajson in conversions.items():
+        with open(f"data/conversion_result/conversion_result{i}.json", "w", encoding="utf-8") as f:
+            json.dump(datajson, f, ensure_ascii=False, indent=2)
+        print(f"第{i}集: {len(datajson)} 条对话")
@@ -0,0 +1,276 @@
+"""
+模型调用的后端：llm_caller.AsyncLLMCaller负责并发、重试和缓存，请求怎样送到模型由后端决定
+
+- http: OpenAI兼容的chat/completions服务（vLLM等），流式读取，拿到完整JSON后立即断开
+- llama_cpp: 在进程内用llama-cpp-python加载GGUF量化模型，在CPU上推理，不需要单独起服务
+- mock: 按prompts.py的模板直接返回格式正确的回答，供测试和基准使用
+
+后端都实现 open() / close() / complete(data, trace)，complete返回回答文本（截取到的JSON），
+可重试的错误抛出adaptive_limiter.RetryableStatus。
+"""
+import asyncio
+import atexit
+import json
+import os
+import queue
+import random
+import threading
+import time
+import logging
+
+from adaptive_limiter import RetryableStatus, parse_retry_after
+from prompts import VALIDATE_PAIR, VALIDATE_BATCH, ROLE_QA
+from response_parser import JsonScanner, read_sse_json
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("http", "llama_cpp", "mock")
+# 推理服务地址，可用环境变量QWEN_API_URL覆盖（如指向benchmarks/mock_llm.py）
+DEFAULT_API_URL = "http://localhost:8001/v1/chat/completions"
+
+
+class HttpBackend:
+    """OpenAI兼容的chat/completions服务"""
+
+    def __init__(self, url=None, api_key=None, timeout=600, connect_timeout=10):
+        """
+        :param url: 接口地址，默认取环境变量QWEN_API_URL，再默认DEFAULT_API_URL
+        :param api_key: Bearer令牌，默认取环境变量QWEN_API_KEY，都没有时不发送Authorization
+        :param timeout: 单次请求的总超时（秒）
+        :param connect_timeout: 建立连接的超时（秒）
+        """
+        self.url = url or os.environ.get("QWEN_API_URL", DEFAULT_API_URL)
+        self.headers = {"Content-Type": "application/json"}
+        api_key = api_key or os.environ.get("QWEN_API_KEY")
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.session = None
+
+    async def open(self):
+        import aiohttp
+
+        timeout = aiohttp.ClientTimeout(total=self.timeout, connect=self.connect_timeout)
+        self.session = aiohttp.ClientSession(timeout=timeout)
+
+    async def close(self):
+        await self.session.close()
+
+    async def complete(self, data, trace):
+        """
+        以流式请求模型，收到完整JSON后返回，连接随之关闭以结束生成
+
+        :param data: chat/completions请求体
+        :param trace: 写入first_token和tokens的字典
+        :return: 回答中的JSON文本
+        """
+        async with self.session.post(self.url, headers=self.headers, json=dict(data, stream=True)) as response:
+            if response.status == 429 or response.status >= 500:
+                raise RetryableStatus(response.status, parse_retry_after(response.headers.get("Retry-After")))
+            return await read_sse_json(response, trace)
+
+
+class LlamaCppBackend:
+    """
+    进程内的llama.cpp推理，多个槽位从同一个队列取请求
+
+    每个槽位是一个独立的llama_cpp.Llama上下文，运行在自己的线程中，有自己的KV缓存；
+    权重通过mmap加载，各槽位共享同一份内存。一个槽位生成完毕立即取下一条排队的请求，
+    不必等同批其他请求结束。同一模板的请求共享system前缀，llama.cpp会复用上一条请求
+    已计算过的最长公共前缀，每条请求只需对变化的尾部做prefill。
+    模型在第一次open()时加载，之后跨事件循环复用，shutdown()时释放（进程退出时自动调用）。
+    """
+
+    def __init__(self, model_path, slots=2, threads=None, n_ctx=4096, max_tokens=1024, chat_format=None):
+        """
+        :param model_path: GGUF模型文件路径
+        :param slots: 并行生成的槽位数
+        :param threads: 推理线程总数，按槽位平分，默认CPU核数
+        :param n_ctx: 每个槽位的上下文长度
+        :param max_tokens: 单条回答的token上限，请求体中的max_tokens更小时以请求为准
+        :param chat_format: llama-cpp-python的对话模板名，默认取模型元数据中的模板
+        """
+        self.model_path = model_path
+        self.slots = slots
+        self.threads = threads or os.cpu_count() or 1
+        self.n_ctx = n_ctx
+        self.max_tokens = max_tokens
+        self.chat_format = chat_format
+        self._queue = queue.Queue()
+        self._workers = []
+
+    async def open(self):
+        if self._workers:
+            return
+        try:
+            from llama_cpp import Llama
+        except ImportError:
+            raise ImportError("llama_cpp后端需要安装llama-cpp-python") from None
+
+        def load():
+            return Llama(model_path=self.model_path, n_ctx=self.n_ctx, chat_format=self.chat_format,
+                         n_threads=max(1, self.threads // self.slots), verbose=False)
+
+        loop = asyncio.get_running_loop()
+        models = await asyncio.gather(*(loop.run_in_executor(None, load) for _ in range(self.slots)))
+        for slot, llm in enumerate(models):
+            worker = threading.Thread(target=self._serve, args=(llm,), name=f"llama-slot-{slot}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        atexit.register(self.shutdown)
+        logger.info(f"已加载 {self.model_path}，{self.slots} 个槽位")
+
+    async def close(self):
+        # 模型跨会话复用，由shutdown()释放
+        pass
+
+    def shutdown(self):
+        """停止各槽位线程并释放模型"""
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        atexit.unregister(self.shutdown)
+
+    async def complete(self, data, trace):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put((data, trace, future))
+        return await future
+
+    def _serve(self, llm):
+        """槽位线程：逐条取请求生成，结果交回请求所在的事件循环"""
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            data, trace, future = job
+            if future.cancelled():
+                continue
+            try:
+                text, error = self._generate(llm, data, trace), None
+            except Exception as e:
+                text, error = None, e
+            try:
+                future.get_loop().call_soon_threadsafe(_resolve, future, text, error)
+            except RuntimeError:
+                # 请求方已超时或取消且其事件循环已关闭，丢弃结果，槽位继续服务后面的请求
+                logger.debug("请求所在的事件循环已关闭，丢弃生成结果")
+
+    def _generate(self, llm, data, trace):
+        """流式生成，得到完整JSON后停止"""
+        scanner = JsonScanner()
+        parts = []
+        stream = llm.create_chat_completion(
+            messages=data["messages"],
+            temperature=data.get("temperature", 0.7),
+            max_tokens=min(data.get("max_tokens") or self.max_tokens, self.max_tokens),
+            seed=data.get("seed"),
+            stream=True,
+        )
+        for chunk in stream:
+            delta = chunk["choices"][0]["delta"].get("content")
+            if not delta:
+                continue
+            if not parts:
+                trace["first_token"] = time.monotonic()
+            trace["tokens"] = trace.get("tokens", 0) + 1
+            parts.append(delta)
+            if scanner.feed(delta):
+                # 不再迭代生成器，剩余token不会被生成
+                return scanner.text
+        return "".join(parts)
+
+
+def _resolve(future, result, error):
+    if future.cancelled():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+def mock_answer(data):
+    """
+    按请求所用的模板生成格式正确的回答
+
+    :param data: chat/completions请求体
+    :return: 代码块包裹的JSON文本
+    """
+    system, user = data["messages"][0]["content"], data["messages"][-1]["content"]
+    if system == VALIDATE_BATCH.system:
+        pairs = json.loads(user.split("\n", 1)[1])
+        records = [{"index": p["index"], "result": "是", "input": p["orther"], "output": p["huang"]}
+                   for p in pairs]
+    elif system == VALIDATE_PAIR.system:
+        orther, huang = user.split("\nhuang说的：", 1)
+        records = {"result": "是", "input": orther.split("orther说的：", 1)[1], "output": huang}
+    elif system == ROLE_QA.system:
+        original = user.split("输入内容：「", 1)[1].split("」", 1)[0]
+        records = {"input": f"请问{original}", "output": "朕知道了。"}
+    else:
+        records = {"content": "ok"}
+    return "```json\n" + json.dumps(records, ensure_ascii=False) + "\n```"
+
+
+class MockBackend:
+    """不联网、不加载模型，按模板直接回答"""
+
+    def __init__(self, latency_ms=0.0, bad_rate=0.0, seed=0):
+        """
+        :param latency_ms: 每次回答前等待的时间（毫秒）
+        :param bad_rate: 返回不合格回答的比例
+        :param seed: 随机种子
+        """
+        self.latency_ms = latency_ms
+        self.bad_rate = bad_rate
+        self.rng = random.Random(seed)
+        self.requests = 0
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def complete(self, data, trace):
+        self.requests += 1
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+        trace["first_token"] = time.monotonic()
+        text = "好的，这确实是一段对话。" if self.rng.random() < self.bad_rate else mock_answer(data)
+        trace["tokens"] = len(text)
+        return text
+
+
+def add_backend_arguments(parser):
+    """给命令行解析器加上模型后端相关参数"""
+    parser.add_argument('--backend', type=str, default="http", choices=BACKENDS,
+                        help='模型后端：http为推理服务，llama_cpp为进程内推理，mock为测试用 (默认: http)')
+    parser.add_argument('--api-url', type=str, default=None,
+                        help=f'http后端的接口地址 (默认: 环境变量QWEN_API_URL或{DEFAULT_API_URL})')
+    parser.add_argument('--model-path', type=str, default=None,
+                        help='llama_cpp后端的GGUF模型文件')
+    parser.add_argument('--llm-slots', type=int, default=2,
+                        help='llama_cpp后端并行生成的槽位数 (默认: 2)')
+    parser.add_argument('--llm-threads', type=int, default=None,
+                        help='llama_cpp后端的推理线程总数 (默认: CPU核数)')
+    parser.add_argument('--llm-ctx', type=int, default=4096,
+                        help='llama_cpp后端每个槽位的上下文长度 (默认: 4096)')
+
+
+def backend_from_args(args):
+    """
+    按命令行参数构造后端
+
+    :return: 后端对象
+    """
+    if args.backend == "llama_cpp":
+        if not args.model_path:
+            raise ValueError("llama_cpp后端需要指定 --model-path")
+        return LlamaCppBackend(args.model_path, slots=args.llm_slots, threads=args.llm_threads, n_ctx=args.llm_ctx)
+    if args.backend == "mock":
+        return MockBackend()
+    return HttpBackend(args.api_url)
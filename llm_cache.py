@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "llm_cache.sqlite")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# 参与缓存键计算的请求字段，其他字段（如stream）不影响回答内容
+KEY_FIELDS = ("model", "messages", "temperature", "max_tokens")
+
+
+class ResponseCache:
+    """
+    以请求内容哈希为键的模型回答缓存（SQLite），按最近访问时间淘汰
+
+    同样的模型、消息、temperature和max_tokens只请求一次，之后直接返回缓存的回答。
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES, read=True, write=True):
+        """
+        :param path: 缓存数据库路径
+        :param max_bytes: 缓存内容的总字节数上限，超过后淘汰最久未访问的条目
+        :param read: 是否读取缓存，为False时总是请求模型（用于刷新缓存）
+        :param write: 是否写入缓存
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.read = read
+        self.write = write
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(payload):
+        """
+        计算请求的缓存键
+
+        :param payload: 发送给chat/completions接口的请求体
+        :return: sha256十六进制字符串
+        """
+        fields = {field: payload.get(field) for field in KEY_FIELDS}
+        # 指定了采样种子的请求按种子区分（同一条数据的不同变体），没有种子的请求键不变
+        if payload.get("seed") is not None:
+            fields["seed"] = payload["seed"]
+        material = json.dumps(fields, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        读取缓存的回答
+
+        :param key: make_key返回的缓存键
+        :return: 回答内容，未命中时返回None
+        """
+        if not self.read:
+            self.misses += 1
+            return None
+        row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        return row[0]
+
+    def put(self, key, response):
+        """
+        写入回答，必要时淘汰最久未访问的条目
+
+        :param key: make_key返回的缓存键
+        :param response: 回答内容
+        """
+        if not self.write or response is None:
+            return
+        size = len(response.encode("utf-8"))
+        old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+            (key, response, size, time.time())
+        )
+        self.total_bytes += size - (old[0] if old else 0)
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+        self.conn.commit()
+
+    def _evict(self):
+        """按最近访问时间从旧到新删除，直到总大小降到上限的90%"""
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute("SELECT key, size FROM responses ORDER BY last_access")
+        victims = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            victims.append((key,))
+            self.total_bytes -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+        self.evictions += len(victims)
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        logger.info(f"缓存统计 - 命中: {self.hits}, 未命中: {self.misses}, 命中率: {hit_rate:.1f}%, "
+                    f"淘汰: {self.evictions}, 占用: {self.total_bytes / 1024 / 1024:.1f} MB")
+
+    def close(self):
+        self.conn.close()
+
+
+def add_cache_arguments(parser):
+    """给命令行解析器加上缓存相关的参数"""
+    parser.add_argument('--cache-path', type=str, default=DEFAULT_CACHE_PATH,
+                        help='模型回答缓存的数据库路径')
+    parser.add_argument('--cache-max-mb', type=int, default=DEFAULT_MAX_BYTES // 1024 // 1024,
+                        help=f'缓存大小上限（MB） (默认: {DEFAULT_MAX_BYTES // 1024 // 1024})')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='不读也不写缓存')
+    parser.add_argument('--refresh-cache', action='store_true',
+                        help='不读缓存，但用新的回答覆盖缓存')
+
+
+def cache_from_args(args):
+    """根据add_cache_arguments添加的参数创建缓存，--no-cache时返回None"""
+    if args.no_cache:
+        return None
+    return ResponseCache(args.cache_path, args.cache_max_mb * 1024 * 1024, read=not args.refresh_cache)
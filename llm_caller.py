@@ -0,0 +1,210 @@
+"""
+模型调用的公共部分：并发控制、失败重试、回答校验、缓存读写和结果落盘
+
+qwenapi.py（对话校验）和data/create_data/api.py（角色扩充）的调用器都继承AsyncLLMCaller，
+只需要实现怎样构造请求、怎样处理一个任务。
+"""
+import asyncio
+import logging
+import time
+
+from tqdm import tqdm
+
+from adaptive_limiter import AdaptiveLimiter, RetryableStatus, OVERLOAD_STATUSES, backoff_delay
+from response_parser import ResponseParseError
+from metrics import LLMStats
+from llm_backends import HttpBackend
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncLLMCaller:
+    def __init__(self, max_concurrent=5, max_retries=3, cache=None, writer=None, initial_concurrent=None, adaptive=True,
+                 max_requery=1, stats=None, backend=None):
+        """
+        :param max_requery: 回答不符合格式时重新请求的次数，仍不合格则记入拒绝队列
+        :param stats: metrics.LLMStats，记录延迟、重试和缓存命中等指标，为None时新建一个
+        :param backend: llm_backends中的模型后端，为None时使用HttpBackend
+        :param max_concurrent: 在途请求数的上限
+        :param initial_concurrent: 自适应模式下的初始并发，默认取min(8, max_concurrent)
+        :param adaptive: 为False时并发固定为max_concurrent
+        """
+        self.max_concurrent = max_concurrent
+        if adaptive:
+            initial = initial_concurrent or min(8, max_concurrent)
+            self.limiter = AdaptiveLimiter(initial=initial, max_limit=max_concurrent)
+        else:
+            self.limiter = AdaptiveLimiter(initial=max_concurrent, min_limit=max_concurrent, max_limit=max_concurrent)
+        # 已提交但未完成的任务数上限，限制内存占用；实际发出的请求数由limiter控制
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self.max_retries = max_retries
+        self.max_requery = max_requery
+        self.cache = cache
+        self.stats = stats or LLMStats()
+        # 设置了writer时结果逐条落盘，不在内存中累积
+        self.writer = writer
+        self.backend = backend or HttpBackend()
+        self._running_tasks = set()
+        self.processed_count = 0
+        self.total_count = 0
+        # tqdm按total判断真假，total为0时也是假，判断有没有进度条要用is not None
+        self.progress_bar = None
+        self.datas = []
+        # 没有writer时，多次请求仍不合格的回答留在这里
+        self.rejects = []
+
+    async def __aenter__(self):
+        await self.backend.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.backend.close()
+        logger.info(f"结束时的并发上限: {self.limiter.current_limit}")
+        if self.cache:
+            self.cache.log_stats()
+
+    async def _post_chat(self, data: dict, template, label, check=None):
+        """
+        先查缓存，未命中时请求模型，并按模板校验回答；只有合格的回答才写入缓存
+
+        :param template: 请求所用的prompts.PromptTemplate
+        :param check: 对解析结果的额外校验，返回最终结果，不合格时抛出ResponseParseError，为None时不校验
+        :return: 解析（和check）后的结果，网络错误重试用尽时返回None
+        :raises ResponseParseError: 回答不符合模板要求的格式
+        """
+        cache_key = None
+        if self.cache:
+            cache_key = self.cache.make_key(data)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                try:
+                    result = template.parse(cached)
+                    if check:
+                        result = check(result)
+                    self.stats.cache_hits += 1
+                    return result
+                except ResponseParseError:
+                    logger.debug(f"缓存中 '{label}' 的回答不合格，重新请求")
+            self.stats.cache_misses += 1
+
+        response_data = await self._request(data, label)
+        if response_data is None:
+            return None
+        result = template.parse(response_data)
+        if check:
+            result = check(result)
+        if self.cache:
+            self.cache.put(cache_key, response_data)
+        return result
+
+    async def _request(self, data: dict, label, retry_count=0):
+        """
+        通过后端请求模型，收到完整JSON后即结束生成；失败时按退避策略重试
+
+        :return: 回答中的JSON文本，重试用尽返回None
+        """
+        try:
+            async with self.limiter:
+                start = time.monotonic()
+                trace = {}
+                self.stats.request_started()
+                try:
+                    response_data = await self.backend.complete(data, trace)
+                finally:
+                    self.stats.request_finished()
+                latency = time.monotonic() - start
+                self.limiter.record_success(latency)
+                first_token = trace["first_token"] - start if "first_token" in trace else None
+                self.stats.observe(latency, first_token, trace.get("tokens", 0))
+
+            logger.debug(f"回答: {response_data}")
+            return response_data
+
+        except Exception as e:
+            retry_after = None
+            if isinstance(e, RetryableStatus):
+                retry_after = e.retry_after
+                if e.status in OVERLOAD_STATUSES:
+                    self.limiter.record_overload(str(e))
+            elif isinstance(e, asyncio.TimeoutError):
+                self.limiter.record_overload("请求超时")
+            if retry_count < self.max_retries:
+                wait_time = backoff_delay(retry_count, retry_after)  # 带抖动的指数退避
+                logger.warning(f"请求失败，{wait_time:.1f}秒后重试... (错误: {str(e)})")
+                self.stats.retries += 1
+                await asyncio.sleep(wait_time)
+                return await self._request(data, label, retry_count + 1)
+            logger.error(f"处理问题 '{label}' 时发生错误: {str(e)}")
+            self.stats.failures += 1
+            return None
+
+    async def _call_with_requery(self, call, task_id):
+        """
+        回答不合格时重新请求，最多请求max_requery + 1次
+
+        :param call: 以已请求次数为参数的协程函数，回答不合格时抛出ResponseParseError
+        :param task_id: 任务序号，用于日志
+        :return: call的结果
+        :raises ResponseParseError: 每次的回答都不合格，抛出最后一次的错误
+        """
+        for attempt in range(self.max_requery + 1):
+            if attempt:
+                self.stats.requeries += 1
+            try:
+                return await call(attempt)
+            except ResponseParseError as e:
+                logger.warning(f"任务 {task_id} 的回答不合格（{e}），已请求 {attempt + 1} 次")
+                error = e
+        self.stats.rejects += 1
+        raise error
+
+    def _save_result(self, tid, result, writer=None):
+        """结果写入writer（默认self.writer），没有writer时留在self.datas"""
+        writer = writer or self.writer
+        if writer:
+            writer.write(tid, result)
+        else:
+            self.datas.append(result)
+
+    def _save_reject(self, item, error: ResponseParseError, writer=None):
+        """把多次请求仍不合格的任务记入拒绝队列，它不会进入断点清单，--resume时会重新请求"""
+        writer = writer or self.writer
+        if writer:
+            writer.reject(item, error.raw, str(error))
+        else:
+            self.rejects.append({"item": item, "raw": error.raw, "reason": str(error)})
+
+    def _advance(self):
+        if self.progress_bar is not None:
+            self.progress_bar.update(1)
+            self.processed_count += 1
+
+    async def _submit(self, coro):
+        """
+        并发已满时等待空位后再把协程作为任务提交
+
+        :return: 已提交的任务
+        """
+        await self._slots.acquire()
+        task = asyncio.create_task(coro)
+        self._running_tasks.add(task)
+        task.add_done_callback(self._running_tasks.discard)
+        task.add_done_callback(lambda _: self._slots.release())
+        return task
+
+    def set_progress_bar(self, total):
+        """设置进度条"""
+        self.total_count = total
+        self.progress_bar = tqdm(total=total, desc="处理问题", unit="个")
+
+    def add_progress_total(self, count):
+        """增加进度条总数，用于边读取边提交的场景"""
+        self.total_count += count
+        if self.progress_bar is not None:
+            self.progress_bar.total = self.total_count
+            self.progress_bar.refresh()
+
+    def close_progress(self):
+        """关闭进度条"""
+        if self.progress_bar is not None:
+            self.progress_bar.close()
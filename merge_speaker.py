@@ -1,66 +1,142 @@
 import json
+import argparse
+from array import array
 
-def merge_consecutive_speakers(input_file, output_file):
+import numpy as np
+
+from corpus import load_episode
+
+# 相邻两句间隔超过该值（毫秒）时视为新的对话
+DEFAULT_GAP_MS = 2000
+
+def turn_boundaries(speakers, start_ms, end_ms, gap_ms=DEFAULT_GAP_MS):
     """
-    合并连续的相同说话人的句子
+    一次性计算每轮对话的起始句下标
     
-    :param input_file: 输入的JSON文件路径（absdata.py处理后的结果）
-    :param output_file: 输出的JSON文件路径
+    :param speakers: 每句的说话人（可比较的数组，如编号或名称）
+    :param start_ms: 每句的开始时间
+    :param end_ms: 每句的结束时间
+    :param gap_ms: 间隔阈值，超过则开始新的一轮
+    :return: 各轮起始句下标组成的numpy数组
     """
-    # 读取原始数据
-    with open(input_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    speakers = np.asarray(speakers)
+    start_ms = np.asarray(start_ms, dtype=np.int64)
+    end_ms = np.asarray(end_ms, dtype=np.int64)
+    if len(speakers) == 0:
+        return np.zeros(0, dtype=np.int64)
+    
+    is_new = np.empty(len(speakers), dtype=bool)
+    is_new[0] = True
+    # 说话人变了，或者与上一句的间隔超过阈值，都视为新的对话
+    is_new[1:] = (speakers[1:] != speakers[:-1]) | (start_ms[1:] - end_ms[:-1] > gap_ms)
+    return np.flatnonzero(is_new)
+
+def merge_item_sentences(sentences, gap_ms=DEFAULT_GAP_MS):
+    """
+    合并单个条目中连续的相同说话人的句子
+    
+    :param sentences: absdata.py解析出的句子列表
+    :param gap_ms: 间隔阈值（毫秒），超过则视为新的对话
+    :return: 合并后的句子列表
+    """
+    if not sentences:
+        return []
     
+    speaker_ids = {}
+    speakers = [speaker_ids.setdefault(sentence['speaker'], len(speaker_ids)) for sentence in sentences]
+    starts = [sentence['start_ms'] for sentence in sentences]
+    ends = [sentence['end_ms'] for sentence in sentences]
+    texts = [sentence['text'] for sentence in sentences]
+    
+    bounds = turn_boundaries(speakers, starts, ends, gap_ms).tolist()
+    bounds.append(len(sentences))
+    
+    merged_sentences = []
+    for first, stop in zip(bounds, bounds[1:]):
+        merged_sentences.append({
+            'speaker': sentences[first]['speaker'],
+            # 每轮只拼接一次文本
+            'text': ' '.join(texts[first:stop]),
+            'start_ms': starts[first],
+            'end_ms': ends[stop - 1],
+            'segments': [
+                {'text': texts[i], 'start_ms': starts[i], 'end_ms': ends[i]}
+                for i in range(first, stop)
+            ]
+        })
+    
+    return merged_sentences
+
+def merge_parsed_results(data, gap_ms=DEFAULT_GAP_MS):
+    """
+    合并解析结果中每个条目的连续说话人句子
+    
+    :param data: absdata.py处理后的结果列表
+    :param gap_ms: 间隔阈值（毫秒），超过则视为新的对话
+    :return: 合并后的结果列表
+    """
     merged_results = []
     
     for item in data:
-        sentences = item.get('sentences', [])
-        merged_sentences = []
-        current_group = None
-        
-        for sentence in sentences:
-            # 如果是第一句话或者说话人变了，创建新组
-            if (current_group is None or 
-                current_group['speaker'] != sentence['speaker'] or
-                # 如果时间间隔超过2秒（2000ms），也视为新的对话
-                sentence['start_ms'] - current_group['end_ms'] > 2000):
-                
-                if current_group is not None:
-                    merged_sentences.append(current_group)
-                
-                current_group = {
-                    'speaker': sentence['speaker'],
-                    'text': sentence['text'],
-                    'start_ms': sentence['start_ms'],
-                    'end_ms': sentence['end_ms'],
-                    'segments': [{
-                        'text': sentence['text'],
-                        'start_ms': sentence['start_ms'],
-                        'end_ms': sentence['end_ms']
-                    }]
-                }
-            else:
-                # 合并连续的对话
-                current_group['text'] += ' ' + sentence['text']
-                current_group['end_ms'] = sentence['end_ms']
-                current_group['segments'].append({
-                    'text': sentence['text'],
-                    'start_ms': sentence['start_ms'],
-                    'end_ms': sentence['end_ms']
-                })
-        
-        # 添加最后一组
-        if current_group is not None:
-            merged_sentences.append(current_group)
-        
         # 创建新的结果项
         merged_item = {
             'key': item.get('key', ''),
             'text': item.get('text', ''),
-            'merged_sentences': merged_sentences
+            'merged_sentences': merge_item_sentences(item.get('sentences', []), gap_ms)
         }
         merged_results.append(merged_item)
     
+    return merged_results
+
+def merge_store(store, gap_ms=DEFAULT_GAP_MS):
+    """
+    在列式句子存储上直接划分对话轮次，不生成逐句字典
+    
+    :param store: sentence_store.SentenceStore（absdata.py结果）
+    :param gap_ms: 间隔阈值（毫秒），超过则视为新的对话
+    :return: 附带轮次划分的SentenceStore，句子列与输入共享
+    """
+    item_offsets = np.asarray(store.item_offsets, dtype=np.int64)
+    bounds = turn_boundaries(store.speaker, store.start_ms, store.end_ms, gap_ms)
+    # 条目之间一定断开
+    bounds = np.union1d(bounds, item_offsets[:-1][np.diff(item_offsets) > 0])
+    
+    turn_offsets = array('I', bounds.tolist())
+    turn_offsets.append(len(store))
+    item_turn_offsets = array('I', np.searchsorted(bounds, item_offsets).tolist())
+    return store.with_turns(turn_offsets, item_turn_offsets)
+
+def count_turns(store, gaps):
+    """
+    统计不同间隔阈值下的对话轮数，用于调参时快速扫描
+    
+    :param store: sentence_store.SentenceStore
+    :param gaps: 间隔阈值列表（毫秒）
+    :return: {阈值: 轮数}
+    """
+    speakers = np.asarray(store.speaker)
+    start_ms = np.asarray(store.start_ms, dtype=np.int64)
+    end_ms = np.asarray(store.end_ms, dtype=np.int64)
+    if len(speakers) == 0:
+        return {gap: 0 for gap in gaps}
+    
+    item_offsets = np.asarray(store.item_offsets, dtype=np.int64)
+    forced = np.zeros(len(speakers), dtype=bool)
+    forced[item_offsets[:-1][np.diff(item_offsets) > 0]] = True
+    forced[1:] |= speakers[1:] != speakers[:-1]
+    forced[0] = True
+    # 说话人未变的相邻句，只有间隔超过阈值时才断开
+    gaps_between = np.sort((start_ms[1:] - end_ms[:-1])[~forced[1:]])
+    base = int(forced.sum())
+    return {gap: base + len(gaps_between) - int(np.searchsorted(gaps_between, gap, side='right')) for gap in gaps}
+
+def save_merged_results(merged_results, output_file):
+    """
+    保存合并后的结果，同时生成一个易读的文本版本
+    
+    :param merged_results: merge_parsed_results返回的结果
+    :param output_file: 输出的JSON文件路径
+    """
     # 保存合并后的结果
     with open(output_file, 'w', encoding='utf-8') as f:
         json.dump(merged_results, f, ensure_ascii=False, indent=2)
@@ -81,9 +157,68 @@ def merge_consecutive_speakers(input_file, output_file):
                 f.write("\n")
             f.write("-" * 80 + "\n")
 
+def merge_consecutive_speakers(input_file, output_file, gap_ms=DEFAULT_GAP_MS):
+    """
+    合并连续的相同说话人的句子
+    
+    :param input_file: 输入的JSON文件路径（absdata.py处理后的结果）
+    :param output_file: 输出的JSON文件路径
+    :param gap_ms: 间隔阈值（毫秒），超过则视为新的对话
+    """
+    # 读取原始数据
+    with open(input_file, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    
+    merged_results = merge_parsed_results(data, gap_ms)
+    save_merged_results(merged_results, output_file)
+
+def parse_arguments():
+    """
+    解析命令行参数
+    
+    :return: 解析后的参数
+    """
+    parser = argparse.ArgumentParser(description='合并连续的相同说话人的句子')
+    parser.add_argument('--start', '-s', type=int, default=1,
+                        help='起始文件编号 (默认: 1)')
+    parser.add_argument('--end', '-e', type=int, default=46,
+                        help='结束文件编号 (默认: 46)')
+    parser.add_argument('--gap-ms', '-g', type=int, default=DEFAULT_GAP_MS,
+                        help=f'间隔超过该值（毫秒）视为新的对话 (默认: {DEFAULT_GAP_MS})')
+    parser.add_argument('--store-dir', type=str, default=None,
+                        help='从该目录读取列式句子存储(parsed_asr_result{i}.sst)，合并结果写为同目录的merged_asr_result{i}.sst')
+    parser.add_argument('--sweep', type=int, nargs='+', default=None,
+                        help='只统计给定的各个间隔阈值下的总轮数，不写出结果')
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    for i in range(1, 47):
-        input_file = f"data/parsed_results/parsed_asr_result{i}.json"
-        output_file = f"data/merge_results/merged_asr_result{i}.json"
-        merge_consecutive_speakers(input_file, output_file)
-        print(f"处理完成！\n结果已保存到: {output_file}\n文本版本保存到: {output_file.rsplit('.', 1)[0] + '.txt'}") 
\ No newline at end of file
+    args = parse_arguments()
+    
+    if args.store_dir:
+        from sentence_store import load_results_as_store, store_path
+    
+    if args.sweep:
+        from sentence_store import SentenceStore
+        totals = dict.fromkeys(args.sweep, 0)
+        for i in range(args.start, args.end + 1):
+            if args.store_dir:
+                store = load_results_as_store(store_path("parsed", i, args.store_dir))
+            else:
+                store = SentenceStore.from_parsed_results(load_episode("parsed", i))
+            for gap, count in count_turns(store, args.sweep).items():
+                totals[gap] += count
+            store.close()
+        for gap, count in totals.items():
+            print(f"gap={gap}ms: {count} 轮")
+    elif args.store_dir:
+        for i in range(args.start, args.end + 1):
+            store = load_results_as_store(store_path("parsed", i, args.store_dir))
+            output_file = store_path("merged", i, args.store_dir)
+            merge_store(store, args.gap_ms).save(output_file)
+            store.close()
+            print(f"处理完成！\n结果已保存到: {output_file}")
+    else:
+        for i in range(args.start, args.end + 1):
+            output_file = f"data/merge_results/merged_asr_result{i}.json"
+            save_merged_results(merge_parsed_results(load_episode("parsed", i), args.gap_ms), output_file)
+            print(f"处理完成！\n结果已保存到: {output_file}\n文本版本保存到: {output_file.rsplit('.', 1)[0] + '.txt'}")
@@ -0,0 +1,464 @@
+"""
+流水线的运行指标：每个阶段（及每集）的记录数、耗时、CPU时间、内存峰值和读写字节数，
+以及模型调用的延迟分布、生成速度、重试和缓存命中，可导出为JSON或Prometheus文本格式
+
+    metrics = PipelineMetrics()
+    with metrics.stage("merge", episode):
+        ...
+    stream = metrics.track("parse", stream)          # 按集统计生成器的每一步
+    caller = AsyncQwenCaller(stats=metrics.llm("validate"))
+    metrics.write("logs/metrics.prom")               # .prom 为Prometheus文本，其余为JSON
+
+性能分析：--profile merge 会把该阶段的cProfile结果写到 <profile-dir>/merge.prof，
+可用 snakeviz 或 python -m pstats 查看。阶段运行时主线程改名为 stage:<阶段名>，
+py-spy dump 的输出里能直接看到当前在哪个阶段；JSON中记录了各阶段的起止时间，
+便于和 py-spy record 或推理服务的日志对齐。
+"""
+import bisect
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# 请求延迟的分桶上界（秒），覆盖缓存命中到长生成
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+DEFAULT_PROFILE_DIR = "./logs/profile"
+# ru_maxrss 在Linux上以KB为单位，macOS上以字节为单位
+_RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def _io_counters():
+    """本进程累计读写的字节数（/proc/self/io 的 rchar/wchar，含套接字），不支持的平台返回 (0, 0)"""
+    try:
+        with open("/proc/self/io", "r") as f:
+            fields = dict(line.split(":") for line in f)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _cpu_time():
+    """本进程及已回收子进程（如解析阶段的进程池）的CPU时间之和"""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def _peak_rss():
+    """本进程的内存峰值（字节）"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_UNIT
+
+
+class Histogram:
+    """固定分桶的直方图，与Prometheus的histogram一致（le为上界）"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        按分桶线性插值估计分位数
+
+        :param q: 0~1之间的分位
+        :return: 估计值，没有样本时返回None；落在最后一个桶时返回最大的上界
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for k, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if k == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[k - 1] if k else 0.0
+                return lower + (self.buckets[k] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def _rounded(self, q):
+        value = self.quantile(q)
+        return None if value is None else round(value, 4)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "p50": self._rounded(0.5),
+            "p90": self._rounded(0.9),
+            "p99": self._rounded(0.99),
+            "buckets": {str(le): count for le, count in zip(self.buckets + ("+Inf",), self.counts)},
+        }
+
+
+class StageStats:
+    """一个阶段（或一个阶段中的一集）的累计指标"""
+
+    FIELDS = ("records_in", "records_out", "wall_s", "cpu_s", "read_bytes", "write_bytes")
+
+    def __init__(self):
+        self.records_in = 0
+        self.records_out = 0
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.rss_peak_bytes = 0
+        self.calls = 0
+        self.started = None
+        self.ended = None
+
+    def merge(self, other):
+        for field in self.FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+        self.rss_peak_bytes = max(self.rss_peak_bytes, other.rss_peak_bytes)
+        self.calls += other.calls
+        self.started = min(filter(None, (self.started, other.started)), default=None)
+        self.ended = max(filter(None, (self.ended, other.ended)), default=None)
+
+    def to_dict(self):
+        data = {field: getattr(self, field) for field in self.FIELDS}
+        data["wall_s"] = round(self.wall_s, 6)
+        data["cpu_s"] = round(self.cpu_s, 6)
+        data["rss_peak_bytes"] = self.rss_peak_bytes
+        data["calls"] = self.calls
+        data["records_per_s"] = round(self.records_out / self.wall_s, 2) if self.wall_s else None
+        data["started"] = datetime.fromtimestamp(self.started).isoformat() if self.started else None
+        data["ended"] = datetime.fromtimestamp(self.ended).isoformat() if self.ended else None
+        return data
+
+
+class LLMStats:
+    """
+    模型调用的指标，由AsyncQwenCaller在请求过程中更新
+
+    生成的token数取流式回答的分块数（推理服务一般每块一个token），
+    服务端在非流式回答中给出usage时以usage为准。
+    """
+
+    COUNTERS = ("requests", "retries", "failures", "cache_hits", "cache_misses",
+                "requeries", "rejects", "batch_splits", "completion_tokens", "prefiltered")
+
+    def __init__(self):
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+        self.latency = Histogram()
+        self.first_token = Histogram()
+        self._active_since = None
+        self._in_flight = 0
+        # 至少有一个请求在途的总时长，用于计算整体生成速度
+        self.busy_s = 0.0
+
+    def request_started(self):
+        if self._in_flight == 0:
+            self._active_since = time.monotonic()
+        self._in_flight += 1
+
+    def request_finished(self):
+        self._in_flight -= 1
+        if self._in_flight == 0 and self._active_since is not None:
+            self.busy_s += time.monotonic() - self._active_since
+
+    def observe(self, latency, first_token=None, tokens=0):
+        """
+        记录一次成功的请求
+
+        :param latency: 从发出请求到读完回答的秒数
+        :param first_token: 收到第一块回答的秒数
+        :param tokens: 生成的token数
+        """
+        self.requests += 1
+        self.latency.observe(latency)
+        if first_token is not None:
+            self.first_token.observe(first_token)
+        self.completion_tokens += tokens
+
+    def to_dict(self):
+        data = {counter: getattr(self, counter) for counter in self.COUNTERS}
+        lookups = self.cache_hits + self.cache_misses
+        data["cache_hit_rate"] = round(self.cache_hits / lookups, 4) if lookups else None
+        # 单个请求的生成速度，以及所有请求合起来的吞吐
+        data["tokens_per_s_per_request"] = (round(self.completion_tokens / self.latency.sum, 2)
+                                            if self.latency.sum else None)
+        data["tokens_per_s"] = round(self.completion_tokens / self.busy_s, 2) if self.busy_s else None
+        data["busy_s"] = round(self.busy_s, 3)
+        data["latency_s"] = self.latency.to_dict()
+        data["first_token_s"] = self.first_token.to_dict()
+        return data
+
+
+class PipelineMetrics:
+    """
+    收集各阶段和模型调用的指标
+
+    阶段可以嵌套（如生成器串联时下游拉取上游），时间、CPU和读写字节只计入最内层的阶段，
+    各阶段的数值相加等于总量。同一阶段按集分别记录，汇总时相加。
+    阶段计时只适合在主线程中顺序使用；并发的模型请求用 llm() 返回的LLMStats记录。
+    """
+
+    def __init__(self, profile_stages=(), profile_dir=DEFAULT_PROFILE_DIR):
+        """
+        :param profile_stages: 需要用cProfile分析的阶段名，"all"表示全部阶段
+        :param profile_dir: cProfile结果的输出目录
+        """
+        self.stages = {}
+        self.llm_stats = {}
+        self.profile_stages = set(profile_stages)
+        self.profile_dir = profile_dir
+        self._profilers = {}
+        self._stack = []
+        self._created = time.time()
+
+    def _stats(self, name, key):
+        return self.stages.setdefault(name, {}).setdefault(key, StageStats())
+
+    def count(self, name, key=None, records_in=0, records_out=0):
+        """只累加记录数，用于耗时已在阶段级统计、但需要按集记录数量的场合"""
+        stats = self._stats(name, key)
+        stats.records_in += records_in
+        stats.records_out += records_out
+
+    def llm(self, name):
+        """取得（或创建）名为name的模型调用指标"""
+        return self.llm_stats.setdefault(name, LLMStats())
+
+    def _profiler(self, name):
+        if "all" not in self.profile_stages and name not in self.profile_stages:
+            return None
+        if name not in self._profilers:
+            self._profilers[name] = cProfile.Profile()
+        return self._profilers[name]
+
+    @staticmethod
+    def _snapshot():
+        return (time.perf_counter(), _cpu_time()) + _io_counters()
+
+    def _charge(self, frame, now):
+        """把frame从上次快照到now之间的消耗计入其统计"""
+        stats, since = frame[0], frame[1]
+        stats.wall_s += now[0] - since[0]
+        stats.cpu_s += now[1] - since[1]
+        stats.read_bytes += now[2] - since[2]
+        stats.write_bytes += now[3] - since[3]
+
+    def stage(self, name, key=None):
+        """
+        统计一段代码，嵌套时外层阶段暂停计时
+
+        :param name: 阶段名
+        :param key: 集数等细分键，None表示整个阶段
+        :return: 上下文管理器，产出该阶段的StageStats，可在其中累加records_in / records_out
+        """
+        return self._measure(name, self._stats(name, key))
+
+    @contextmanager
+    def _measure(self, name, stats):
+        now = self._snapshot()
+        thread = threading.current_thread()
+        if self._stack:
+            parent = self._stack[-1]
+            self._charge(parent, now)
+            if parent[2] is not None:
+                parent[2].disable()
+        profiler = self._profiler(name)
+        frame = [stats, now, profiler, thread.name]
+        self._stack.append(frame)
+        stats.calls += 1
+        stats.started = stats.started or time.time()
+        thread.name = f"stage:{name}"
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield stats
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            self._stack.pop()
+            thread.name = frame[3]
+            now = self._snapshot()
+            self._charge(frame, now)
+            stats.ended = time.time()
+            stats.rss_peak_bytes = max(stats.rss_peak_bytes, _peak_rss())
+            if self._stack:
+                parent = self._stack[-1]
+                parent[1] = now
+                if parent[2] is not None:
+                    parent[2].enable()
+
+    def track(self, name, stream, source=None):
+        """
+        按集统计一个生成 (集数, 记录列表) 的阶段，每次取下一项的消耗计入产出的那一集
+
+        :param name: 阶段名
+        :param stream: 阶段的生成器
+        :param source: 上游阶段名，该集在上游的产出记为本阶段的输入记录数
+        :return: 原样产出stream内容的生成器
+        """
+        stream = iter(stream)
+        while True:
+            # 取到之前还不知道这一项属于哪一集，先记在临时统计里
+            step = StageStats()
+            with self._measure(name, step):
+                try:
+                    item = next(stream)
+                except StopIteration:
+                    self._stats(name, None).merge(step)
+                    return
+            key = item[0]
+            episode = self._stats(name, key)
+            episode.merge(step)
+            if isinstance(item[1], list):
+                episode.records_out += len(item[1])
+            if source is not None and key in self.stages.get(source, {}):
+                episode.records_in += self.stages[source][key].records_out
+            yield item
+
+    def summary(self, name):
+        """阶段各集相加后的总计"""
+        total = StageStats()
+        for stats in self.stages.get(name, {}).values():
+            total.merge(stats)
+        return total
+
+    def to_dict(self):
+        stages = {}
+        for name, keys in self.stages.items():
+            stages[name] = self.summary(name).to_dict()
+            episodes = {str(key): stats.to_dict() for key, stats in keys.items() if key is not None}
+            if episodes:
+                stages[name]["episodes"] = episodes
+        return {
+            "generated_at": datetime.now().isoformat(),
+            "started": datetime.fromtimestamp(self._created).isoformat(),
+            "wall_s": round(time.time() - self._created, 3),
+            "cpu_s": round(_cpu_time(), 3),
+            "rss_peak_bytes": _peak_rss(),
+            "stages": stages,
+            "llm": {name: stats.to_dict() for name, stats in self.llm_stats.items()},
+        }
+
+    def to_prometheus(self):
+        """Prometheus文本格式（可由node_exporter的textfile收集器读取）"""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}")
+
+        stage_fields = [
+            ("records_in", "records_in_total", "counter", "读入的记录数"),
+            ("records_out", "records_out_total", "counter", "产出的记录数"),
+            ("wall_s", "wall_seconds_total", "counter", "耗时（秒）"),
+            ("cpu_s", "cpu_seconds_total", "counter", "CPU时间（秒）"),
+            ("read_bytes", "read_bytes_total", "counter", "读取的字节数"),
+            ("write_bytes", "write_bytes_total", "counter", "写出的字节数"),
+            ("rss_peak_bytes", "rss_peak_bytes", "gauge", "结束时的进程内存峰值"),
+        ]
+        # 阶段总计和各集分开导出：总计还包含不属于任何一集的开销，与各集之和不相等，
+        # 放在同一个指标里按标签求和会重复计算
+        for field, suffix, kind, help_text in stage_fields:
+            metric(f"pipeline_stage_{suffix}", kind, f"阶段{help_text}",
+                   [({"stage": stage}, getattr(self.summary(stage), field)) for stage in self.stages])
+            samples = [({"stage": stage, "episode": key}, getattr(stats, field))
+                       for stage, keys in self.stages.items() for key, stats in keys.items() if key is not None]
+            if samples:
+                metric(f"pipeline_episode_{suffix}", kind, f"每集{help_text}", samples)
+
+        for counter in LLMStats.COUNTERS:
+            metric(f"llm_{counter}_total", "counter", f"模型调用 {counter}",
+                   [({"client": client}, getattr(stats, counter)) for client, stats in self.llm_stats.items()])
+        for attr, name, help_text in (("latency", "llm_request_duration_seconds", "请求延迟（秒）"),
+                                      ("first_token", "llm_first_token_seconds", "首个token延迟（秒）")):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for client, stats in self.llm_stats.items():
+                histogram = getattr(stats, attr)
+                cumulative = 0
+                for le, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{client="{client}",le="{le}"}} {cumulative}')
+                lines.append(f'{name}_sum{{client="{client}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{client="{client}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        写出指标，并写出各阶段的cProfile结果
+
+        :param path: 以.prom结尾时写Prometheus文本格式，否则写JSON
+        """
+        output_dir = os.path.dirname(path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            if path.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        logger.info(f"运行指标已写入 {path}")
+        self.dump_profiles()
+
+    def dump_profiles(self):
+        if not self._profilers:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        for name, profiler in self._profilers.items():
+            profile_file = os.path.join(self.profile_dir, f"{name}.prof")
+            profiler.dump_stats(profile_file)
+            logger.info(f"{name} 阶段的cProfile结果已写入 {profile_file}")
+
+    def log_summary(self):
+        for name in self.stages:
+            stats = self.summary(name)
+            logger.info(f"[{name}] 输入 {stats.records_in} 条, 输出 {stats.records_out} 条, "
+                        f"耗时 {stats.wall_s:.2f}s, CPU {stats.cpu_s:.2f}s, "
+                        f"读 {stats.read_bytes / 1024 / 1024:.1f} MB, 写 {stats.write_bytes / 1024 / 1024:.1f} MB, "
+                        f"内存峰值 {stats.rss_peak_bytes / 1024 / 1024:.0f} MB")
+        for name, stats in self.llm_stats.items():
+            data = stats.to_dict()
+            latency = data["latency_s"]
+            logger.info(f"[{name}] 请求 {stats.requests} 次, 重试 {stats.retries}, 失败 {stats.failures}, "
+                        f"缓存命中 {stats.cache_hits}/{stats.cache_hits + stats.cache_misses}, "
+                        f"延迟 p50/p90/p99 {latency['p50']}/{latency['p90']}/{latency['p99']}s, "
+                        f"生成 {data['tokens_per_s']} token/s")
+
+
+def add_metrics_arguments(parser):
+    """给命令行解析器加上指标和性能分析相关的参数"""
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='运行指标的输出文件，.prom结尾时为Prometheus文本格式，否则为JSON')
+    parser.add_argument('--profile', type=str, nargs='+', default=[],
+                        help='用cProfile分析的阶段名，all表示全部阶段')
+    parser.add_argument('--profile-dir', type=str, default=DEFAULT_PROFILE_DIR,
+                        help=f'cProfile结果的输出目录 (默认: {DEFAULT_PROFILE_DIR})')
+
+
+def metrics_from_args(args):
+    """根据add_metrics_arguments添加的参数创建PipelineMetrics"""
+    return PipelineMetrics(args.profile, args.profile_dir)
+
+
+def finish_metrics(metrics, args):
+    """输出指标汇总，指定了--metrics时写入文件"""
+    metrics.log_summary()
+    if args.metrics:
+        metrics.write(args.metrics)
+    else:
+        metrics.dump_profiles()
@@ -0,0 +1,329 @@
+import json
+import os
+import argparse
+import asyncio
+import logging
+from collections import deque
+
+from absdata import parse_asr_data, save_parsed_results
+from merge_speaker import DEFAULT_GAP_MS, merge_parsed_results, save_merged_results
+from find_huang import DEFAULT_TRIGGERS, extract_conversions
+from reshape import (OUTPUT_FORMATS, DEFAULT_FORMAT, DEFAULT_SHARD_SIZE, to_sft_records, assemble_shards,
+                     write_json_array)
+from llm_cache import add_cache_arguments, cache_from_args
+from dedup import DEFAULT_THRESHOLD, Deduplicator
+from metrics import add_metrics_arguments, metrics_from_args, finish_metrics
+from asr_ingest import add_ingest_arguments, ingest_from_args
+from llm_backends import add_backend_arguments, backend_from_args
+from prefilter import add_prefilter_arguments, prefilter_from_args
+
+logger = logging.getLogger(__name__)
+
+STAGES = ["parse", "merge", "extract", "validate", "assemble"]
+
+
+def iter_asr_files(input_prefix, start, end):
+    """
+    按编号读取ASR原始结果
+
+    :param input_prefix: 输入的JSON文件前缀
+    :param start: 起始文件编号
+    :param end: 结束文件编号（包含）
+    :return: 生成 (编号, 原始数据)
+    """
+    for i in range(start, end + 1):
+        input_file = f"{input_prefix}{i}.json"
+        logger.info(f"正在读取文件: {input_file}")
+        try:
+            with open(input_file, 'r', encoding='utf-8') as f:
+                yield i, json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"文件 {input_file} 读取失败: {e}")
+
+
+def parse_stage(episodes, dump_dir=None):
+    """
+    解析阶段：ASR原始结果 -> 按句组织的结果
+
+    :param episodes: 生成 (编号, 原始数据) 的迭代器
+    :param dump_dir: 中间结果保存目录，为None时不保存
+    """
+    for i, data in episodes:
+        try:
+            results = parse_asr_data(data)
+        except (SyntaxError, ValueError, KeyError) as e:
+            logger.error(f"第{i}集解析失败: {e}")
+            continue
+        if dump_dir:
+            save_parsed_results(results, os.path.join(dump_dir, "parsed_results"),
+                                f"parsed_asr_result{i}.json", f"parsed_asr_result{i}.txt")
+        yield i, results
+
+
+def merge_stage(episodes, gap_ms=DEFAULT_GAP_MS, dump_dir=None):
+    """
+    合并阶段：合并连续的相同说话人的句子
+
+    :param episodes: 生成 (编号, 解析结果) 的迭代器
+    :param gap_ms: 间隔阈值（毫秒），超过则视为新的对话
+    :param dump_dir: 中间结果保存目录，为None时不保存
+    """
+    for i, results in episodes:
+        merged_results = merge_parsed_results(results, gap_ms)
+        if dump_dir:
+            output_dir = os.path.join(dump_dir, "merge_results")
+            os.makedirs(output_dir, exist_ok=True)
+            save_merged_results(merged_results, os.path.join(output_dir, f"merged_asr_result{i}.json"))
+        yield i, merged_results
+
+
+def extract_stage(episodes, triggers=DEFAULT_TRIGGERS, context=1, dump_dir=None):
+    """
+    提取阶段：找出皇上与前一句组成的对话
+
+    :param episodes: 生成 (编号, 合并结果) 的迭代器
+    :param triggers: 触发词列表
+    :param context: 前文包含的轮数
+    :param dump_dir: 中间结果保存目录，为None时不保存
+    """
+    for i, merged_results in episodes:
+        conversions = extract_conversions(merged_results, triggers, context, episode=i)
+        if dump_dir:
+            output_dir = os.path.join(dump_dir, "conversion_result")
+            os.makedirs(output_dir, exist_ok=True)
+            with open(os.path.join(output_dir, f"conversion_result{i}.json"), "w", encoding="utf-8") as f:
+                json.dump(conversions, f, ensure_ascii=False, indent=2)
+        yield i, conversions
+
+
+class _EpisodeResults:
+    """在内存中收集一集的校验结果，提供与CheckpointWriter相同的write/reject方法"""
+
+    def __init__(self):
+        self.datas = []
+        self.rejects = []
+
+    def write(self, tid, result):
+        self.datas.append(result)
+
+    def reject(self, item, raw, reason):
+        self.rejects.append({"item": item, "raw": raw, "reason": reason})
+
+
+def _dump_results(dump_dir, i, datas):
+    output_dir = os.path.join(dump_dir, "qwenapi_result")
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, f"qwenapi_result{i}.json"), "w", encoding="utf-8") as f:
+        for data in datas:
+            f.write(json.dumps(data, ensure_ascii=False) + "\n")
+
+
+def validate_stage(episodes, max_concurrent=64, cache=None, dump_dir=None, stats=None, backend=None,
+                   prefilter=None):
+    """
+    校验阶段：调用模型判断对话是否成立并修正错别字
+
+    所有集共用一个事件循环、一个会话和一个并发上限（同qwenapi.validate_episodes）：
+    一集的对话全部提交后就去取下一集，上一集的尾部请求在提交下一集时继续进行，
+    各集按顺序在其请求全部完成后交给下一阶段。
+
+    :param episodes: 生成 (编号, 对话列表) 的迭代器
+    :param max_concurrent: 最大并发数
+    :param cache: llm_cache.ResponseCache，为None时不使用缓存
+    :param dump_dir: 中间结果保存目录，为None时不保存
+    :param stats: metrics.LLMStats，记录模型调用的指标
+    :param backend: llm_backends中的模型后端，为None时使用HttpBackend
+    :param prefilter: prefilter.Prefilter，为None时全部对话都请求模型
+    """
+    # 延迟导入，只跑前几个阶段时不需要aiohttp和模型日志
+    from qwenapi import AsyncQwenCaller
+
+    loop = asyncio.new_event_loop()
+    caller = AsyncQwenCaller(max_concurrent=max_concurrent, cache=cache, stats=stats, backend=backend)
+    loop.run_until_complete(caller.__aenter__())
+    try:
+        caller.set_progress_bar(0)
+        inflight = deque()
+        upstream = iter(episodes)
+        while True:
+            # 上游各阶段是同步的，取下一集期间事件循环暂停，已发出的请求在下次进入循环时继续
+            episode = next(upstream, None)
+            if episode is not None:
+                i, conversions = episode
+                logger.info(f"第{i}集共 {len(conversions)} 条对话待校验")
+                results = _EpisodeResults()
+                tasks = loop.run_until_complete(caller.submit_questions(conversions, results, prefilter=prefilter))
+                inflight.append((i, results, tasks))
+            elif inflight and inflight[0][2]:
+                loop.run_until_complete(asyncio.wait(inflight[0][2]))
+            # 按集的顺序交出请求已全部完成的集
+            while inflight and all(task.done() for task in inflight[0][2]):
+                i, results, _ = inflight.popleft()
+                if dump_dir:
+                    _dump_results(dump_dir, i, results.datas)
+                yield i, results.datas
+            if episode is None and not inflight:
+                break
+        caller.close_progress()
+    finally:
+        pending = list(caller._running_tasks)
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.wait(pending))
+        loop.run_until_complete(caller.__aexit__(None, None, None))
+        loop.close()
+    if prefilter:
+        prefilter.log_stats()
+
+
+def assemble_stage(episodes):
+    """
+    组装阶段：将校验通过的对话转换为SFT训练数据
+
+    :param episodes: 生成 (编号, 校验结果) 的迭代器
+    :return: 生成训练数据记录
+    """
+    for i, datas in episodes:
+        yield from to_sft_records(datas)
+
+
+def build_pipeline(input_prefix, start, end, stop_after="assemble", max_concurrent=64, dump_dir=None,
+                   gap_ms=DEFAULT_GAP_MS, triggers=DEFAULT_TRIGGERS, context=1, cache=None, dedup=None,
+                   metrics=None, ingest=None, backend=None, prefilter=None):
+    """
+    按顺序串联各阶段，记录在内存中逐集传递
+
+    :param input_prefix: 输入的JSON文件前缀
+    :param start: 起始文件编号
+    :param end: 结束文件编号（包含）
+    :param stop_after: 最后执行的阶段
+    :param max_concurrent: 模型调用的最大并发数
+    :param dump_dir: 中间结果保存目录，为None时不保存
+    :param gap_ms: 合并阶段的间隔阈值（毫秒）
+    :param triggers: 提取阶段的触发词列表
+    :param context: 提取阶段前文包含的轮数
+    :param cache: 校验阶段使用的llm_cache.ResponseCache
+    :param dedup: 组装后用于去重的dedup.Deduplicator，为None时不去重
+    :param metrics: metrics.PipelineMetrics，按集记录读取到校验各阶段的指标，为None时不记录
+    :param ingest: 生成 (编号, 解析结果) 的音频识别阶段，设置后代替读取和解析阶段
+    :param backend: 校验阶段使用的llm_backends后端，为None时使用HttpBackend
+    :param prefilter: 校验前的prefilter.Prefilter，为None时全部对话都请求模型
+    :return: 最后一个阶段的生成器
+    """
+    if metrics is None:
+        track = lambda name, stream, source=None: stream
+        stats = None
+    else:
+        track = metrics.track
+        stats = metrics.llm("validate")
+
+    if ingest is None:
+        stream = track("load", iter_asr_files(input_prefix, start, end))
+        stream = track("parse", parse_stage(stream, dump_dir), "load")
+        parsed = "parse"
+    else:
+        stream = track("ingest", ingest)
+        parsed = "ingest"
+    if stop_after == "parse":
+        return stream
+    stream = track("merge", merge_stage(stream, gap_ms, dump_dir), parsed)
+    if stop_after == "merge":
+        return stream
+    stream = track("extract", extract_stage(stream, triggers, context, dump_dir), "merge")
+    if stop_after == "extract":
+        return stream
+    stream = track("validate", validate_stage(stream, max_concurrent, cache, dump_dir, stats, backend, prefilter),
+                   "extract")
+    if stop_after == "validate":
+        return stream
+    stream = assemble_stage(stream)
+    if dedup is not None:
+        stream = dedup.filter(stream)
+    return stream
+
+
+def parse_arguments():
+    """
+    解析命令行参数
+
+    :return: 解析后的参数
+    """
+    parser = argparse.ArgumentParser(description='串联解析、合并、提取、校验、组装各阶段的数据处理流水线')
+    parser.add_argument('--input-prefix', '-i', type=str, default="data/asr_result",
+                        help='输入的JSON文件前缀 (默认: data/asr_result)')
+    parser.add_argument('--output', '-o', type=str, default="data/qwenapi_result/qwenapi_result.json",
+                        help='最终训练数据的输出路径 (默认: data/qwenapi_result/qwenapi_result.json)')
+    parser.add_argument('--format', type=str, default=DEFAULT_FORMAT, choices=OUTPUT_FORMATS,
+                        help=f'最终训练数据的格式；json写到 --output，其余按集划分后分片写到 --shard-dir (默认: {DEFAULT_FORMAT})')
+    parser.add_argument('--shard-dir', type=str, default="data/sft",
+                        help='分片和manifest.json的输出目录 (默认: data/sft)')
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE,
+                        help=f'每个分片的记录数 (默认: {DEFAULT_SHARD_SIZE})')
+    parser.add_argument('--val-ratio', type=float, default=0.0,
+                        help='按集划入验证集的比例 (默认: 0，不划分)')
+    parser.add_argument('--start', '-s', type=int, default=1,
+                        help='起始文件编号，指定 --audio-dir 时为第一个音频的集数编号 (默认: 1)')
+    parser.add_argument('--end', '-e', type=int, default=46,
+                        help='结束文件编号 (默认: 46)')
+    parser.add_argument('--stop-after', type=str, default="assemble", choices=STAGES,
+                        help='执行到哪个阶段为止 (默认: assemble)')
+    parser.add_argument('--max-concurrent', type=int, default=64,
+                        help='模型调用的最大并发数 (默认: 64)')
+    parser.add_argument('--gap-ms', type=int, default=DEFAULT_GAP_MS,
+                        help=f'合并阶段的间隔阈值（毫秒） (默认: {DEFAULT_GAP_MS})')
+    parser.add_argument('--triggers', type=str, nargs='+', default=list(DEFAULT_TRIGGERS),
+                        help='提取阶段的触发词列表 (默认: 朕)')
+    parser.add_argument('--context', type=int, default=1,
+                        help='提取阶段前文包含的轮数 (默认: 1)')
+    parser.add_argument('--dump-dir', type=str, default=None,
+                        help='保存各阶段中间结果的目录，不指定则不保存')
+    parser.add_argument('--dedup-threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f'组装后近似去重的相似度阈值 (默认: {DEFAULT_THRESHOLD})')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='组装后不做去重')
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    add_ingest_arguments(parser)
+    add_backend_arguments(parser)
+    add_prefilter_arguments(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    args = parse_arguments()
+
+    dedup = None if args.no_dedup else Deduplicator(args.dedup_threshold)
+    metrics = metrics_from_args(args)
+    sharded = args.stop_after == "assemble" and args.format != "json"
+    # 分片输出需要知道每条记录属于哪一集，因此取校验阶段的逐集结果自行组装
+    stream = build_pipeline(args.input_prefix, args.start, args.end, "validate" if sharded else args.stop_after,
+                            args.max_concurrent, args.dump_dir, args.gap_ms,
+                            args.triggers, args.context, cache_from_args(args), dedup, metrics,
+                            ingest_from_args(args, args.start, args.dump_dir), backend_from_args(args),
+                            prefilter_from_args(args))
+
+    if args.stop_after == "assemble":
+        # 上游各阶段在组装拉取记录时运行，计时只计入各自的阶段，组装阶段只含转换、去重和写出
+        with metrics.stage("assemble") as stats:
+            if sharded:
+                manifest = assemble_shards(((i, to_sft_records(datas)) for i, datas in stream), args.shard_dir,
+                                           args.format, args.shard_size, args.val_ratio, dedup=dedup)
+                stats.records_out = manifest["records"]
+                logger.info(f"流水线完成，共生成 {manifest['records']} 条训练数据: {args.shard_dir}")
+            else:
+                stats.records_out = write_json_array(stream, args.output)
+                logger.info(f"流水线完成，共生成 {stats.records_out} 条训练数据: {args.output}")
+        stats.records_in = metrics.summary("validate").records_out
+        if dedup:
+            dedup.log_stats()
+            dedup.close()
+    else:
+        # 只执行到中间阶段时，各阶段结果通过 --dump-dir 保存
+        episode_count = sum(1 for _ in stream)
+        logger.info(f"流水线执行到 {args.stop_after} 阶段，共处理 {episode_count} 集")
+    finish_metrics(metrics, args)
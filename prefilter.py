@@ -0,0 +1,389 @@
+"""
+校验前的预筛：给提取出的对话打分，明显不成立的对话不再请求模型
+
+两层判断：
+- 硬规则：没有任何汉字（纯噪声、音乐）、前后两轮文本相同、同一个字大量重复，直接判"否"
+- 分类器：字符1~3-gram哈希特征 + 说话人是否交替、间隔、长度比、语速等规则特征上的逻辑回归，
+  用已有qwenapi_result中模型给出的"是/否"训练。判否的阈值在训练时按交叉验证结果校准，
+  保证被直接判否的对话中至少有target_precision确实会被模型判否；达不到时不直接判否
+
+说话人、间隔这些规则单独使用时和模型的判断相关性不够（同一说话人的对话仍有近半被判"是"），
+因此只作为分类器的特征，由标签决定权重。
+"""
+import difflib
+import json
+import math
+import os
+import pickle
+import re
+import argparse
+import logging
+
+from checkpoint import task_id
+from corpus import load_episode
+from find_huang import DEFAULT_TRIGGERS, extract_conversions
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "prefilter_model.pkl")
+DEFAULT_TARGET_PRECISION = 0.9
+# 标签与对话按文本相似度对应时的最低相似度（模型会修正错别字，文本不完全相同）
+MATCH_RATIO = 0.6
+LONG_GAP_MS = 8000
+# 超过这个时长且语速低于LYRICS_CHARS_PER_S的一轮多为唱词或背景音乐
+LYRICS_MIN_MS = 15000
+LYRICS_CHARS_PER_S = 2.0
+_NON_CJK = re.compile(r"[^一-鿿]")
+
+
+def _chars(text):
+    """只保留汉字，标点和ASR插入的空格不计入长度"""
+    return _NON_CJK.sub("", text or "")
+
+
+def hard_reject(pair):
+    """
+    不需要模型就能判否的情况
+
+    :param pair: 提取阶段的对话字典
+    :return: 原因，不满足时返回None
+    """
+    orther, huang = _chars(pair.get("orther")), _chars(pair.get("huang"))
+    if not orther or not huang:
+        return "no_text"
+    if orther == huang:
+        return "echo"
+    for text in (orther, huang):
+        if len(text) >= 20 and len(set(text)) < 0.2 * len(text):
+            return "repetitive"
+    return None
+
+
+def pair_features(pair):
+    """
+    分类器的规则特征
+
+    :param pair: 提取阶段的对话字典，缺少speakers、gap_ms、duration_ms时相应特征为0
+    :return: 浮点数列表，第一维标记是否有说话人和时间信息
+    """
+    orther, huang = _chars(pair.get("orther")), _chars(pair.get("huang"))
+    speakers, gap, durations = pair.get("speakers"), pair.get("gap_ms"), pair.get("duration_ms")
+    has_meta = bool(speakers) and gap is not None and bool(durations)
+    features = [
+        float(has_meta),
+        math.log1p(len(orther)) / 5,
+        math.log1p(len(huang)) / 5,
+        abs(math.log((len(orther) + 1) / (len(huang) + 1))) / 3,
+    ]
+    if has_meta:
+        slow = any(duration >= LYRICS_MIN_MS and len(text) * 1000 / duration < LYRICS_CHARS_PER_S
+                   for text, duration in zip((orther, huang), durations))
+        features += [
+            float(speakers[0] == speakers[1]),
+            min(max(gap, 0), 60000) / 10000,
+            float(gap > LONG_GAP_MS),
+            float(slow),
+        ]
+    else:
+        features += [0.0, 0.0, 0.0, 0.0]
+    return features
+
+
+def pair_text(pair):
+    return f"{pair['orther']}\n{pair['huang']}"
+
+
+class PairClassifier:
+    """哈希文本特征 + 规则特征的逻辑回归，不需要词表，模型只有几MB"""
+
+    def __init__(self, model, reject_below=0.0, report=None):
+        """
+        :param model: 训练好的sklearn LogisticRegression
+        :param reject_below: 校准得到的判否阈值，0表示不直接判否
+        :param report: 训练时的评估结果
+        """
+        self.model = model
+        self.reject_below = reject_below
+        self.report = report or {}
+
+    @staticmethod
+    def features(pairs):
+        from scipy.sparse import csr_matrix, hstack
+        from sklearn.feature_extraction.text import HashingVectorizer
+
+        vectorizer = HashingVectorizer(analyzer="char", ngram_range=(1, 3), n_features=2 ** 18,
+                                       alternate_sign=False, norm="l2")
+        text = vectorizer.transform([pair_text(pair) for pair in pairs])
+        return hstack([text, csr_matrix([pair_features(pair) for pair in pairs])]).tocsr()
+
+    @staticmethod
+    def calibrate(probs, labels, target_precision, min_support=20):
+        """
+        选出最大的阈值，使概率低于它的样本中判"否"的比例不低于target_precision
+
+        :return: 阈值，达不到目标时为0
+        """
+        order = sorted(zip(probs, labels))
+        threshold = 0.0
+        negatives = 0
+        for count, (prob, label) in enumerate(order, 1):
+            negatives += not label
+            if count >= min_support and negatives / count >= target_precision:
+                threshold = prob
+        return threshold
+
+    @classmethod
+    def train(cls, pairs, labels, target_precision=DEFAULT_TARGET_PRECISION, folds=5, seed=0):
+        """
+        训练分类器并按交叉验证的预测校准判否阈值
+
+        :param pairs: 对话字典列表
+        :param labels: 与pairs对应的布尔列表，True表示模型判"是"
+        :param target_precision: 直接判否的对话中确实为"否"的最低比例
+        :return: PairClassifier
+        """
+        try:
+            from sklearn.linear_model import LogisticRegression
+            from sklearn.metrics import roc_auc_score
+            from sklearn.model_selection import StratifiedKFold, cross_val_predict
+        except ImportError:
+            raise ImportError("训练预筛分类器需要安装scikit-learn") from None
+
+        x = cls.features(pairs)
+        model = LogisticRegression(max_iter=2000, class_weight="balanced")
+        probs = cross_val_predict(model, x, labels, method="predict_proba",
+                                  cv=StratifiedKFold(folds, shuffle=True, random_state=seed))[:, 1]
+        reject_below = cls.calibrate(probs, labels, target_precision)
+        rejected = [label for prob, label in zip(probs, labels) if prob < reject_below]
+        report = {
+            "samples": len(labels),
+            "with_meta": sum(1 for pair in pairs if pair_features(pair)[0]),
+            "positive_rate": round(sum(labels) / len(labels), 3),
+            "cv_auc": round(roc_auc_score(labels, probs), 3),
+            "target_precision": target_precision,
+            "reject_below": round(reject_below, 4),
+            "cv_reject_rate": round(len(rejected) / len(labels), 3),
+            "cv_reject_precision": round(1 - sum(rejected) / len(rejected), 3) if rejected else None,
+        }
+        model.fit(x, labels)
+        return cls(model, reject_below, report)
+
+    def predict(self, pairs):
+        """
+        :param pairs: 对话字典列表
+        :return: 每条对话被模型判"是"的概率
+        """
+        if not pairs:
+            return []
+        return list(self.model.predict_proba(self.features(pairs))[:, 1])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "wb") as f:
+            pickle.dump({"model": self.model, "reject_below": self.reject_below, "report": self.report}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        return cls(state["model"], state["reject_below"], state["report"])
+
+
+class Prefilter:
+    """给对话打分，把明显不成立（和可选的明显成立）的对话从模型请求中分出来"""
+
+    def __init__(self, classifier=None, reject_below=None, accept_above=None):
+        """
+        :param classifier: PairClassifier，为None时只用硬规则
+        :param reject_below: 概率低于它的对话直接判"否"，默认用分类器校准的阈值
+        :param accept_above: 概率高于它的对话直接判"是"（不经模型，也就没有错别字修正），为None时不启用
+        """
+        self.classifier = classifier
+        if reject_below is None:
+            reject_below = classifier.reject_below if classifier else 0.0
+        self.reject_below = reject_below
+        self.accept_above = accept_above
+        self.rejected = 0
+        self.accepted = 0
+        self.passed = 0
+
+    def config(self):
+        """影响结果的参数，供rebuild.py判断校验阶段是否需要重建"""
+        return {
+            "reject_below": self.reject_below,
+            "accept_above": self.accept_above,
+            "classifier": self.classifier.report if self.classifier else None,
+        }
+
+    def split(self, pairs):
+        """
+        把对话分成需要请求模型的和已经有结论的
+
+        :param pairs: 对话字典列表
+        :return: (需要请求模型的对话列表, [(对话, 结果字典)])；结果字典与模型的校验结果格式相同，
+                 另带source、score和reason字段，训练分类器时会跳过这些结果
+        """
+        pending, decided = [], []
+        reasons = [hard_reject(pair) for pair in pairs]
+        candidates = [pair for pair, reason in zip(pairs, reasons) if reason is None]
+        probs = iter(self.classifier.predict(candidates) if self.classifier else [None] * len(candidates))
+        for pair, reason in zip(pairs, reasons):
+            prob = None if reason else next(probs)
+            if reason:
+                result = "否"
+            elif prob is not None and prob < self.reject_below:
+                result, reason = "否", "classifier"
+            elif prob is not None and self.accept_above is not None and prob >= self.accept_above:
+                result, reason = "是", "classifier"
+            else:
+                pending.append(pair)
+                self.passed += 1
+                continue
+            if result == "否":
+                self.rejected += 1
+            else:
+                self.accepted += 1
+            decided.append((pair, {"result": result, "input": pair["orther"], "output": pair["huang"],
+                                   "source": "prefilter", "reason": reason,
+                                   "score": None if prob is None else round(prob, 4)}))
+        return pending, decided
+
+    def log_stats(self):
+        total = self.rejected + self.accepted + self.passed
+        logger.info(f"预筛统计 - 共 {total} 条, 直接判否: {self.rejected}, 直接通过: {self.accepted}, "
+                    f"交给模型: {self.passed}")
+
+
+def _read_results(path):
+    """读取一集的校验结果及其任务编号（结果行里没有task_id的旧结果为None）"""
+    results = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            results.append((record.get("task_id") if isinstance(record, dict) else None, record))
+    return results
+
+
+def load_training_pairs(result_prefix="data/qwenapi_result/qwenapi_result", start=1, end=46,
+                        triggers=DEFAULT_TRIGGERS):
+    """
+    把模型的校验结果对应回提取阶段的对话，作为训练数据
+
+    对话按find_huang的规则从合并结果重新提取，带有说话人和时间信息，与校验时预筛看到的对话一致。
+    结果行带task_id时按任务编号精确对应；没有时按文本相似度对应（模型会修正错别字），
+    对应不上的结果只用其文本。预筛自己判定的结果不参与训练。
+
+    :param triggers: 提取对话用的触发词，应与生成这些结果时的一致
+    :return: (对话字典列表, 布尔标签列表)
+    """
+    pairs, labels = [], []
+    for i in range(start, end + 1):
+        result_file = f"{result_prefix}{i}.json"
+        if not os.path.exists(result_file):
+            continue
+        try:
+            conversions = extract_conversions(load_episode("merged", i), triggers, episode=i)
+        except FileNotFoundError:
+            conversions = []
+        by_id = {task_id(conversion): conversion for conversion in conversions}
+        for tid, record in _read_results(result_file):
+            if not isinstance(record, dict) or record.get("result") not in ("是", "否") or "source" in record:
+                continue
+            if not (record.get("input") and record.get("output")):
+                continue
+            pair = by_id.get(tid)
+            if pair is None and conversions:
+                text = record["input"] + record["output"]
+                ratio, pair = max(((difflib.SequenceMatcher(None, c["orther"] + c["huang"], text).ratio(), c)
+                                   for c in conversions), key=lambda item: item[0])
+                if ratio < MATCH_RATIO:
+                    pair = None
+            if pair is None:
+                pair = {"orther": record["input"], "huang": record["output"]}
+            pairs.append(pair)
+            labels.append(record["result"] == "是")
+    return pairs, labels
+
+
+def add_prefilter_arguments(parser):
+    """给命令行解析器加上预筛相关参数"""
+    parser.add_argument('--no-prefilter', action='store_true',
+                        help='不做预筛，全部对话都交给模型')
+    parser.add_argument('--prefilter-model', type=str, default=DEFAULT_MODEL_PATH,
+                        help='预筛分类器文件，不存在时只用硬规则 (默认: data/prefilter_model.pkl)')
+    parser.add_argument('--reject-below', type=float, default=None,
+                        help='分类器概率低于此值的对话直接判否 (默认: 训练时校准的阈值)')
+    parser.add_argument('--accept-above', type=float, default=None,
+                        help='分类器概率高于此值的对话直接通过，不经模型修正错别字 (默认: 不启用)')
+
+
+def prefilter_from_args(args):
+    """
+    按命令行参数构造预筛
+
+    :return: Prefilter，指定 --no-prefilter 时返回None
+    """
+    if args.no_prefilter:
+        return None
+    classifier = None
+    if args.prefilter_model and os.path.exists(args.prefilter_model):
+        classifier = PairClassifier.load(args.prefilter_model)
+        logger.info(f"已加载预筛分类器: {args.prefilter_model}，判否阈值 {classifier.reject_below:.4f}")
+    return Prefilter(classifier, args.reject_below, args.accept_above)
+
+
+def parse_arguments():
+    """
+    解析命令行参数
+
+    :return: 解析后的参数
+    """
+    parser = argparse.ArgumentParser(description='训练预筛分类器，或统计预筛对提取结果的筛除情况')
+    parser.add_argument('--train', action='store_true',
+                        help='用已有的校验结果训练分类器并保存到 --prefilter-model')
+    parser.add_argument('--result-prefix', type=str, default="data/qwenapi_result/qwenapi_result",
+                        help='校验结果文件前缀 (默认: data/qwenapi_result/qwenapi_result)')
+    parser.add_argument('--conversion-prefix', type=str, default="data/conversion_result/conversion_result",
+                        help='统计筛除情况时读取的提取结果文件前缀 (默认: data/conversion_result/conversion_result)')
+    parser.add_argument('--triggers', '-t', type=str, nargs='+', default=list(DEFAULT_TRIGGERS),
+                        help='训练时从合并结果重新提取对话用的触发词 (默认: 朕)')
+    parser.add_argument('--start', '-s', type=int, default=1,
+                        help='起始文件编号 (默认: 1)')
+    parser.add_argument('--end', '-e', type=int, default=46,
+                        help='结束文件编号 (默认: 46)')
+    parser.add_argument('--target-precision', type=float, default=DEFAULT_TARGET_PRECISION,
+                        help=f'训练时校准判否阈值的目标精度 (默认: {DEFAULT_TARGET_PRECISION})')
+    add_prefilter_arguments(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    args = parse_arguments()
+    if args.train:
+        pairs, labels = load_training_pairs(args.result_prefix, args.start, args.end, args.triggers)
+        logger.info(f"共 {len(labels)} 条标签")
+        classifier = PairClassifier.train(pairs, labels, args.target_precision)
+        classifier.save(args.prefilter_model)
+        logger.info(f"交叉验证评估: {json.dumps(classifier.report, ensure_ascii=False)}")
+        logger.info(f"分类器已保存到: {args.prefilter_model}")
+    else:
+        prefilter = prefilter_from_args(args) or Prefilter()
+        reasons = {}
+        for i in range(args.start, args.end + 1):
+            path = f"{args.conversion_prefix}{i}.json"
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                _, decided = prefilter.split(json.load(f))
+            for _, result in decided:
+                reasons[result["reason"]] = reasons.get(result["reason"], 0) + 1
+        prefilter.log_stats()
+        logger.info(f"直接判定的原因: {reasons}")
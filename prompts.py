@@ -0,0 +1,176 @@
+"""
+模型调用用到的prompt模板
+
+每个模板分成固定的system消息和只含本条数据的user消息。同一模板的所有请求
+共享完整的system前缀，开启prefix caching的推理服务（如vLLM）只需对变化的尾部做prefill。
+"""
+import json
+
+from response_parser import parse_json
+
+DEFAULT_MODEL = "Qwen2.5"
+DEFAULT_TEMPERATURE = 0.7
+DEFAULT_MAX_TOKENS = 4096 * 4
+
+
+class PromptTemplate:
+    """固定的system消息 + 按字段填充的user消息，以及回答应满足的格式"""
+
+    def __init__(self, name, system, user, keys, many=False):
+        """
+        :param name: 模板名称
+        :param system: system消息，不含任何变量
+        :param user: user消息的格式串，用str.format填充
+        :param keys: 回答中每条结果必须包含的字段
+        :param many: 回答是否为结果数组
+        """
+        self.name = name
+        self.system = system.strip()
+        self.user = user.strip()
+        self.keys = tuple(keys)
+        self.many = many
+
+    def messages(self, **fields):
+        """
+        生成chat消息列表
+
+        :param fields: user消息中的字段
+        :return: [system消息, user消息]
+        """
+        return [
+            {"role": "system", "content": self.system},
+            {"role": "user", "content": self.user.format(**fields)},
+        ]
+
+    def payload(self, model=DEFAULT_MODEL, temperature=DEFAULT_TEMPERATURE, max_tokens=DEFAULT_MAX_TOKENS, **fields):
+        """
+        生成chat/completions接口的请求体
+
+        :param fields: user消息中的字段
+        """
+        return {
+            "model": model,
+            "messages": self.messages(**fields),
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        }
+
+    def parse(self, text):
+        """
+        解析并校验模型回答
+
+        :raises response_parser.ResponseParseError: 回答不符合格式
+        """
+        return parse_json(text, self.keys, self.many)
+
+
+TEMPLATES = {}
+
+
+def register(template):
+    """注册模板，同名模板会被覆盖"""
+    TEMPLATES[template.name] = template
+    return template
+
+
+def get_template(name):
+    """
+    按名称取模板
+
+    :param name: 模板名称
+    :return: PromptTemplate
+    """
+    try:
+        return TEMPLATES[name]
+    except KeyError:
+        raise KeyError(f"未知的prompt模板: {name}（可用: {', '.join(sorted(TEMPLATES))}）") from None
+
+
+VALIDATE_PAIR = register(PromptTemplate(
+    "validate_pair",
+    system="""
+你会收到一段orther说的话和一段huang说的话，理论上这是一个对话。
+## 可能存在的错误
+- 可能有错别字，如果有错别字就给我修改，但是原意不要修改
+- 可能会有标点符号的错误，如果有，修改标点符号为正确的
+## 返回结果
+- 这俩如果不是一个人和皇上的对话逻辑，那么就返回否
+- 返回标准的json格式，不要给出其他任何数据
+{
+"result":"是"或者"否"//是否是皇上和orther的对话
+"input":"修改后的内容"//如果是的话，而且有错别字就修改，如果不是的话就是原话，这是orther说的，里边只能放说的话，不要放其他内容
+"output":"修改后的内容"//如果是的话，而且有错别字就修改，如果不是的话就是原话，这是huang说的，里边只能放说的话，不要放其他内容
+}
+""",
+    user="""
+orther说的：{orther}
+huang说的：{huang}
+""",
+    keys=("result", "input", "output"),
+))
+
+VALIDATE_BATCH = register(PromptTemplate(
+    "validate_batch",
+    system="""
+你会收到一个对话列表，每一项都有orther说的话和huang说的话，理论上每一项都是一个对话。
+## 可能存在的错误
+- 可能有错别字，如果有错别字就给我修改，但是原意不要修改
+- 可能会有标点符号的错误，如果有，修改标点符号为正确的
+## 返回结果
+- 逐项判断，如果不是一个人和皇上的对话逻辑，那么这一项的result就返回否
+- 返回标准的json数组，每个输入对应一项，index和输入的index一致，不要给出其他任何数据
+[
+  {
+  "index":0//对应输入的index
+  "result":"是"或者"否"//是否是皇上和orther的对话
+  "input":"修改后的内容"//如果是的话，而且有错别字就修改，如果不是的话就是原话，这是orther说的，里边只能放说的话，不要放其他内容
+  "output":"修改后的内容"//如果是的话，而且有错别字就修改，如果不是的话就是原话，这是huang说的，里边只能放说的话，不要放其他内容
+  }
+]
+""",
+    user="""
+## 对话列表
+{pairs}
+""",
+    keys=("index", "result", "input", "output"),
+    many=True,
+))
+
+ROLE_QA = register(PromptTemplate(
+    "role_qa",
+    system="""
+## 角色
+- 你是一个资深的语言大师，精通各行各业的语言
+## 任务
+- 我需要得到一些的和皇帝的对话
+- 我会给你一个角色的相关信息，然后给你一个对话的实例，你根据当前角色还可能的说的话或者相关问题，来生成提问以及皇帝的回答
+- 提问需要按照当代的语言提问，也就是角色信息的few-shot的样子提问
+## 输出格式
+- 标注json格式
+- 不要输出其他任何东西
+{
+"input":""//模仿的提问,注意使用当代语言提问，不要出现皇上两个字，就是角色信息的正常说话
+"output":""//生成的回答
+}
+""",
+    user="""
+## 角色信息
+- 提问者身份：{role}
+- 角色特征：{traits}
+- 示例发言："{examples}"
+
+## 当前对话
+- 输入内容：「{input}」
+- 皇帝回应：「{output}」
+""",
+    keys=("input", "output"),
+))
+
+
+def batch_pairs_text(questions):
+    """把一组对话转成validate_batch模板中带index的列表文本"""
+    pairs = [
+        {"index": index, "orther": question["orther"], "huang": question["huang"]}
+        for index, question in enumerate(questions)
+    ]
+    return json.dumps(pairs, ensure_ascii=False)
@@ -1,11 +1,19 @@
-import aiohttp
 import asyncio
+import argparse
 import logging
 import json
-from tqdm import tqdm
 from datetime import datetime
 import os
 
+from llm_cache import add_cache_arguments, cache_from_args
+from checkpoint import CheckpointWriter, task_id as make_task_id
+from prompts import VALIDATE_PAIR, VALIDATE_BATCH, batch_pairs_text
+from response_parser import ResponseParseError
+from metrics import add_metrics_arguments, metrics_from_args, finish_metrics
+from llm_backends import add_backend_arguments, backend_from_args
+from llm_caller import AsyncLLMCaller
+from prefilter import add_prefilter_arguments, prefilter_from_args
+
 
 # 配置日志
 def setup_logging(log_dir="./logs", log_level=logging.INFO, show_logs=True):
@@ -29,186 +37,282 @@ def setup_logging(log_dir="./logs", log_level=logging.INFO, show_logs=True):
 
 logger = setup_logging()
 
-async def analyze_feedback(feedback_content):
+def match_batch_results(records, count):
     """
-    Analyze a single feedback entry using LLM
+    把批量回答按index对应回输入
+
+    :param records: VALIDATE_BATCH.parse解析后的结果列表
+    :param count: 输入条数
+    :return: 按输入顺序排列的结果列表（去掉index），对应不上时返回None
     """
-    try:
-        # Clean up the response if it contains code block formatting
-        clean_response = feedback_content
-        if clean_response.startswith('```json'):
-            clean_response = clean_response[7:]  # Remove ```json prefix
-        if clean_response.startswith('```'):
-            clean_response = clean_response[3:]  # Remove ``` prefix
-        if clean_response.endswith('```'):
-            clean_response = clean_response[:-3]  # Remove ``` suffix
-        if clean_response.startswith('```python'):
-            clean_response = clean_response[7:]  # Remove ```json prefix
-        if clean_response.startswith('```'):
-            clean_response = clean_response[3:]  # Remove ``` prefix
-        if clean_response.endswith('```'):
-            clean_response = clean_response[:-3]  # Remove ``` suffix
-        # Parse the cleaned JSON
-        logger.info(f"clean_response: {clean_response}")
-        result = json.loads(clean_response)
-        logger.info(f"result: {result}")
-
-        return result
-    except Exception as e:
-        clean_response = json.dumps(clean_response, ensure_ascii=False)
-        return json.loads(clean_response)
-class AsyncQwenCaller:
-    def __init__(self, max_concurrent=5, max_retries=3):
-        self.max_concurrent = max_concurrent
-        self.max_retries = max_retries
-        self.url = "http://localhost:8001/v1/chat/completions"
-        self.headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer YOUR_TOKEN"
-        }
-        self._running_tasks = set()
-        self.processed_count = 0
-        self.total_count = 0
-        self.progress_bar = None
-        self.datas = []
-
-    async def __aenter__(self):
-        timeout = aiohttp.ClientTimeout(total=600, connect=10)
-        self.session = aiohttp.ClientSession(timeout=timeout)
-        return self
-
-    async def __aexit__(self, exc_type, exc, tb):
-        await self.session.close()
-
-    async def _call_api(self, question: dict, retry_count=0) -> dict:
-        """实际调用API的异步方法，带重试机制"""
+    if len(records) != count:
+        return None
+    results = [None] * count
+    for record in records:
+        index = record.get("index")
+        # bool是int的子类，true/false不能当作下标
+        if type(index) is not int or not 0 <= index < count or results[index] is not None:
+            return None
+        results[index] = {key: value for key, value in record.items() if key != "index"}
+    return results
+
+
+class AsyncQwenCaller(AsyncLLMCaller):
+    """校验提取出的对话，支持单条和批量prompt"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 已提交的请求数，跨多组对话连续编号，用于日志
+        self.task_count = 0
+
+    async def _call_api(self, question: dict):
+        """校验单条对话，返回解析后的结果，网络错误重试用尽时返回None"""
+        data = VALIDATE_PAIR.payload(orther=question["orther"], huang=question["huang"])
+        return await self._post_chat(data, VALIDATE_PAIR, question.get("huang"))
+
+    async def _call_batch_api(self, questions: list):
+        """一次请求校验多条对话，返回解析后的结果列表，网络错误重试用尽时返回None"""
+        data = VALIDATE_BATCH.payload(pairs=batch_pairs_text(questions))
+
+        def check(records):
+            results = match_batch_results(records, len(questions))
+            if results is None:
+                raise ResponseParseError(f"批量回答的index无法对应到 {len(questions)} 条输入")
+            return results
+
+        return await self._post_chat(data, VALIDATE_BATCH, f"批量{len(questions)}条", check)
+
+    def _record_result(self, question: dict, result, writer=None):
+        """保存一条结果并更新进度"""
+        self._save_result(make_task_id(question), result, writer)
+        self._advance()
+
+    def _record_reject(self, question: dict, error: ResponseParseError, writer=None):
+        """记入拒绝队列并更新进度"""
+        self._save_reject(question, error, writer)
+        self._advance()
+
+    async def _execute_call(self, question: dict, task_id: int, writer=None):
+        """实际执行调用的内部方法；回答不合格时重新请求，仍不合格则记入拒绝队列"""
         try:
-            data = {
-                "model": "Qwen2.5",
-                "messages": [
-                    {"role": "user", "content":f"""
-                     你现在来看一下这个内容，这个是orther说的{question["orther"]}，这是huang说的{question["huang"]}，
-                    ，理论上这是一个对话，
-                    ## 可能存在的错误
-                    - 可能有错别字，如果有错别字就给我修改，但是原意不要修改
-                    - 可能会有标点符号的错误，如果有，修改标点符号为正确的
-                    ## 返回结果
-                    - 这俩如果不是一个人和皇上的对话逻辑，那么就返回否
-                    - 返回标准的json格式，不要给出其他任何数据
-                     
-                     {{
-                     "result":"是"或者"否"//是否是皇上和orther的对话
-                     "input":"修改后的内容"//如果是的话，而且有错别字就修改，如果不是的话就是原话，这是orther说的，里边只能放说的话，不要放其他内容
-                     "output":"修改后的内容"//如果是的话，而且有错别字就修改，如果不是的话就是原话，这是huang说的，里边只能放说的话，不要放其他内容
-                     }}
-                     """}
-                ],
-                "temperature": 0.7,
-                "max_tokens": 4096 * 4
-            }
-
-            async with self.session.post(self.url, headers=self.headers, json=data) as response:
-                response_json = await response.json()
-                response_data = response_json["choices"][0]["message"].get("content")
-                logger.info(f"回答: {response_data}")
-                logger.info("-" * 50)
-
-                # question["answer_7b"] = response_data
-                return response_data
-
+            try:
+                result = await self._call_with_requery(lambda attempt: self._call_api(question), task_id)
+            except ResponseParseError as error:
+                self._record_reject(question, error, writer)
+                return
+            if result is None:
+                raise RuntimeError("重试次数用尽")
+            self._record_result(question, result, writer)
         except Exception as e:
-            if retry_count < self.max_retries:
-                wait_time = 2 ** retry_count  # 指数退避
-                logger.warning(f"请求失败，{wait_time}秒后重试... (错误: {str(e)})")
-                await asyncio.sleep(wait_time)
-                return await self._call_api(question, retry_count + 1)
-            logger.error(f"处理问题 '{question['question']}' 时发生错误: {str(e)}")
-            return question
-
-    async def _execute_call(self, question: dict, task_id: int):
-        """实际执行调用的内部方法"""
+            logger.error(f"任务 {task_id} 执行失败: {str(e)}")
+            self._advance()
+
+    async def _execute_batch(self, questions: list, task_id: int, writer=None):
+        """
+        批量校验一组对话；回答格式不对时对半拆分重试，拆到单条时改用单条prompt
+
+        网络错误重试用尽时不拆分（拆分只会向已经出错的服务发出更多请求），整组记为失败。
+        """
+        if len(questions) == 1:
+            await self._execute_call(questions[0], task_id, writer)
+            return
+
+        recorded = 0
         try:
-            result = await self._call_api(question)
-            result = await analyze_feedback(result)
-            self.datas.append(result)
-            if self.progress_bar:
-                self.progress_bar.update(1)
-                self.processed_count += 1
+            try:
+                results = await self._call_batch_api(questions)
+            except ResponseParseError as e:
+                logger.warning(f"任务 {task_id} 的批量回答不合格（{e}），拆分后重试")
+                results = None
+            else:
+                if results is None:
+                    raise RuntimeError("重试次数用尽")
+                for question, result in zip(questions, results):
+                    self._record_result(question, result, writer)
+                    recorded += 1
+                return
         except Exception as e:
-            logger.error(f"任务 {task_id} 执行失败: {str(e)}")
-            if self.progress_bar:
-                self.progress_bar.update(1)
-                self.processed_count += 1
-
-    async def process_question(self, question: dict, task_id: int):
-        """处理单个问题"""
-        while len(self._running_tasks) >= self.max_concurrent:
-            done, _ = await asyncio.wait(
-                self._running_tasks,
-                return_when=asyncio.FIRST_COMPLETED
-            )
-            self._running_tasks -= done
-
-        task = asyncio.create_task(self._execute_call(question, task_id))
-        self._running_tasks.add(task)
-        task.add_done_callback(self._running_tasks.discard)
-
-    def set_progress_bar(self, total):
-        """设置进度条"""
-        self.total_count = total
-        self.progress_bar = tqdm(total=total, desc="处理问题", unit="个")
-
-    def close_progress(self):
-        """关闭进度条"""
-        if self.progress_bar:
-            self.progress_bar.close()
-
-
-async def main(input_file: str, output_file: str, max_concurrent: int = 5):
-    """主函数"""
-    # 读取输入文件
-    questions = []
-    with open(input_file, "r", encoding="utf-8") as f:
-        data=json.load(f)
-        for i in data:
-            questions.append(i)
-    # for line in f:
-    #     try:
-    #         question = json.loads(line)
-    #         questions.append(question)
-    #     except json.JSONDecodeError:
-    #         logger.warning(f"跳过无效的JSON行: {line[:50]}...")
-
-    logger.info(f"共读取 {len(questions)} 条问题记录")
-
-    # 异步处理问题
-    async with AsyncQwenCaller(max_concurrent=max_concurrent) as caller:
+            logger.error(f"任务 {task_id} 执行失败，{len(questions) - recorded} 条对话未完成: {str(e)}")
+            for _ in range(len(questions) - recorded):
+                self._advance()
+            return
+
+        self.stats.batch_splits += 1
+        middle = len(questions) // 2
+        await self._execute_batch(questions[:middle], task_id, writer)
+        await self._execute_batch(questions[middle:], task_id, writer)
+
+    async def process_batch(self, questions: list, task_id: int, writer=None):
+        """
+        一次请求处理多条对话，并发已满时等待空位后再提交
+
+        :param writer: 结果写入的CheckpointWriter，默认使用self.writer
+        :return: 已提交的任务
+        """
+        return await self._submit(self._execute_batch(questions, task_id, writer))
+
+    async def process_question(self, question: dict, task_id: int, writer=None):
+        """
+        处理单个问题，并发已满时等待空位后再提交
+
+        :param writer: 该问题结果写入的CheckpointWriter，默认使用self.writer
+        :return: 已提交的任务
+        """
+        return await self._submit(self._execute_call(question, task_id, writer))
+
+    async def submit_questions(self, questions: list, writer=None, batch_pairs: int = 1, prefilter=None):
+        """
+        预筛后把一组对话全部提交，不等待完成；并发已满时等待空位后再继续提交
+
+        :param writer: 这组对话的结果写入的CheckpointWriter（或有同样write/reject方法的对象），默认使用self.writer
+        :param batch_pairs: 每个请求包含的对话条数，大于1时使用批量prompt
+        :param prefilter: prefilter.Prefilter，预筛已有结论的对话直接写入结果，为None时全部请求
+        :return: 已提交的任务列表
+        """
+        if prefilter:
+            questions = _apply_prefilter(prefilter, questions, self, writer)
+        self.add_progress_total(len(questions))
+        tasks = []
+        for start in range(0, len(questions), batch_pairs):
+            self.task_count += 1
+            batch = questions[start:start + batch_pairs]
+            if batch_pairs > 1:
+                tasks.append(await self.process_batch(batch, self.task_count, writer))
+            else:
+                tasks.append(await self.process_question(batch[0], self.task_count, writer))
+        return tasks
+
+
+async def validate_questions(questions: list, max_concurrent: int = 5, cache=None, writer=None,
+                             stats=None, backend=None, prefilter=None) -> list:
+    """
+    异步调用模型校验一组对话
+
+    :param questions: 对话列表，每项包含orther和huang
+    :param max_concurrent: 最大并发数
+    :param cache: llm_cache.ResponseCache，为None时不使用缓存
+    :param writer: checkpoint.CheckpointWriter，设置后结果逐条写入文件
+    :param stats: metrics.LLMStats，记录模型调用的指标
+    :param backend: llm_backends中的模型后端，为None时使用HttpBackend
+    :param prefilter: prefilter.Prefilter，预筛已有结论的对话不再请求模型，为None时全部请求
+    :return: 预筛结果和模型返回并解析后的结果列表（设置writer时为空）
+    """
+    async with AsyncQwenCaller(max_concurrent=max_concurrent, cache=cache, writer=writer, stats=stats,
+                               backend=backend) as caller:
+        if prefilter:
+            questions = _apply_prefilter(prefilter, questions, caller)
         caller.set_progress_bar(len(questions))
 
-        tasks = []
+        # 逐个提交，并发已满时process_question会等待，在途任务数不超过max_concurrent
         for i, question in enumerate(questions):
-            task = caller.process_question(question, i + 1)
-            tasks.append(task)
-
-        # 等待所有任务完成
-        await asyncio.gather(*tasks, return_exceptions=True)
+            await caller.process_question(question, i + 1)
 
         # 等待剩余的任务完成
         if caller._running_tasks:
             await asyncio.wait(caller._running_tasks)
 
         caller.close_progress()
+        return caller.datas
 
-        # 写入结果
-        with open(output_file, "w", encoding="utf-8") as f:
-            for data in caller.datas:
-                f.write(json.dumps(data, ensure_ascii=False) + "\n")
 
+def _apply_prefilter(prefilter, questions: list, caller: AsyncQwenCaller, writer=None) -> list:
+    """把预筛已有结论的对话按模型结果的格式记下（不计入进度），返回仍需请求模型的对话"""
+    pending, decided = prefilter.split(questions)
+    caller.stats.prefiltered += len(decided)
+    for question, record in decided:
+        caller._save_result(make_task_id(question), record, writer)
+    return pending
+
+
+def load_questions(input_file: str) -> list:
+    """读取find_huang.py提取出的对话列表"""
+    with open(input_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+async def _finish_episode(tasks: list, writer: CheckpointWriter):
+    """等一集的任务全部完成后关闭其输出"""
+    if tasks:
+        await asyncio.wait(tasks)
+    writer.close()
+    logger.info(f"{writer.output_file} 处理完成")
+
+
+async def validate_episodes(jobs: list, max_concurrent: int = 5, cache=None, resume: bool = False,
+                            adaptive: bool = True, batch_pairs: int = 1, stats=None, backend=None, prefilter=None):
+    """
+    用同一个会话和同一个并发上限处理多集对话，结果按集写入各自的输出文件
+
+    上一集的尾部任务还在进行时就开始提交下一集，避免每集结束时并发降到零。
+
+    :param jobs: (输入文件, 输出文件) 列表
+    :param max_concurrent: 最大并发数
+    :param cache: llm_cache.ResponseCache，为None时不使用缓存
+    :param resume: 是否跳过输出清单中已完成的任务
+    :param adaptive: 是否根据延迟和错误自动调节并发，为False时固定为max_concurrent
+    :param batch_pairs: 每个请求包含的对话条数，大于1时使用批量prompt
+    :param stats: metrics.LLMStats，记录模型调用的指标
+    :param backend: llm_backends中的模型后端，为None时使用HttpBackend
+    :param prefilter: prefilter.Prefilter，预筛已有结论的对话直接写入结果，为None时全部请求
+    """
+    async with AsyncQwenCaller(max_concurrent=max_concurrent, cache=cache, adaptive=adaptive,
+                               stats=stats, backend=backend) as caller:
+        caller.set_progress_bar(0)
+        finishers = []
+
+        for input_file, output_file in jobs:
+            questions = load_questions(input_file)
+            writer = CheckpointWriter(output_file, resume=resume)
+            pending = [question for question in questions if not writer.is_done(make_task_id(question))]
+            logger.info(f"{input_file}: 共 {len(questions)} 条问题记录，待处理 {len(pending)} 条")
+            tasks = await caller.submit_questions(pending, writer, batch_pairs, prefilter)
+            finishers.append(asyncio.create_task(_finish_episode(tasks, writer)))
+
+        await asyncio.gather(*finishers)
+        caller.close_progress()
+
+    if prefilter:
+        prefilter.log_stats()
     logger.info("所有问题处理完成")
 
 
+async def main(input_file: str, output_file: str, max_concurrent: int = 5, cache=None, resume: bool = False):
+    """处理单个文件"""
+    await validate_episodes([(input_file, output_file)], max_concurrent=max_concurrent, cache=cache, resume=resume)
+
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='调用模型校验提取出的对话')
+    parser.add_argument('--start', '-s', type=int, default=1,
+                        help='起始文件编号 (默认: 1)')
+    parser.add_argument('--end', '-e', type=int, default=46,
+                        help='结束文件编号 (默认: 46)')
+    parser.add_argument('--max-concurrent', type=int, default=64,
+                        help='最大并发数 (默认: 64)')
+    parser.add_argument('--batch-pairs', type=int, default=1,
+                        help='每个请求打包的对话条数，大于1时使用批量prompt (默认: 1)')
+    parser.add_argument('--fixed-concurrency', action='store_true',
+                        help='关闭自适应并发，始终使用 --max-concurrent')
+    parser.add_argument('--resume', action='store_true',
+                        help='跳过输出清单中已完成的任务，继续上次中断的运行')
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    add_backend_arguments(parser)
+    add_prefilter_arguments(parser)
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    for i in range(1,47):
-        input_file = f"data/conversion_result/conversion_result{i}.json"
-        output_file = f"data/qwenapi_result/qwenapi_result{i}.json"
-        asyncio.run(main(input_file, output_file, max_concurrent=64))
+    args = parse_arguments()
+    jobs = [
+        (f"data/conversion_result/conversion_result{i}.json", f"data/qwenapi_result/qwenapi_result{i}.json")
+        for i in range(args.start, args.end + 1)
+    ]
+    metrics = metrics_from_args(args)
+    with metrics.stage("validate"):
+        asyncio.run(validate_episodes(jobs, max_concurrent=args.max_concurrent, cache=cache_from_args(args),
+                                      resume=args.resume, adaptive=not args.fixed_concurrency,
+                                      batch_pairs=args.batch_pairs, stats=metrics.llm("validate"),
+                                      backend=backend_from_args(args), prefilter=prefilter_from_args(args)))
+    finish_metrics(metrics, args)
@@ -0,0 +1,311 @@
+"""
+增量重建：只重新计算输入、参数或处理代码发生变化的集和阶段
+
+    python rebuild.py                  # 按默认参数增量重建全部阶段
+    python rebuild.py --gap-ms 1500    # 只改合并间隔：合并及其下游中结果实际变化的集会重建
+    python rebuild.py --dry-run        # 只列出需要重建的目标
+
+各阶段的输入哈希、参数和输出哈希记录在 data/build_state.json（见build_state.py）。
+校验阶段对变化的集只请求新增或改动的对话，未变的对话直接沿用上次的结果。
+"""
+import argparse
+import asyncio
+import json
+import os
+import logging
+
+from build_state import DEFAULT_STATE_PATH, BuildState, source_hash, text_hash
+from checkpoint import retain_tasks, task_id
+from dedup import DEFAULT_THRESHOLD, Deduplicator
+from find_huang import DEFAULT_TRIGGERS, extract_conversions
+from llm_backends import add_backend_arguments, backend_from_args
+from prefilter import add_prefilter_arguments, prefilter_from_args
+from llm_cache import add_cache_arguments, cache_from_args
+from merge_speaker import DEFAULT_GAP_MS, merge_parsed_results, save_merged_results
+from metrics import PipelineMetrics, add_metrics_arguments, metrics_from_args, finish_metrics
+from prompts import VALIDATE_BATCH, VALIDATE_PAIR
+from reshape import (OUTPUT_FORMATS, DEFAULT_FORMAT, DEFAULT_SHARD_SIZE, MANIFEST_NAME, assemble_shards,
+                     iter_result_lines, to_sft_records, write_json_array)
+
+logger = logging.getLogger(__name__)
+
+STAGES = ["parse", "merge", "extract", "validate", "assemble"]
+
+PARSED_DIR = "data/parsed_results"
+MERGED_DIR = "data/merge_results"
+CONVERSION_DIR = "data/conversion_result"
+RESULT_DIR = "data/qwenapi_result"
+
+
+def parsed_file(i):
+    return os.path.join(PARSED_DIR, f"parsed_asr_result{i}.json")
+
+
+def merged_file(i):
+    return os.path.join(MERGED_DIR, f"merged_asr_result{i}.json")
+
+
+def conversion_file(i):
+    return os.path.join(CONVERSION_DIR, f"conversion_result{i}.json")
+
+
+def result_file(i):
+    return os.path.join(RESULT_DIR, f"qwenapi_result{i}.json")
+
+
+def _txt(path):
+    return path.rsplit('.', 1)[0] + '.txt'
+
+
+class Rebuilder:
+    """按阶段顺序检查每集是否需要重建，并只重建过期的目标"""
+
+    def __init__(self, args, state, metrics=None):
+        """
+        :param metrics: metrics.PipelineMetrics，记录各阶段和每集的指标，为None时新建一个
+        """
+        self.args = args
+        self.state = state
+        self.metrics = metrics or PipelineMetrics()
+        self.episodes = list(range(args.start, args.end + 1))
+        # dry-run时上游过期的集，下游也按过期处理
+        self.pending = set()
+        # 阶段 -> (重建数, 目标数)
+        self.summary = {}
+        self.cache = None
+
+    def _stale(self, stage, key, inputs, params):
+        if self.args.force:
+            return True
+        if self.args.dry_run and (key in self.pending or (key == "all" and self.pending)):
+            return True
+        return not self.state.is_fresh(stage, key, inputs, params)
+
+    def _plan(self, stage, targets):
+        """
+        :param targets: (集数, 输入列表, 参数) 列表
+        :return: 过期的 (集数, 输入列表, 参数) 列表；输入缺失的目标跳过
+        """
+        stale = []
+        for key, inputs, params in targets:
+            missing = [path for path in inputs if not os.path.exists(path)]
+            if missing and not (self.args.dry_run and key in self.pending):
+                logger.warning(f"[{stage}] {key} 缺少输入 {missing}，跳过")
+                continue
+            if self._stale(stage, key, inputs, params):
+                stale.append((key, inputs, params))
+        self.summary[stage] = (len(stale), len(targets))
+        logger.info(f"[{stage}] 需要重建 {len(stale)}/{len(targets)}"
+                    + (f": {[key for key, _, _ in stale]}" if stale else ""))
+        if self.args.dry_run:
+            self.pending.update(key for key, _, _ in stale)
+            return []
+        return stale
+
+    def parse(self):
+        from absdata import run_parse_tasks
+
+        params = {"code": source_hash("absdata.py", "asr_decoder.py")}
+        stale = self._plan("parse", [(i, [f"{self.args.input_prefix}{i}.json"], params) for i in self.episodes])
+        tasks = [(inputs[0], PARSED_DIR, os.path.basename(parsed_file(i)), os.path.basename(_txt(parsed_file(i))))
+                 for i, inputs, _ in stale]
+        # 逐个取出解析结果，单进程时每集的解析耗时计入该集
+        results = self.metrics.track("parse", ((i, success) for (i, _, _), (_, success)
+                                               in zip(stale, run_parse_tasks(tasks, self.args.workers))))
+        for (i, inputs, _), (_, success) in zip(stale, results):
+            if success:
+                self.state.record("parse", i, inputs, params, [parsed_file(i), _txt(parsed_file(i))])
+            else:
+                self.state.forget("parse", i)
+
+    def merge(self):
+        params = {"gap_ms": self.args.gap_ms, "code": source_hash("merge_speaker.py")}
+        os.makedirs(MERGED_DIR, exist_ok=True)
+        for i, inputs, _ in self._plan("merge", [(i, [parsed_file(i)], params) for i in self.episodes]):
+            with self.metrics.stage("merge", i) as stats:
+                with open(inputs[0], "r", encoding="utf-8") as f:
+                    parsed = json.load(f)
+                merged = merge_parsed_results(parsed, self.args.gap_ms)
+                save_merged_results(merged, merged_file(i))
+                stats.records_in += sum(len(item["sentences"]) for item in parsed)
+                stats.records_out += sum(len(item["merged_sentences"]) for item in merged)
+            self.state.record("merge", i, inputs, params, [merged_file(i), _txt(merged_file(i))])
+
+    def extract(self):
+        params = {"triggers": list(self.args.triggers), "context": self.args.context,
+                  "code": source_hash("find_huang.py")}
+        os.makedirs(CONVERSION_DIR, exist_ok=True)
+        for i, inputs, _ in self._plan("extract", [(i, [merged_file(i)], params) for i in self.episodes]):
+            with self.metrics.stage("extract", i) as stats:
+                with open(inputs[0], "r", encoding="utf-8") as f:
+                    merged = json.load(f)
+                conversions = extract_conversions(merged, self.args.triggers, self.args.context, episode=i)
+                with open(conversion_file(i), "w", encoding="utf-8") as f:
+                    json.dump(conversions, f, ensure_ascii=False, indent=2)
+                stats.records_in += sum(len(item["merged_sentences"]) for item in merged)
+                stats.records_out += len(conversions)
+            self.state.record("extract", i, inputs, params, [conversion_file(i)])
+
+    def validate(self):
+        # 延迟导入，不到校验阶段时不需要aiohttp和模型日志
+        from qwenapi import validate_episodes
+
+        prefilter = prefilter_from_args(self.args)
+        params = {"prompt": text_hash(VALIDATE_PAIR.system, VALIDATE_PAIR.user,
+                                      VALIDATE_BATCH.system, VALIDATE_BATCH.user),
+                  "prefilter": dict(prefilter.config(), code=source_hash("prefilter.py")) if prefilter else None}
+        stale = self._plan("validate", [(i, [conversion_file(i)], params) for i in self.episodes])
+        if not stale:
+            return
+
+        expected = {}
+        kept = 0
+        for i, inputs, _ in stale:
+            with open(inputs[0], "r", encoding="utf-8") as f:
+                expected[i] = {task_id(question) for question in json.load(f)}
+            previous = self.state.previous_params("validate", i)
+            if previous in (None, params) and not self.args.force:
+                # prompt未变（或没有记录，沿用已有结果）：保留仍然存在的对话的结果，续跑时只请求新增的对话
+                kept += retain_tasks(result_file(i), expected[i])
+            elif not self.args.force and previous.get("prompt") == params["prompt"]:
+                # 只有预筛变了：模型给出的结果仍然有效，只重新判定预筛直接给出的结果
+                kept += retain_tasks(result_file(i), expected[i],
+                                     lambda record: record.get("source") != "prefilter")
+            else:
+                for path in (result_file(i), result_file(i) + ".done"):
+                    if os.path.exists(path):
+                        os.remove(path)
+        logger.info(f"[validate] 沿用上次结果 {kept} 条，"
+                    f"待请求 {sum(len(ids) for ids in expected.values()) - kept} 条")
+
+        jobs = [(conversion_file(i), result_file(i)) for i, _, _ in stale]
+        asyncio.run(validate_episodes(jobs, max_concurrent=self.args.max_concurrent, cache=self.cache,
+                                      resume=True, batch_pairs=self.args.batch_pairs,
+                                      stats=self.metrics.llm("validate"), backend=backend_from_args(self.args),
+                                      prefilter=prefilter))
+
+        for i, inputs, _ in stale:
+            done = set()
+            if os.path.exists(result_file(i) + ".done"):
+                with open(result_file(i) + ".done", "r", encoding="utf-8") as f:
+                    done = {line.strip() for line in f}
+            # 有失败或不合格的对话时不记为最新，下次重建会只补这些对话
+            complete = expected[i] <= done and not os.path.exists(result_file(i) + ".rejects")
+            self.metrics.count("validate", i, len(expected[i]), len(expected[i] & done))
+            if not complete:
+                logger.warning(f"[validate] 第{i}集还有 {len(expected[i] - done)} 条对话未完成")
+            self.state.record("validate", i, inputs, params, [result_file(i)], complete)
+
+    def assemble(self):
+        args = self.args
+        inputs = [result_file(i) for i in self.episodes if os.path.exists(result_file(i))]
+        params = {"format": args.format, "shard_size": args.shard_size, "val_ratio": args.val_ratio,
+                  "dedup": None if args.no_dedup else args.dedup_threshold,
+                  "code": source_hash("reshape.py", "dedup.py")}
+        stale = self._plan("assemble", [("all", inputs, params)])
+        if not stale:
+            return
+
+        def result_lines(i):
+            for line in iter_result_lines(result_file(i)):
+                self.metrics.count("assemble", records_in=1)
+                yield line
+
+        dedup = None if args.no_dedup else Deduplicator(args.dedup_threshold)
+        episodes = ((i, to_sft_records(result_lines(i)))
+                    for i in self.episodes if os.path.exists(result_file(i)))
+        if args.format == "json":
+            records = (record for _, rows in episodes for record in rows)
+            if dedup is not None:
+                records = dedup.filter(records)
+            self.metrics.count("assemble", records_out=write_json_array(records, args.output))
+            outputs = [args.output]
+        else:
+            manifest = assemble_shards(episodes, args.shard_dir, args.format, args.shard_size,
+                                       args.val_ratio, dedup=dedup)
+            self.metrics.count("assemble", records_out=manifest["records"])
+            outputs = [os.path.join(args.shard_dir, MANIFEST_NAME)] + [
+                os.path.join(args.shard_dir, shard["file"])
+                for split in manifest["splits"].values() for shard in split["shards"]
+            ]
+        if dedup is not None:
+            dedup.log_stats()
+            dedup.close()
+        self.state.record("assemble", "all", inputs, params, outputs)
+
+    def run(self, stop_after="assemble", cache=None):
+        self.cache = cache
+        for stage in STAGES[:STAGES.index(stop_after) + 1]:
+            with self.metrics.stage(stage):
+                getattr(self, stage)()
+            if not self.args.dry_run:
+                # 每个阶段完成后保存，中断后已完成的阶段不必重做
+                self.state.save()
+
+
+def parse_arguments():
+    """
+    解析命令行参数
+
+    :return: 解析后的参数
+    """
+    parser = argparse.ArgumentParser(description='按输入内容哈希和参数增量重建各阶段的结果')
+    parser.add_argument('--input-prefix', '-i', type=str, default="data/asr_result",
+                        help='ASR原始结果的文件前缀 (默认: data/asr_result)')
+    parser.add_argument('--start', '-s', type=int, default=1,
+                        help='起始文件编号 (默认: 1)')
+    parser.add_argument('--end', '-e', type=int, default=46,
+                        help='结束文件编号 (默认: 46)')
+    parser.add_argument('--stop-after', type=str, default="assemble", choices=STAGES,
+                        help='重建到哪个阶段为止 (默认: assemble)')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help='解析阶段的进程数 (默认: 1)')
+    parser.add_argument('--gap-ms', type=int, default=DEFAULT_GAP_MS,
+                        help=f'合并阶段的间隔阈值（毫秒） (默认: {DEFAULT_GAP_MS})')
+    parser.add_argument('--triggers', type=str, nargs='+', default=list(DEFAULT_TRIGGERS),
+                        help='提取阶段的触发词列表 (默认: 朕)')
+    parser.add_argument('--context', type=int, default=1,
+                        help='提取阶段前文包含的轮数 (默认: 1)')
+    parser.add_argument('--max-concurrent', type=int, default=64,
+                        help='模型调用的最大并发数 (默认: 64)')
+    parser.add_argument('--batch-pairs', type=int, default=1,
+                        help='校验阶段每个请求打包的对话条数 (默认: 1)')
+    parser.add_argument('--format', type=str, default=DEFAULT_FORMAT, choices=OUTPUT_FORMATS,
+                        help=f'组装阶段的输出格式 (默认: {DEFAULT_FORMAT})')
+    parser.add_argument('--output', '-o', type=str, default=os.path.join(RESULT_DIR, "qwenapi_result.json"),
+                        help='--format json时的输出文件')
+    parser.add_argument('--shard-dir', type=str, default="data/sft",
+                        help='分片输出目录 (默认: data/sft)')
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE,
+                        help=f'每个分片的记录数 (默认: {DEFAULT_SHARD_SIZE})')
+    parser.add_argument('--val-ratio', type=float, default=0.0,
+                        help='按集划入验证集的比例 (默认: 0)')
+    parser.add_argument('--dedup-threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f'近似去重的相似度阈值 (默认: {DEFAULT_THRESHOLD})')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='组装时不去重')
+    parser.add_argument('--state', type=str, default=DEFAULT_STATE_PATH,
+                        help='构建状态文件 (默认: data/build_state.json)')
+    parser.add_argument('--force', action='store_true',
+                        help='忽略构建状态，全部重建')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='只列出需要重建的目标，不执行')
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+    add_backend_arguments(parser)
+    add_prefilter_arguments(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    args = parse_arguments()
+    rebuilder = Rebuilder(args, BuildState(args.state), metrics_from_args(args))
+    rebuilder.run(args.stop_after, None if args.dry_run else cache_from_args(args))
+    for stage, (stale, total) in rebuilder.summary.items():
+        logger.info(f"{stage}: 重建 {stale}/{total}")
+    if not args.dry_run:
+        finish_metrics(rebuilder.metrics, args)
@@ -1,25 +1,302 @@
 import json
 import os
+import re
+import hashlib
+import argparse
+import logging
 
-base_dir = "data/qwenapi_result"
-data_list = []
-for file in os.listdir(base_dir):
-    print(file)
-    if file=="qwenapi_result.json":
-        continue
-    with open(os.path.join(base_dir, file), "r", encoding="utf-8") as f:
+from dedup import DEFAULT_THRESHOLD, Deduplicator
+
+logger = logging.getLogger(__name__)
+
+SHARD_FORMATS = ("jsonl", "parquet", "arrow")
+# 组装输出的格式：json为单个JSON数组文件，其余按集分片；各脚本默认都输出json，与原先的qwenapi_result.json一致
+OUTPUT_FORMATS = ("json",) + SHARD_FORMATS
+DEFAULT_FORMAT = "json"
+DEFAULT_SHARD_SIZE = 100000
+MANIFEST_NAME = "manifest.json"
+
+def to_sft_records(rows):
+    """
+    将qwenapi结果中判定为"是"的对话转换为SFT训练数据
+    
+    :param rows: qwenapi结果的字典（可迭代）
+    :return: 生成instruction/input/output格式的记录
+    """
+    for data in rows:
+        # 旧版本的结果文件里可能混有模型的原始回答字符串
+        if isinstance(data, dict) and data.get("result") == "是":
+            yield {"instruction":"",
+                   "input":data["input"],
+                   "output":data["output"]}
+
+def write_json_array(records, output_file):
+    """
+    逐条写出JSON数组，不在内存中保留全部记录
+
+    :param records: 记录迭代器
+    :param output_file: 输出文件路径
+    :return: 写出的记录数
+    """
+    output_dir = os.path.dirname(output_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    count = 0
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write("[")
+        for record in records:
+            f.write(",\n    " if count else "\n    ")
+            f.write(json.dumps(record, ensure_ascii=False, indent=4).replace("\n", "\n    "))
+            count += 1
+        f.write("\n]" if count else "]")
+    return count
+
+def iter_result_lines(path):
+    """
+    逐行读取qwenapi结果文件，跳过无法解析的行
+    
+    :param path: qwenapi结果文件路径（每行一个JSON）
+    """
+    with open(path, "r", encoding="utf-8") as f:
         for line in f:
             try:
-                data = json.loads(line)
-            
-                print(data)
-
-                if data["result"] == "是":
-                    data_list.append({"instruction":"",
-                                    "input":data["input"],
-                                    "output":data["output"]})
-            except Exception as e:
+                yield json.loads(line)
+            except json.JSONDecodeError:
                 continue
-with open("data/qwenapi_result/qwenapi_result.json", "w", encoding="utf-8") as f:
-    json.dump(data_list, f, ensure_ascii=False, indent=4)
 
+def iter_result_files(base_dir):
+    """
+    按集数顺序列出qwenapi结果文件
+
+    :param base_dir: qwenapi结果目录
+    :return: 生成 (集数, 文件路径)；跳过汇总文件和断点续跑的清单/拒绝记录
+    """
+    episodes = []
+    for file in os.listdir(base_dir):
+        match = re.fullmatch(r"qwenapi_result(\d+)\.json", file)
+        if match:
+            episodes.append((int(match.group(1)), os.path.join(base_dir, file)))
+    yield from sorted(episodes)
+
+
+def episode_split(episode, val_ratio=0.0, val_episodes=(), seed=0):
+    """
+    按集数决定划入训练集还是验证集，同一集的对话不会同时出现在两边
+
+    :param episode: 集数编号
+    :param val_ratio: 随机划入验证集的集数比例（按集数哈希，结果与处理顺序无关）
+    :param val_episodes: 固定划入验证集的集数
+    :param seed: 哈希种子，换种子得到另一种划分
+    :return: "train" 或 "val"
+    """
+    if episode in val_episodes:
+        return "val"
+    if val_ratio <= 0:
+        return "train"
+    digest = hashlib.sha1(f"{seed}:{episode}".encode("utf-8")).digest()
+    return "val" if int.from_bytes(digest[:4], "big") / 2 ** 32 < val_ratio else "train"
+
+
+def _file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class ShardWriter:
+    """
+    把一个split的记录按条数切分写成多个分片
+
+    jsonl逐行写出；parquet和arrow（IPC文件，可直接内存映射）每个分片在内存中攒满后一次写出，
+    内存占用不超过一个分片。
+    """
+
+    def __init__(self, output_dir, split, fmt="jsonl", shard_size=DEFAULT_SHARD_SIZE):
+        """
+        :param output_dir: 输出目录
+        :param split: 分片文件名前缀，如train/val
+        :param fmt: jsonl、parquet或arrow
+        :param shard_size: 每个分片的记录数
+        """
+        if fmt not in SHARD_FORMATS:
+            raise ValueError(f"不支持的分片格式: {fmt}")
+        if fmt != "jsonl":
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ImportError(f"写出{fmt}分片需要安装pyarrow") from None
+        self.output_dir = output_dir
+        self.split = split
+        self.fmt = fmt
+        self.shard_size = shard_size
+        self.shards = []
+        self._buffer = []
+        self._file = None
+        self._sha = None
+        self._count = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+    @property
+    def records(self):
+        return sum(shard["records"] for shard in self.shards) + self._count
+
+    def _shard_path(self):
+        return os.path.join(self.output_dir, f"{self.split}-{len(self.shards):05d}.{self.fmt}")
+
+    def write(self, record):
+        if self.fmt == "jsonl":
+            if self._file is None:
+                self._file = open(self._shard_path(), "wb")
+                self._sha = hashlib.sha256()
+            line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+            self._file.write(line)
+            self._sha.update(line)
+        else:
+            self._buffer.append(record)
+        self._count += 1
+        if self._count >= self.shard_size:
+            self._finish_shard()
+
+    def _finish_shard(self):
+        if not self._count:
+            return
+        path = self._shard_path()
+        if self.fmt == "jsonl":
+            self._file.close()
+            self._file = None
+            checksum = self._sha.hexdigest()
+        else:
+            import pyarrow as pa
+
+            table = pa.Table.from_pylist(self._buffer)
+            if self.fmt == "parquet":
+                import pyarrow.parquet as pq
+
+                pq.write_table(table, path)
+            else:
+                with pa.ipc.new_file(path, table.schema) as writer:
+                    writer.write_table(table)
+            self._buffer = []
+            checksum = _file_sha256(path)
+        self.shards.append({
+            "file": os.path.basename(path),
+            "records": self._count,
+            "bytes": os.path.getsize(path),
+            "sha256": checksum,
+        })
+        logger.info(f"已写出分片 {path}（{self._count} 条）")
+        self._count = 0
+
+    def close(self):
+        self._finish_shard()
+        return self.shards
+
+
+def assemble_shards(episodes, output_dir, fmt="jsonl", shard_size=DEFAULT_SHARD_SIZE,
+                    val_ratio=0.0, val_episodes=(), seed=0, dedup=None):
+    """
+    流式组装训练数据：逐集去重、按集划分train/val，写出分片和清单（manifest.json）
+
+    :param episodes: 生成 (集数, SFT记录迭代器)
+    :param output_dir: 输出目录
+    :param fmt: 分片格式，jsonl、parquet或arrow
+    :param shard_size: 每个分片的记录数
+    :param val_ratio: 划入验证集的集数比例
+    :param val_episodes: 固定划入验证集的集数
+    :param seed: 划分用的哈希种子
+    :param dedup: dedup.Deduplicator，为None时不去重；两个split共用，验证集不会与训练集重复
+    :return: 清单字典
+    """
+    val_episodes = set(val_episodes)
+    writers = {}
+    split_episodes = {}
+    for episode, records in episodes:
+        split = episode_split(episode, val_ratio, val_episodes, seed)
+        if split not in writers:
+            writers[split] = ShardWriter(output_dir, split, fmt, shard_size)
+            split_episodes[split] = []
+        split_episodes[split].append(episode)
+        if dedup is not None:
+            records = dedup.filter(records)
+        for record in records:
+            writers[split].write(record)
+
+    manifest = {
+        "format": fmt,
+        "shard_size": shard_size,
+        "val_ratio": val_ratio,
+        "seed": seed,
+        "records": 0,
+        "splits": {},
+    }
+    for split, writer in writers.items():
+        shards = writer.close()
+        manifest["splits"][split] = {
+            "records": writer.records,
+            "episodes": split_episodes[split],
+            "shards": shards,
+        }
+        manifest["records"] += writer.records
+    if dedup is not None:
+        manifest["dedup"] = dict(dedup.stats, threshold=dedup.threshold)
+
+    with open(os.path.join(output_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+def parse_arguments():
+    """
+    解析命令行参数
+
+    :return: 解析后的参数
+    """
+    parser = argparse.ArgumentParser(description='把qwenapi结果组装成SFT训练数据')
+    parser.add_argument('--input-dir', '-i', type=str, default="data/qwenapi_result",
+                        help='qwenapi结果目录 (默认: data/qwenapi_result)')
+    parser.add_argument('--output-dir', '-o', type=str, default="data/sft",
+                        help='分片和manifest.json的输出目录 (默认: data/sft)')
+    parser.add_argument('--format', type=str, default=DEFAULT_FORMAT, choices=OUTPUT_FORMATS,
+                        help=f'输出格式；json为单个JSON数组，写到 --json-output，其余分片写到 --output-dir (默认: {DEFAULT_FORMAT})')
+    parser.add_argument('--json-output', type=str, default="data/qwenapi_result/qwenapi_result.json",
+                        help='--format json时的输出文件')
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE,
+                        help=f'每个分片的记录数 (默认: {DEFAULT_SHARD_SIZE})')
+    parser.add_argument('--val-ratio', type=float, default=0.0,
+                        help='按集划入验证集的比例 (默认: 0，不划分)')
+    parser.add_argument('--val-episodes', type=int, nargs='*', default=[],
+                        help='固定划入验证集的集数')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='划分用的哈希种子 (默认: 0)')
+    parser.add_argument('--dedup-threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f'近似去重的相似度阈值 (默认: {DEFAULT_THRESHOLD})')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='不做去重')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_arguments()
+
+    dedup = None if args.no_dedup else Deduplicator(args.dedup_threshold)
+    episodes = (
+        (episode, to_sft_records(iter_result_lines(path)))
+        for episode, path in iter_result_files(args.input_dir)
+    )
+    if args.format == "json":
+        records = (record for _, rows in episodes for record in rows)
+        if dedup is not None:
+            records = dedup.filter(records)
+        count = write_json_array(records, args.json_output)
+        logger.info(f"共写出 {count} 条训练数据: {args.json_output}")
+    else:
+        manifest = assemble_shards(episodes, args.output_dir, args.format, args.shard_size,
+                                   args.val_ratio, args.val_episodes, args.seed, dedup)
+        for split, info in manifest["splits"].items():
+            logger.info(f"{split}: {info['records']} 条，{len(info['shards'])} 个分片，{len(info['episodes'])} 集")
+    if dedup is not None:
+        dedup.log_stats()
+        dedup.close()
@@ -0,0 +1,163 @@
+"""
+模型回答的解析：从（流式）回答中截取第一个完整的JSON值，并按字段要求校验
+"""
+import json
+import time
+
+
+class ResponseParseError(ValueError):
+    """回答不是合格的JSON，或缺少要求的字段"""
+
+    def __init__(self, message, raw=None):
+        super().__init__(message)
+        self.raw = raw
+
+
+class JsonScanner:
+    """
+    增量扫描文本，找到第一个完整的JSON对象或数组
+
+    逐块feed模型输出，顶层括号闭合时complete变为True，此时可以停止生成。
+    代码块标记（```json）和JSON前后的说明文字会被忽略。
+    """
+
+    def __init__(self):
+        self.buffer = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.started = False
+        self.complete = False
+
+    def feed(self, chunk):
+        """
+        追加一段输出
+
+        :param chunk: 新的文本片段
+        :return: 是否已经得到完整的JSON
+        """
+        for char in chunk:
+            if self.complete:
+                break
+            if not self.started:
+                if char not in "{[":
+                    continue
+                self.started = True
+            self.buffer.append(char)
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.complete = True
+        return self.complete
+
+    @property
+    def text(self):
+        return "".join(self.buffer)
+
+
+def extract_json(text):
+    """
+    取出文本中的第一个完整JSON值
+
+    :param text: 模型回答
+    :return: JSON文本
+    :raises ResponseParseError: 找不到完整的JSON
+    """
+    scanner = JsonScanner()
+    if not scanner.feed(text or ""):
+        raise ResponseParseError("回答中没有完整的JSON", raw=text)
+    return scanner.text
+
+
+def check_record(record, keys):
+    """
+    校验一条结果包含全部字段且字段值为字符串
+
+    :raises ResponseParseError: 校验失败
+    """
+    if not isinstance(record, dict):
+        raise ResponseParseError(f"期望JSON对象，实际是 {type(record).__name__}")
+    missing = [key for key in keys if key not in record]
+    if missing:
+        raise ResponseParseError(f"缺少字段: {', '.join(missing)}")
+    wrong = [key for key in keys if key != "index" and not isinstance(record[key], str)]
+    if wrong:
+        raise ResponseParseError(f"字段不是字符串: {', '.join(wrong)}")
+
+
+def parse_json(text, keys, many=False):
+    """
+    解析并校验模型回答
+
+    :param text: 模型回答（可带代码块标记和说明文字）
+    :param keys: 每条结果必须包含的字段
+    :param many: 为True时回答应是结果数组
+    :return: 只保留要求字段的字典，many为True时为字典列表
+    :raises ResponseParseError: 解析或校验失败，raw属性为原始回答
+    """
+    try:
+        value = json.loads(extract_json(text))
+        records = value if many else [value]
+        if many and not isinstance(value, list):
+            raise ResponseParseError(f"期望JSON数组，实际是 {type(value).__name__}")
+        for record in records:
+            check_record(record, keys)
+    except (json.JSONDecodeError, ResponseParseError) as e:
+        raise ResponseParseError(str(e), raw=text) from None
+
+    cleaned = [{key: record[key] for key in keys} for record in records]
+    return cleaned if many else cleaned[0]
+
+
+async def read_sse_json(response, trace=None):
+    """
+    读取chat/completions的流式（SSE）回答，得到完整JSON后立即停止
+
+    返回后由调用方关闭连接，推理服务检测到断开会中止这次生成。
+
+    :param response: aiohttp响应对象（请求体中stream为True）
+    :param trace: 可选的字典，写入first_token（收到首块回答时的time.monotonic()）和tokens（生成的token数）
+    :return: 截取到的JSON文本；没有完整JSON时返回全部输出
+    """
+    if trace is None:
+        trace = {}
+    if response.content_type == "application/json":
+        # 服务端不支持流式时会直接返回完整回答
+        body = await response.json()
+        trace["first_token"] = time.monotonic()
+        trace["tokens"] = (body.get("usage") or {}).get("completion_tokens", 0)
+        return body["choices"][0]["message"].get("content")
+
+    scanner = JsonScanner()
+    parts = []
+    async for line in response.content:
+        line = line.strip()
+        if not line.startswith(b"data:"):
+            continue
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            break
+        choices = json.loads(data).get("choices") or [{}]
+        delta = choices[0].get("delta", {}).get("content")
+        if not delta:
+            continue
+        if not parts:
+            trace["first_token"] = time.monotonic()
+        # 推理服务一般每块一个token
+        trace["tokens"] = trace.get("tokens", 0) + 1
+        parts.append(delta)
+        if scanner.feed(delta):
+            return scanner.text
+    return "".join(parts)
+
@@ -0,0 +1,295 @@
+"""
+合并结果的全文和时间范围检索
+
+索引是一个SQLite数据库：
+- turns: 每轮一行（集数、条目、轮次、说话人、起止时间、文本），(speaker, episode, start_ms) 上建B树索引，
+  作为按说话人的倒排
+- turn_text: FTS5倒排索引，每轮的文本先用jieba（搜索引擎模式）分词，只存词不存原文
+- turn_spans: R*树区间索引，每轮是 (集数, 集数) × (start_ms, end_ms) 的矩形
+
+各条件都由对应的索引求出，由SQLite按选择性决定先走哪个；查询耗时与命中数相关，与总集数基本无关。
+新增或改动的集按源文件的大小和修改时间识别，update只重建这些集。
+"""
+import os
+import re
+import sqlite3
+import sys
+import time
+import argparse
+import logging
+
+import jieba
+
+from corpus import DEFAULT_CORPUS_DIR, load_episode, source_signature
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "search_index.sqlite")
+DEFAULT_LIMIT = 100
+_WORD = re.compile(r"[\w一-鿿]")
+
+jieba.setLogLevel(logging.WARNING)
+
+
+def tokenize(text, for_search=True):
+    """
+    分词并去掉标点和空白
+
+    :param for_search: 为True时用搜索引擎模式（长词再切出其中的短词），建索引时使用
+    :return: 去重后的词列表
+    """
+    words = jieba.cut_for_search(text) if for_search else jieba.cut(text)
+    return list(dict.fromkeys(word for word in words if _WORD.search(word)))
+
+
+def _match_query(words):
+    """把词列表拼成FTS5查询，各词都要出现"""
+    return " ".join('"' + word.replace('"', '""') + '"' for word in words)
+
+
+def parse_time(value):
+    """
+    解析时间，支持毫秒数、mm:ss和hh:mm:ss（秒可带小数）
+
+    :return: 毫秒数
+    """
+    if re.fullmatch(r"\d+", value):
+        return int(value)
+    parts = value.split(":")
+    if not 2 <= len(parts) <= 3:
+        raise ValueError(f"无法解析的时间: {value}")
+    seconds = 0.0
+    for part in parts:
+        seconds = seconds * 60 + float(part)
+    return round(seconds * 1000)
+
+
+def format_time(ms):
+    minutes, ms = divmod(ms, 60000)
+    return f"{minutes:02d}:{ms / 1000:04.1f}"
+
+
+def parse_episodes(value):
+    """
+    解析集数范围，如"5-12"或"7"
+
+    :return: (起, 止)，都包含
+    """
+    match = re.fullmatch(r"(\d+)(?:-(\d+))?", value)
+    if not match:
+        raise ValueError(f"无法解析的集数范围: {value}")
+    start = int(match.group(1))
+    return start, int(match.group(2) or start)
+
+
+class SearchIndex:
+    """合并结果的检索索引，可以逐集增量更新"""
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        """
+        :param path: 索引数据库路径，不存在时新建
+        """
+        self.path = path
+        # 分词词典在第一次分词时才加载（约1秒），提前加载，不计入第一次查询
+        jieba.initialize()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS episodes (
+                episode INTEGER PRIMARY KEY,
+                signature TEXT,
+                turns INTEGER NOT NULL,
+                indexed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS turns (
+                id INTEGER PRIMARY KEY,
+                episode INTEGER NOT NULL,
+                item INTEGER NOT NULL,
+                turn INTEGER NOT NULL,
+                speaker TEXT NOT NULL,
+                start_ms INTEGER NOT NULL,
+                end_ms INTEGER NOT NULL,
+                text TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS turns_episode ON turns(episode, start_ms);
+            CREATE INDEX IF NOT EXISTS turns_speaker ON turns(speaker, episode, start_ms);
+            CREATE VIRTUAL TABLE IF NOT EXISTS turn_text USING fts5(words, content='', detail='none');
+            CREATE VIRTUAL TABLE IF NOT EXISTS turn_spans USING rtree_i32(id, episode_min, episode_max,
+                                                                          start_ms, end_ms);
+        """)
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def signatures(self):
+        """已索引的集数 -> 来源标识"""
+        return dict(self.conn.execute("SELECT episode, signature FROM episodes").fetchall())
+
+    def remove_episode(self, episode):
+        """删除一集的索引；FTS5表不存原文，删除时按原文重新分词"""
+        rows = self.conn.execute("SELECT id, text FROM turns WHERE episode = ?", (episode,)).fetchall()
+        self.conn.executemany("INSERT INTO turn_text(turn_text, rowid, words) VALUES('delete', ?, ?)",
+                              ((row["id"], " ".join(tokenize(row["text"]))) for row in rows))
+        self.conn.execute("DELETE FROM turn_spans WHERE id IN (SELECT id FROM turns WHERE episode = ?)", (episode,))
+        self.conn.execute("DELETE FROM turns WHERE episode = ?", (episode,))
+        self.conn.execute("DELETE FROM episodes WHERE episode = ?", (episode,))
+
+    def add_episode(self, episode, merged_results, signature=None):
+        """
+        索引一集的合并结果，已有的同一集先删除
+
+        :param episode: 集数编号
+        :param merged_results: merge_speaker.py的合并结果
+        :param signature: 来源标识，update据此判断是否需要重建
+        :return: 索引的轮数
+        """
+        self.remove_episode(episode)
+        count = 0
+        for item_index, item in enumerate(merged_results):
+            for turn in item.get("merged_sentences", []):
+                cursor = self.conn.execute(
+                    "INSERT INTO turns(episode, item, turn, speaker, start_ms, end_ms, text) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (episode, item_index, count, turn["speaker"], turn["start_ms"], turn["end_ms"], turn["text"]))
+                self.conn.execute("INSERT INTO turn_text(rowid, words) VALUES (?, ?)",
+                                  (cursor.lastrowid, " ".join(tokenize(turn["text"]))))
+                self.conn.execute("INSERT INTO turn_spans VALUES (?, ?, ?, ?, ?)",
+                                  (cursor.lastrowid, episode, episode, turn["start_ms"], turn["end_ms"]))
+                count += 1
+        self.conn.execute("INSERT INTO episodes VALUES (?, ?, ?, ?)", (episode, signature, count, time.time()))
+        self.conn.commit()
+        return count
+
+    def update(self, episodes, corpus_dir=DEFAULT_CORPUS_DIR):
+        """
+        索引新出现或来源有变化的集，来源已不存在的集从索引中删除
+
+        :param episodes: 需要检查的集数编号
+        :param corpus_dir: 语料库目录，合并结果优先从这里读取
+        :return: (新增集数, 重建集数, 删除集数)
+        """
+        known = self.signatures()
+        added = rebuilt = removed = 0
+        for i in episodes:
+            signature = source_signature("merged", i, corpus_dir)
+            if signature is None:
+                if i in known:
+                    self.remove_episode(i)
+                    self.conn.commit()
+                    removed += 1
+                continue
+            if known.get(i) == signature:
+                continue
+            count = self.add_episode(i, load_episode("merged", i, corpus_dir), signature)
+            logger.info(f"{'重建' if i in known else '新增'}第{i}集索引: {count} 轮")
+            if i in known:
+                rebuilt += 1
+            else:
+                added += 1
+        return added, rebuilt, removed
+
+    def search(self, text=None, speaker=None, episodes=None, start_ms=None, end_ms=None, limit=DEFAULT_LIMIT):
+        """
+        按条件检索对话轮次，各条件同时满足
+
+        :param text: 要包含的文本，分词后各词都要出现；分词后没有任何词（如只有标点）时不匹配任何轮次
+        :param speaker: 说话人
+        :param episodes: (起, 止) 集数范围，都包含
+        :param start_ms: 与该时间之后有重叠的轮次（毫秒）
+        :param end_ms: 与该时间之前有重叠的轮次（毫秒）
+        :param limit: 最多返回的条数，按集数和开始时间排序
+        :return: 字典列表，包含episode、item、turn、speaker、start_ms、end_ms、text
+        """
+        # 全文和区间条件写成 id IN (子查询)，各自只求值一次得到轮次编号集合，
+        # 避免SQLite沿说话人索引逐行回查FTS5（每次回查都要重新求值MATCH）
+        where, params = [], []
+        if text:
+            words = tokenize(text, for_search=False)
+            if not words:
+                return []
+            where.append("t.id IN (SELECT rowid FROM turn_text WHERE turn_text MATCH ?)")
+            params.append(_match_query(words))
+        if start_ms is not None or end_ms is not None:
+            low, high = episodes if episodes is not None else (-2 ** 31, 2 ** 31 - 1)
+            where.append("t.id IN (SELECT id FROM turn_spans WHERE episode_max >= ? AND episode_min <= ? "
+                         "AND end_ms >= ? AND start_ms <= ?)")
+            params += [low, high, start_ms if start_ms is not None else -2 ** 31,
+                       end_ms if end_ms is not None else 2 ** 31 - 1]
+        elif episodes is not None:
+            where.append("t.episode BETWEEN ? AND ?")
+            params += list(episodes)
+        if speaker is not None:
+            where.append("t.speaker = ?")
+            params.append(speaker)
+        sql = (f"SELECT t.episode, t.item, t.turn, t.speaker, t.start_ms, t.end_ms, t.text FROM turns t "
+               f"{'WHERE ' + ' AND '.join(where) if where else ''} ORDER BY t.episode, t.start_ms LIMIT ?")
+        return [dict(row) for row in self.conn.execute(sql, params + [limit])]
+
+    def stats(self):
+        episodes, turns = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(turns), 0) FROM episodes").fetchone()
+        speakers = self.conn.execute("SELECT COUNT(DISTINCT speaker) FROM turns").fetchone()[0]
+        return {"episodes": episodes, "turns": turns, "speakers": speakers,
+                "bytes": os.path.getsize(self.path)}
+
+    def close(self):
+        self.conn.close()
+
+
+def parse_arguments():
+    """
+    解析命令行参数
+
+    :return: 解析后的参数
+    """
+    parser = argparse.ArgumentParser(description='检索合并结果中的对话轮次')
+    parser.add_argument('command', choices=["update", "query", "stats"],
+                        help='update: 增量更新索引；query: 检索；stats: 统计')
+    parser.add_argument('text', nargs='?', default=None,
+                        help='query: 要包含的文本')
+    parser.add_argument('--index', type=str, default=DEFAULT_INDEX_PATH,
+                        help='索引数据库路径 (默认: data/search_index.sqlite)')
+    parser.add_argument('--corpus-dir', type=str, default=DEFAULT_CORPUS_DIR,
+                        help=f'语料库目录，合并结果优先从这里读取 (默认: {DEFAULT_CORPUS_DIR})')
+    parser.add_argument('--start', '-s', type=int, default=1,
+                        help='update: 起始文件编号 (默认: 1)')
+    parser.add_argument('--end', '-e', type=int, default=46,
+                        help='update: 结束文件编号 (默认: 46)')
+    parser.add_argument('--speaker', type=str, default=None,
+                        help='query: 说话人，如 Speaker_2')
+    parser.add_argument('--episodes', type=parse_episodes, default=None,
+                        help='query: 集数范围，如 5-12')
+    parser.add_argument('--from', dest='from_time', type=parse_time, default=None,
+                        help='query: 起始时间，如 10:00 或毫秒数')
+    parser.add_argument('--to', dest='to_time', type=parse_time, default=None,
+                        help='query: 结束时间，如 20:00 或毫秒数')
+    parser.add_argument('--limit', '-n', type=int, default=DEFAULT_LIMIT,
+                        help=f'query: 最多返回的条数 (默认: {DEFAULT_LIMIT})')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    args = parse_arguments()
+    with SearchIndex(args.index) as index:
+        if args.command == "update":
+            added, rebuilt, removed = index.update(range(args.start, args.end + 1), args.corpus_dir)
+            logger.info(f"索引更新完成: 新增 {added} 集, 重建 {rebuilt} 集, 删除 {removed} 集")
+        elif args.command == "stats":
+            print(index.stats())
+        else:
+            started = time.perf_counter()
+            rows = index.search(args.text, args.speaker, args.episodes, args.from_time, args.to_time, args.limit)
+            elapsed = (time.perf_counter() - started) * 1000
+            for row in rows:
+                print(f"第{row['episode']}集 {format_time(row['start_ms'])}-{format_time(row['end_ms'])} "
+                      f"{row['speaker']}: {row['text']}")
+            print(f"共 {len(rows)} 条，用时 {elapsed:.1f} ms", file=sys.stderr)
@@ -0,0 +1,350 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import argparse
+import logging
+from array import array
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORE_DIR = "data/sentence_store"
+MAGIC = b"SSTORE01"
+# magic, flags, n_items, n_sentences, n_turns, meta_len, text_len
+_HEADER = struct.Struct("<8sIIIIIQ")
+_FLAG_MERGED = 1
+_ALIGN = 8
+
+for _code, _size in (("H", 2), ("i", 4), ("I", 4)):
+    assert array(_code).itemsize == _size, f"array('{_code}') 的大小不是 {_size} 字节"
+
+
+def _padding(offset):
+    return -offset % _ALIGN
+
+
+class SentenceStore:
+    """
+    按列存储的句子集合，替代parsed/merged结果中逐句的字典
+
+    - speaker: 说话人编号（uint16，对应speakers中的名称）
+    - start_ms / end_ms: 起止时间（int32）
+    - text_offsets: 每句在text_buffer中的字节偏移（n+1个）
+    - item_offsets: 每个条目（一集中的一个key）的句子范围（n_items+1个）
+    - turn_offsets / item_turn_offsets: 合并后的对话轮次，每轮对应一段连续的句子
+    """
+
+    def __init__(self, keys, item_texts, speakers, item_offsets, speaker, start_ms, end_ms,
+                 text_offsets, text_buffer, turn_offsets=None, item_turn_offsets=None, _mmap=None):
+        self.keys = keys
+        self.item_texts = item_texts
+        self.speakers = speakers
+        self.item_offsets = item_offsets
+        self.speaker = speaker
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.text_offsets = text_offsets
+        self.text_buffer = text_buffer
+        self.turn_offsets = turn_offsets
+        self.item_turn_offsets = item_turn_offsets
+        self._mmap = _mmap
+
+    # ---- 构建 ----
+
+    @classmethod
+    def from_parsed_results(cls, results):
+        """
+        由absdata.py的解析结果构建
+
+        :param results: 解析结果列表，每项包含key、text和sentences
+        """
+        speakers = []
+        speaker_ids = {}
+        item_offsets = array("I", [0])
+        speaker = array("H")
+        start_ms = array("i")
+        end_ms = array("i")
+        text_offsets = array("I", [0])
+        text_parts = []
+        text_len = 0
+
+        for item in results:
+            for sentence in item.get("sentences", []):
+                name = sentence["speaker"]
+                if name not in speaker_ids:
+                    speaker_ids[name] = len(speakers)
+                    speakers.append(name)
+                speaker.append(speaker_ids[name])
+                start_ms.append(sentence["start_ms"])
+                end_ms.append(sentence["end_ms"])
+                encoded = sentence["text"].encode("utf-8")
+                text_parts.append(encoded)
+                text_len += len(encoded)
+                text_offsets.append(text_len)
+            item_offsets.append(len(speaker))
+
+        return cls(
+            keys=[item.get("key", "") for item in results],
+            item_texts=[item.get("text", "") for item in results],
+            speakers=speakers,
+            item_offsets=item_offsets,
+            speaker=speaker,
+            start_ms=start_ms,
+            end_ms=end_ms,
+            text_offsets=text_offsets,
+            text_buffer=b"".join(text_parts),
+        )
+
+    @classmethod
+    def from_merged_results(cls, merged_results):
+        """
+        由merge_speaker.py的合并结果构建，原始句子取自segments
+
+        :param merged_results: 合并结果列表，每项包含key、text和merged_sentences
+        """
+        parsed = []
+        turn_offsets = array("I", [0])
+        item_turn_offsets = array("I", [0])
+        for item in merged_results:
+            sentences = []
+            for turn in item.get("merged_sentences", []):
+                for segment in turn["segments"]:
+                    sentences.append(dict(segment, speaker=turn["speaker"]))
+                turn_offsets.append(turn_offsets[-1] + len(turn["segments"]))
+            item_turn_offsets.append(len(turn_offsets) - 1)
+            parsed.append({"key": item.get("key", ""), "text": item.get("text", ""), "sentences": sentences})
+        return cls.from_parsed_results(parsed).with_turns(turn_offsets, item_turn_offsets)
+
+    def with_turns(self, turn_offsets, item_turn_offsets):
+        """返回共享句子列、附带新轮次划分的store"""
+        return SentenceStore(self.keys, self.item_texts, self.speakers, self.item_offsets, self.speaker,
+                             self.start_ms, self.end_ms, self.text_offsets, self.text_buffer,
+                             turn_offsets, item_turn_offsets, _mmap=self._mmap)
+
+    # ---- 访问 ----
+
+    def __len__(self):
+        return len(self.speaker)
+
+    @property
+    def is_merged(self):
+        return self.turn_offsets is not None
+
+    def sentence_text(self, index):
+        return bytes(self.text_buffer[self.text_offsets[index]:self.text_offsets[index + 1]]).decode("utf-8")
+
+    def speaker_name(self, index):
+        return self.speakers[self.speaker[index]]
+
+    def item_range(self, item_index):
+        """条目的句子下标范围"""
+        return range(self.item_offsets[item_index], self.item_offsets[item_index + 1])
+
+    def item_turn_range(self, item_index):
+        """条目的轮次下标范围"""
+        return range(self.item_turn_offsets[item_index], self.item_turn_offsets[item_index + 1])
+
+    def turn_text(self, turn_index):
+        sentences = range(self.turn_offsets[turn_index], self.turn_offsets[turn_index + 1])
+        return " ".join(self.sentence_text(i) for i in sentences)
+
+    def iter_sentences(self, item_index):
+        """按absdata.py的格式逐句生成字典"""
+        for i in self.item_range(item_index):
+            yield {
+                "speaker": self.speaker_name(i),
+                "text": self.sentence_text(i),
+                "start_ms": self.start_ms[i],
+                "end_ms": self.end_ms[i],
+            }
+
+    def iter_turns(self, item_index, with_segments=True):
+        """按merge_speaker.py的格式逐轮生成字典"""
+        for t in self.item_turn_range(item_index):
+            first, last = self.turn_offsets[t], self.turn_offsets[t + 1]
+            texts = [self.sentence_text(i) for i in range(first, last)]
+            turn = {
+                "speaker": self.speaker_name(first),
+                "text": " ".join(texts),
+                "start_ms": self.start_ms[first],
+                "end_ms": self.end_ms[last - 1],
+            }
+            if with_segments:
+                turn["segments"] = [
+                    {"text": text, "start_ms": self.start_ms[i], "end_ms": self.end_ms[i]}
+                    for i, text in zip(range(first, last), texts)
+                ]
+            yield turn
+
+    def to_parsed_results(self):
+        return [
+            {"key": key, "text": text, "sentences": list(self.iter_sentences(n))}
+            for n, (key, text) in enumerate(zip(self.keys, self.item_texts))
+        ]
+
+    def to_merged_results(self):
+        return [
+            {"key": key, "text": text, "merged_sentences": list(self.iter_turns(n))}
+            for n, (key, text) in enumerate(zip(self.keys, self.item_texts))
+        ]
+
+    # ---- 读写 ----
+
+    def _columns(self):
+        columns = [self.item_offsets, self.speaker, self.start_ms, self.end_ms, self.text_offsets]
+        if self.is_merged:
+            columns += [self.turn_offsets, self.item_turn_offsets]
+        return columns
+
+    def save(self, path):
+        """
+        保存为二进制文件：定长头 + JSON元数据 + 按8字节对齐的各列 + 文本缓冲区
+
+        :param path: 输出文件路径
+        """
+        # 条目全文与逐句文本拼接一致时不重复保存，读取时再拼接
+        item_texts = [
+            None if text == "".join(self.sentence_text(i) for i in self.item_range(n)) else text
+            for n, text in enumerate(self.item_texts)
+        ]
+        meta = json.dumps({
+            "keys": self.keys,
+            "item_texts": item_texts,
+            "speakers": self.speakers,
+            "byteorder": sys.byteorder,
+        }, ensure_ascii=False).encode("utf-8")
+        n_turns = len(self.turn_offsets) - 1 if self.is_merged else 0
+        flags = _FLAG_MERGED if self.is_merged else 0
+        with open(path, "wb") as f:
+            f.write(_HEADER.pack(MAGIC, flags, len(self.keys), len(self), n_turns, len(meta), len(self.text_buffer)))
+            f.write(meta)
+            for column in self._columns():
+                f.write(b"\0" * _padding(f.tell()))
+                column.tofile(f) if isinstance(column, array) else f.write(column.tobytes())
+            f.write(b"\0" * _padding(f.tell()))
+            f.write(self.text_buffer)
+
+    @classmethod
+    def load(cls, path, use_mmap=True):
+        """
+        读取二进制文件，默认通过mmap直接引用各列，不复制数据
+
+        :param path: 文件路径
+        :param use_mmap: 为False时把各列读入内存
+        """
+        with open(path, "rb") as f:
+            if use_mmap:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                buffer = memoryview(mapped)
+            else:
+                mapped = None
+                buffer = memoryview(f.read())
+
+        magic, flags, n_items, n_sentences, n_turns, meta_len, text_len = _HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} 不是句子存储文件")
+        merged = bool(flags & _FLAG_MERGED)
+        offset = _HEADER.size
+        meta = json.loads(bytes(buffer[offset:offset + meta_len]).decode("utf-8"))
+        if meta["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} 的字节序为 {meta['byteorder']}，与当前平台不一致")
+        offset += meta_len
+
+        def column(code, count):
+            nonlocal offset
+            offset += _padding(offset)
+            size = array(code).itemsize * count
+            view = buffer[offset:offset + size].cast(code)
+            offset += size
+            return view if use_mmap else array(code, view)
+
+        item_offsets = column("I", n_items + 1)
+        speaker = column("H", n_sentences)
+        start_ms = column("i", n_sentences)
+        end_ms = column("i", n_sentences)
+        text_offsets = column("I", n_sentences + 1)
+        turn_offsets = column("I", n_turns + 1) if merged else None
+        item_turn_offsets = column("I", n_items + 1) if merged else None
+        offset += _padding(offset)
+        text_buffer = buffer[offset:offset + text_len]
+        if not use_mmap:
+            text_buffer = bytes(text_buffer)
+
+        store = cls(meta["keys"], meta["item_texts"], meta["speakers"], item_offsets, speaker, start_ms,
+                    end_ms, text_offsets, text_buffer, turn_offsets, item_turn_offsets, _mmap=mapped)
+        store.item_texts = [
+            "".join(store.sentence_text(i) for i in store.item_range(n)) if text is None else text
+            for n, text in enumerate(store.item_texts)
+        ]
+        return store
+
+    def close(self):
+        """释放mmap，之后不能再访问各列"""
+        if self._mmap is not None:
+            for name in ("item_offsets", "speaker", "start_ms", "end_ms", "text_offsets",
+                         "turn_offsets", "item_turn_offsets", "text_buffer"):
+                view = getattr(self, name)
+                if isinstance(view, memoryview):
+                    view.release()
+            self._mmap.close()
+            self._mmap = None
+
+
+def load_results_as_store(path):
+    """
+    读取句子存储文件，或parsed/merged的JSON结果并转换为SentenceStore
+
+    :param path: .sst文件或JSON文件路径
+    """
+    if path.endswith(".sst"):
+        return SentenceStore.load(path)
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if data and "merged_sentences" in data[0]:
+        return SentenceStore.from_merged_results(data)
+    return SentenceStore.from_parsed_results(data)
+
+
+def store_path(stage, episode, store_dir=DEFAULT_STORE_DIR):
+    """
+    一集的句子存储文件路径，文件名与由该阶段的JSON文件转换得到的相同
+
+    :param stage: "parsed"或"merged"
+    :param episode: 集数编号
+    :param store_dir: 句子存储目录
+    """
+    return os.path.join(store_dir, f"{stage}_asr_result{episode}.sst")
+
+
+def parse_arguments():
+    """
+    解析命令行参数
+
+    :return: 解析后的参数
+    """
+    parser = argparse.ArgumentParser(description='将parsed/merged的JSON结果转换为列式句子存储(.sst)')
+    parser.add_argument('inputs', nargs='+', help='输入的JSON文件')
+    parser.add_argument('--output', '-o', type=str, default=DEFAULT_STORE_DIR,
+                        help=f'输出目录路径 (默认: {DEFAULT_STORE_DIR})')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    args = parse_arguments()
+    os.makedirs(args.output, exist_ok=True)
+
+    total_json = total_store = 0
+    for input_file in args.inputs:
+        store = load_results_as_store(input_file)
+        output_file = os.path.join(args.output, os.path.splitext(os.path.basename(input_file))[0] + ".sst")
+        store.save(output_file)
+        total_json += os.path.getsize(input_file)
+        total_store += os.path.getsize(output_file)
+        logger.info(f"{input_file} -> {output_file} ({len(store)} 句)")
+
+    logger.info(f"转换完成: JSON {total_json / 1024:.0f} KB -> 存储 {total_store / 1024:.0f} KB")
@@ -0,0 +1,491 @@
+"""
+跨集的说话人聚类：每集每个说话人一个向量，在全部集上用HDBSCAN聚类，得到全局说话人编号
+
+absdata.py给出的Speaker_{spk}只在一集内有效。这里为每集的每个说话人计算向量：
+- voice: 有音频时用cam++声纹向量，取该说话人最长的若干轮，按时长加权平均
+- text: 没有音频或语音太短时，用该说话人全部台词的字符n-gram（对数词频，固定种子的随机投影降维）
+
+两种向量不在同一空间，分别聚类，全局编号以V/T开头区分。向量按 (输入内容, 配置) 缓存，
+新增几集时只计算新的集，聚类本身只处理每集几个说话人的向量，几千集也只需几秒。
+聚不进任何簇的说话人各自单独编号（clustered为False），保证每句话都有全局编号。
+
+聚类结果写入speaker_map.json，find_huang.py可以按全局编号提取某个角色的全部对话。
+"""
+import json
+import os
+import argparse
+import logging
+from collections import Counter
+
+import numpy as np
+
+from build_state import text_hash
+from corpus import load_episode
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = "data/speaker_embeddings"
+DEFAULT_MAP_PATH = "data/speaker_map.json"
+TEXT_CONFIG = {"analyzer": "char", "ngram_range": [1, 2], "n_features": 2 ** 18, "dim": 256, "seed": 0}
+VOICE_MODEL = "cam++"
+SAMPLE_RATE = 16000
+# 每个说话人最多取这么多秒语音，单段最长VOICE_SEGMENT_S秒
+VOICE_MAX_S = 60
+VOICE_SEGMENT_S = 10
+# 语音不足MIN_VOICE_S秒时改用文本向量，文本不足MIN_CHARS字时不参与聚类
+MIN_VOICE_S = 3
+MIN_CHARS = 30
+# 聚类前先用PCA降到的维数
+CLUSTER_DIMS = 32
+
+
+def speaker_turns(merged_results):
+    """
+    按说话人收集一集的轮次
+
+    :param merged_results: merge_speaker.py的合并结果
+    :return: {说话人: [轮次字典]}，按首次出现的顺序
+    """
+    turns = {}
+    for item in merged_results:
+        for turn in item.get("merged_sentences", []):
+            turns.setdefault(turn["speaker"], []).append(turn)
+    return turns
+
+
+class EmbeddingCache:
+    """
+    按 (向量类型, 配置, 输入内容) 缓存一集各说话人的向量，每集一个.npz
+
+    与asr_ingest.AsrCache一样先写临时文件再改名。
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npz")
+
+    def get(self, key):
+        """
+        :return: (说话人列表, 向量矩阵)，没有时返回None
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+        try:
+            with np.load(path) as data:
+                speakers, vectors = list(data["speakers"]), data["vectors"]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"缓存文件 {path} 损坏，重新计算: {e}")
+            self.misses += 1
+            return None
+        self.hits += 1
+        return speakers, vectors
+
+    def put(self, key, speakers, vectors):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, speakers=np.array(speakers, dtype=str), vectors=vectors)
+        os.replace(tmp_path, path)
+
+    def log_stats(self):
+        logger.info(f"说话人向量缓存 - 命中: {self.hits}, 未命中: {self.misses}")
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+_text_projection = None
+
+
+def text_embeddings(docs):
+    """
+    台词文本的风格向量：字符n-gram的对数词频，经固定种子的稀疏随机投影降维
+
+    投影矩阵只由TEXT_CONFIG决定，不需要在全部语料上拟合，每集的向量可以单独计算和缓存。
+
+    :param docs: 每个说话人的全部台词
+    :return: len(docs) x TEXT_CONFIG["dim"] 的矩阵，各行已归一化
+    """
+    global _text_projection
+    try:
+        from scipy.sparse import csr_matrix
+        from sklearn.feature_extraction.text import HashingVectorizer
+        from sklearn.preprocessing import normalize
+        from sklearn.random_projection import SparseRandomProjection
+    except ImportError:
+        raise ImportError("计算文本向量需要安装scikit-learn") from None
+
+    if _text_projection is None:
+        _text_projection = SparseRandomProjection(n_components=TEXT_CONFIG["dim"], dense_output=True,
+                                                  random_state=TEXT_CONFIG["seed"])
+        _text_projection.fit(csr_matrix((1, TEXT_CONFIG["n_features"])))
+    vectorizer = HashingVectorizer(analyzer=TEXT_CONFIG["analyzer"], ngram_range=tuple(TEXT_CONFIG["ngram_range"]),
+                                   n_features=TEXT_CONFIG["n_features"], alternate_sign=False, norm=None)
+    counts = vectorizer.transform(docs)
+    counts.data = np.log1p(counts.data)
+    return _normalize(_text_projection.transform(normalize(counts)).astype(np.float32))
+
+
+def load_voice_model(device="cpu"):
+    """加载FunASR的cam++说话人模型"""
+    try:
+        from funasr import AutoModel
+    except ImportError:
+        raise ImportError("计算声纹向量需要安装funasr（见requirements.txt）") from None
+    return AutoModel(model=VOICE_MODEL, device=device, disable_update=True, disable_pbar=True, disable_log=True)
+
+
+def _load_audio(path):
+    """读取音频为16kHz单声道的numpy数组"""
+    try:
+        import torchaudio
+    except ImportError:
+        raise ImportError("读取音频需要安装torchaudio（见requirements.txt）") from None
+    waveform, rate = torchaudio.load(path)
+    waveform = waveform.mean(0)
+    if rate != SAMPLE_RATE:
+        waveform = torchaudio.functional.resample(waveform, rate, SAMPLE_RATE)
+    return waveform.numpy()
+
+
+def voice_segments(turns):
+    """
+    选出用于计算声纹的语音段：最长的若干轮，每段不超过VOICE_SEGMENT_S秒，总长不超过VOICE_MAX_S秒
+
+    :return: [(start_ms, end_ms)]
+    """
+    segments = []
+    total = 0
+    for turn in sorted(turns, key=lambda turn: turn["end_ms"] - turn["start_ms"], reverse=True):
+        if total >= VOICE_MAX_S * 1000:
+            break
+        end_ms = min(turn["end_ms"], turn["start_ms"] + VOICE_SEGMENT_S * 1000)
+        segments.append((turn["start_ms"], end_ms))
+        total += end_ms - turn["start_ms"]
+    return segments
+
+
+def voice_embeddings(model, audio, segments_by_speaker):
+    """
+    :param model: load_voice_model返回的模型
+    :param audio: 16kHz单声道音频
+    :param segments_by_speaker: {说话人: [(start_ms, end_ms)]}
+    :return: 说话人顺序与输入相同的向量矩阵，各行已归一化
+    """
+    vectors = []
+    for segments in segments_by_speaker.values():
+        weighted = 0
+        for start_ms, end_ms in segments:
+            clip = audio[start_ms * SAMPLE_RATE // 1000:end_ms * SAMPLE_RATE // 1000]
+            embedding = model.generate(input=clip)[0]["spk_embedding"]
+            weighted = weighted + np.asarray(embedding.cpu() if hasattr(embedding, "cpu") else embedding,
+                                             dtype=np.float32).reshape(-1) * (end_ms - start_ms)
+        vectors.append(weighted)
+    return _normalize(np.stack(vectors))
+
+
+def embed_episode(episode, merged_results, cache=None, audio_path=None, voice_model=None):
+    """
+    计算一集各说话人的向量
+
+    :param episode: 集数编号
+    :param merged_results: 合并结果
+    :param cache: EmbeddingCache，为None时不缓存
+    :param audio_path: 该集的音频，为None时全部用文本向量
+    :param voice_model: load_voice_model返回的模型，有audio_path时需要
+    :return: 每个说话人一个字典，包含episode、speaker、kind、turns、chars、seconds和vector（文本太少时为None）
+    """
+    turns = speaker_turns(merged_results)
+    rows = {}
+    for speaker, speaker_turn_list in turns.items():
+        rows[speaker] = {
+            "episode": episode,
+            "speaker": speaker,
+            "kind": "text",
+            "turns": len(speaker_turn_list),
+            "chars": sum(len(turn["text"].replace(" ", "")) for turn in speaker_turn_list),
+            "seconds": round(sum(turn["end_ms"] - turn["start_ms"] for turn in speaker_turn_list) / 1000, 1),
+            "vector": None,
+        }
+
+    voiced = {}
+    if audio_path is not None:
+        voiced = {speaker: voice_segments(speaker_turns) for speaker, speaker_turns in turns.items()}
+        voiced = {speaker: segments for speaker, segments in voiced.items()
+                  if sum(end - start for start, end in segments) >= MIN_VOICE_S * 1000}
+    texts = {speaker: "\n".join(turn["text"] for turn in turns[speaker])
+             for speaker in turns if speaker not in voiced and rows[speaker]["chars"] >= MIN_CHARS}
+
+    for kind, material, compute in (
+        ("voice", voiced, lambda: voice_embeddings(voice_model, _load_audio(audio_path), voiced)),
+        ("text", texts, lambda: text_embeddings(list(texts.values()))),
+    ):
+        if not material:
+            continue
+        if kind == "voice":
+            from asr_ingest import audio_hash
+            key = text_hash(kind, VOICE_MODEL, audio_hash(audio_path), json.dumps(material, sort_keys=True))
+        else:
+            key = text_hash(kind, json.dumps(TEXT_CONFIG, sort_keys=True), json.dumps(material, ensure_ascii=False))
+        cached = cache.get(key) if cache else None
+        if cached is None:
+            cached = list(material), compute()
+            if cache:
+                cache.put(key, *cached)
+        for speaker, vector in zip(*cached):
+            rows[speaker]["kind"] = kind
+            rows[speaker]["vector"] = vector
+    return list(rows.values())
+
+
+def cluster_vectors(vectors, min_cluster_size=5, min_samples=None, groups=None, dims=CLUSTER_DIMS):
+    """
+    HDBSCAN聚类：先减去均值、用PCA降到dims维并归一化，使欧氏距离近似余弦距离
+
+    同一集内的不同说话人已经由说话人分离区分开，因此一个簇在同一集中只保留离簇中心最近的一个，
+    其余改为噪声；之后成员少于min_cluster_size的簇整个改为噪声。
+
+    :param groups: 每个向量所属的集，为None时不做这一限制
+    :return: (簇标签数组，从0连续编号，噪声为-1; 归属概率数组)
+    """
+    try:
+        import hdbscan
+        from sklearn.decomposition import PCA
+    except ImportError:
+        raise ImportError("说话人聚类需要安装hdbscan和scikit-learn（见requirements.txt）") from None
+
+    if len(vectors) < max(min_cluster_size, 2):
+        return np.full(len(vectors), -1), np.zeros(len(vectors))
+    vectors = vectors - vectors.mean(axis=0)
+    dims = min(dims, len(vectors) - 1, vectors.shape[1])
+    reduced = _normalize(PCA(n_components=dims, random_state=0).fit_transform(vectors))
+    clusterer = hdbscan.HDBSCAN(min_cluster_size=min_cluster_size, min_samples=min_samples)
+    labels = clusterer.fit_predict(reduced)
+    probs = clusterer.probabilities_.copy()
+    if groups is not None:
+        for label in set(labels) - {-1}:
+            members = np.flatnonzero(labels == label)
+            similarity = reduced[members] @ reduced[members].mean(axis=0)
+            nearest = {}
+            for k, score in zip(members, similarity):
+                if groups[k] not in nearest or score > nearest[groups[k]][0]:
+                    nearest[groups[k]] = (score, k)
+            keep = {k for _, k in nearest.values()}
+            for k in members:
+                if k not in keep:
+                    labels[k], probs[k] = -1, 0.0
+        # 去掉同集的重复成员后，有的簇只剩一两个说话人，不再满足最小簇大小
+        small = [label for label in set(labels) - {-1} if np.count_nonzero(labels == label) < min_cluster_size]
+        demoted = np.isin(labels, small)
+        labels[demoted], probs[demoted] = -1, 0.0
+        kept = sorted(set(labels) - {-1})
+        labels = np.array([kept.index(label) if label >= 0 else -1 for label in labels])
+    return labels, probs
+
+
+def cluster_speakers(rows, min_cluster_size=5, min_samples=None):
+    """
+    按向量类型分别聚类，给每个说话人分配全局编号
+
+    :param rows: embed_episode返回的字典列表（全部集）
+    :return: 说话人映射，结构见save_speaker_map
+    """
+    episodes = {}
+    clusters = {}
+    for kind in ("voice", "text"):
+        members = [row for row in rows if row["kind"] == kind and row["vector"] is not None]
+        if not members:
+            continue
+        labels, probs = cluster_vectors(np.stack([row["vector"] for row in members]), min_cluster_size, min_samples,
+                                        [row["episode"] for row in members])
+        prefix = kind[0].upper()
+        n_clusters = int(labels.max()) + 1 if len(labels) else 0
+        singles = n_clusters
+        for row, label, prob in zip(members, labels, probs):
+            if label < 0:
+                label, singles = singles, singles + 1
+            row["global"] = f"{prefix}{int(label):03d}"
+            row["prob"] = round(float(prob), 3)
+            row["clustered"] = bool(label < n_clusters)
+    for n, row in enumerate(row for row in rows if "global" not in row):
+        # 台词太少、无法计算向量的说话人
+        row["global"], row["prob"], row["clustered"] = f"X{n:03d}", 0.0, False
+
+    for row in rows:
+        episodes.setdefault(str(row["episode"]), {})[row["speaker"]] = {
+            key: row[key] for key in ("global", "prob", "kind", "turns", "chars", "seconds")
+        }
+        cluster = clusters.setdefault(row["global"], {"kind": row["kind"], "clustered": row["clustered"],
+                                                      "members": 0, "episodes": 0, "turns": 0, "chars": 0})
+        cluster["members"] += 1
+        cluster["turns"] += row["turns"]
+        cluster["chars"] += row["chars"]
+    for global_id in clusters:
+        clusters[global_id]["episodes"] = sum(
+            1 for speakers in episodes.values() if any(info["global"] == global_id for info in speakers.values()))
+    return {"episodes": episodes, "clusters": clusters}
+
+
+def save_speaker_map(mapping, path, params):
+    """
+    保存说话人映射
+
+    episodes: {集数: {本集说话人: {global, prob, kind, turns, chars, seconds}}}
+    clusters: {全局编号: {kind, clustered, members, episodes, turns, chars}}
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(dict(mapping, params=params), f, ensure_ascii=False, indent=2)
+
+
+def load_speaker_map(path=DEFAULT_MAP_PATH):
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def speakers_by_episode(mapping, global_ids=None, allow_text=False):
+    """
+    :param mapping: load_speaker_map的返回值
+    :param global_ids: 只保留这些全局编号，为None时全部保留
+    :param allow_text: 是否允许在global_ids中指定文本向量聚出的簇；文本簇按用词聚在一起，
+                       常把同一场景的不同角色归为一人，不适合按角色提取对话
+    :return: {集数: {本集说话人: 全局编号}}，可直接传给find_huang.DialogueIndex.iter_speaker_pairs
+    :raises ValueError: global_ids中有文本簇而allow_text为False
+    """
+    if global_ids is not None:
+        text_ids = [global_id for global_id in global_ids
+                    if mapping["clusters"].get(global_id, {}).get("kind") == "text"]
+        if text_ids and not allow_text:
+            raise ValueError(f"{', '.join(text_ids)} 是文本向量聚出的簇，不能可靠地对应到一个角色；"
+                             f"请提供音频（--audio-dir）重新聚类，或明确允许使用文本簇")
+        if text_ids:
+            logger.warning(f"{', '.join(text_ids)} 是文本向量聚出的簇，提取的对话可能混有其他角色")
+    result = {}
+    for episode, speakers in mapping["episodes"].items():
+        selected = {speaker: info["global"] for speaker, info in speakers.items()
+                    if global_ids is None or info["global"] in global_ids}
+        if selected:
+            result[int(episode)] = selected
+    return result
+
+
+def apply_global_speakers(results, episode_speakers):
+    """
+    给一集的parsed或merged结果的每句、每轮加上global_speaker字段（原地修改）
+
+    :param results: 解析结果或合并结果
+    :param episode_speakers: {本集说话人: 全局编号}
+    :return: results
+    """
+    for item in results:
+        for unit in item.get("sentences", []) + item.get("merged_sentences", []):
+            unit["global_speaker"] = episode_speakers.get(unit["speaker"])
+    return results
+
+
+def keyword_share(mapping, term, start, end):
+    """
+    各全局说话人的台词中包含term的轮次比例，用于找出某个角色对应的编号（如皇上说"朕"）
+
+    :return: [(全局编号, 包含term的轮次数, 轮次数)]，按包含term的轮次数从多到少
+    """
+    hits, totals = Counter(), Counter()
+    by_episode = speakers_by_episode(mapping)
+    for i in range(start, end + 1):
+        if i not in by_episode:
+            continue
+        for speaker, turns in speaker_turns(load_episode("merged", i)).items():
+            global_id = by_episode[i][speaker]
+            totals[global_id] += len(turns)
+            hits[global_id] += sum(term in turn["text"] for turn in turns)
+    return sorted(((global_id, hits[global_id], totals[global_id]) for global_id in totals),
+                  key=lambda item: item[1], reverse=True)
+
+
+def parse_arguments():
+    """
+    解析命令行参数
+
+    :return: 解析后的参数
+    """
+    parser = argparse.ArgumentParser(description='跨集聚类说话人，给每句话加上全局说话人编号')
+    parser.add_argument('--start', '-s', type=int, default=1,
+                        help='起始文件编号 (默认: 1)')
+    parser.add_argument('--end', '-e', type=int, default=46,
+                        help='结束文件编号 (默认: 46)')
+    parser.add_argument('--audio-dir', type=str, default=None,
+                        help='音频目录（按自然顺序依次对应第start、start+1……集），指定后优先使用声纹向量')
+    parser.add_argument('--device', type=str, default="cpu",
+                        help='声纹模型的推理设备 (默认: cpu)')
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR,
+                        help=f'向量缓存目录 (默认: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='不使用向量缓存')
+    parser.add_argument('--min-cluster-size', type=int, default=5,
+                        help='HDBSCAN的最小簇大小，即一个角色至少出现的集数 (默认: 5)')
+    parser.add_argument('--min-samples', type=int, default=None,
+                        help='HDBSCAN的min_samples，越大噪声点越多 (默认: 同min-cluster-size)')
+    parser.add_argument('--output', '-o', type=str, default=DEFAULT_MAP_PATH,
+                        help=f'说话人映射输出文件 (默认: {DEFAULT_MAP_PATH})')
+    parser.add_argument('--apply-dir', type=str, default=None,
+                        help='把全局编号写回每句话，合并结果保存到该目录，不指定则不写')
+    parser.add_argument('--rank', type=str, default=None,
+                        help='聚类后按台词中包含该词的比例列出全局说话人，如 朕')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    args = parse_arguments()
+    cache = None if args.no_cache else EmbeddingCache(args.cache_dir)
+    audio_files, voice_model = {}, None
+    if args.audio_dir:
+        from asr_ingest import list_audio_files
+
+        audio_files = dict(enumerate(list_audio_files(args.audio_dir), args.start))
+        voice_model = load_voice_model(args.device)
+
+    rows = []
+    for i in range(args.start, args.end + 1):
+        try:
+            merged_results = load_episode("merged", i)
+        except FileNotFoundError:
+            continue
+        rows += embed_episode(i, merged_results, cache, audio_files.get(i), voice_model)
+    if cache:
+        cache.log_stats()
+
+    mapping = cluster_speakers(rows, args.min_cluster_size, args.min_samples)
+    save_speaker_map(mapping, args.output, {"text": TEXT_CONFIG, "voice_model": VOICE_MODEL if args.audio_dir else None,
+                                            "min_cluster_size": args.min_cluster_size,
+                                            "min_samples": args.min_samples})
+    clustered = {global_id: info for global_id, info in mapping["clusters"].items() if info["clustered"]}
+    logger.info(f"{len(rows)} 个本集说话人聚成 {len(clustered)} 个角色，"
+                f"{len(mapping['clusters']) - len(clustered)} 个未归入任何角色: {args.output}")
+    for global_id, info in sorted(clustered.items(), key=lambda item: -item[1]["turns"]):
+        logger.info(f"{global_id}: {info['episodes']} 集, {info['turns']} 轮, {info['chars']} 字")
+
+    if args.apply_dir:
+        os.makedirs(args.apply_dir, exist_ok=True)
+        by_episode = speakers_by_episode(mapping)
+        for i in sorted(by_episode):
+            output_file = os.path.join(args.apply_dir, f"merged_asr_result{i}.json")
+            with open(output_file, "w", encoding="utf-8") as f:
+                json.dump(apply_global_speakers(load_episode("merged", i), by_episode[i]), f,
+                          ensure_ascii=False, indent=2)
+        logger.info(f"已写回全局编号: {args.apply_dir}")
+
+    if args.rank:
+        for global_id, hits, turns in keyword_share(mapping, args.rank, args.start, args.end)[:10]:
+            print(f"{global_id}: {hits} 轮包含「{args.rank}」，占 {hits / turns:.1%}（共 {turns} 轮）")
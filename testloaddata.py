@@ -1,7 +1,5 @@
-import json
-with open("data/conversion_result/conversion_result1.json", "r", encoding="utf-8") as f:
-    data=json.load(f)
-    for i in data:
-        print(i["orther"])
-        print(i["huang"])
-        print("--------------------------------")
+from corpus import load_episode
+for i in load_episode("conversion", 1):
+    print(i["orther"])
+    print(i["huang"])
+    print("--------------------------------")